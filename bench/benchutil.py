@@ -0,0 +1,57 @@
+"""
+Helpers shared by the benchmarks. They import the server module without starting
+it, from the repository root, with the local config.py when there is one.
+"""
+import os
+import resource
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# used when config.py is missing, the benchmarks do not reach the database
+BENCH_CONFIG = {
+    "SERVER_IP": "127.0.0.1",
+    "SERVER_PORT": 8080,
+    "DB_HOST": "127.0.0.1",
+    "DB_PORT": 3306,
+    "DB_USER": "ccss",
+    "DB_PASS": "",
+    "DB_NAME": "ccss",
+    "NOTIFY_USER": None,
+    "NOTIFY_USER_PATH": None,
+    "PUSH_TRANSPORT": "fake",
+}
+
+def load_server(**overrides):
+    """
+    :return: the main module. overrides are set on the config module before the import.
+    """
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    try:
+        import config
+    except ImportError:
+        config = types.ModuleType("config")
+        config.__dict__.update(BENCH_CONFIG)
+        sys.modules["config"] = config
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    import main
+    return main
+
+def rss_bytes(pid="self"):
+    # resident set size of a process, Linux only
+    with open(f"/proc/{pid}/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def cpu_seconds(pid="self"):
+    # user + system CPU time of a process, Linux only
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
@@ -0,0 +1,128 @@
+"""
+Memory per idle connection and CPU per broadcast for each permessage-deflate policy.
+
+For every policy a server process is started with compression_options() of
+main.py, a client process opens --connections sockets (offering permessage-deflate
+like browsers do), the growth of the server RSS is divided by the number of sockets,
+then --broadcasts chat messages and as many ping_response sized replies are sent to
+every socket through broadcast_message.
+
+    python bench/compression.py [--connections 2000] [--broadcasts 20]
+"""
+import argparse
+import asyncio
+import gc
+import subprocess
+import sys
+import time
+
+import websockets
+
+from benchutil import load_server, rss_bytes
+
+POLICIES = [
+    ("off", {"enabled": False}),
+    ("websockets default (12 bits, memLevel 5)", {"window_bits": 12, "mem_level": 5, "min_size": 0}),
+    ("server default (+ min size 256)", {}),
+    ("small (9 bits, memLevel 1)", {"window_bits": 9, "client_window_bits": 9, "mem_level": 1}),
+    ("no context takeover", {"no_context_takeover": True}),
+]
+
+CHAT_MESSAGE = {
+    "event": "chat_message",
+    "data": {
+        "username": "alice",
+        "msgid": 123456,
+        "room": 42,
+        "message": "Are we still on for the review at three? I moved the notes to the shared folder.",
+        "msginfo": {"attachments": [{"name": "notes.pdf", "size": 48213, "mime": "application/pdf"}], "mentions": [7, 9]},
+    },
+}
+PING_RESPONSE = {"event": "ping_response", "status": True, "user_id": 7}
+
+async def run_clients(port, connections, expected):
+    sockets = []
+    for _ in range(connections):
+        sockets.append(await websockets.connect(f"ws://127.0.0.1:{port}", compression="deflate", max_queue=None))
+    print("ready", flush=True)
+    received = 0
+
+    async def drain(ws):
+        nonlocal received
+        async for _ in ws:
+            received += 1
+
+    readers = [asyncio.create_task(drain(ws)) for ws in sockets]
+    while received < expected * connections:
+        await asyncio.sleep(0.01)
+    print("done", flush=True)
+    await asyncio.gather(*readers, return_exceptions=True)
+
+async def measure(server, name, options, args, port):
+    sockets = set()
+    connected = asyncio.Event()
+
+    async def handler(ws):
+        sockets.add(ws)
+        if len(sockets) == args.connections:
+            connected.set()
+        await ws.wait_closed()
+
+    gc.collect()
+    ws_server = await websockets.serve(handler, "127.0.0.1", port, **server.compression_options(**options))
+    rss_before = rss_bytes()
+    client = await asyncio.create_subprocess_exec(
+        sys.executable, __file__, "--client", str(port), "--connections", str(args.connections),
+        "--broadcasts", str(args.broadcasts), stdout=subprocess.PIPE,
+    )
+    assert (await client.stdout.readline()).strip() == b"ready"
+    await connected.wait()
+    gc.collect()
+    per_socket = (rss_bytes() - rss_before) / args.connections
+
+    compressed = sum(1 for ws in sockets if ws.protocol.extensions)
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(args.broadcasts):
+        server.broadcast_message(CHAT_MESSAGE, sockets)
+        server.broadcast_message(PING_RESPONSE, sockets)
+        await asyncio.sleep(0)
+    assert (await client.stdout.readline()).strip() == b"done"
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+
+    for ws in list(sockets):
+        await ws.close()
+    await client.wait()
+    ws_server.close()
+    await ws_server.wait_closed()
+    print(f"{name:<42} {per_socket / 1024:8.1f} KiB/socket {cpu / args.broadcasts * 1000:8.2f} ms CPU/broadcast "
+          f"{wall:6.2f} s wall  {compressed}/{args.connections} compressing", flush=True)
+
+def run_policies(args):
+    print(f"{args.connections} connections, {args.broadcasts} broadcasts of one chat message and one ping_response")
+    for index in range(len(POLICIES)):
+        # a fresh process per policy, memory freed by the previous one would hide the growth
+        subprocess.run([
+            sys.executable, __file__, "--policy", str(index), "--port", str(args.port + index),
+            "--connections", str(args.connections), "--broadcasts", str(args.broadcasts),
+        ], check=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--broadcasts", type=int, default=20)
+    parser.add_argument("--port", type=int, default=18700)
+    parser.add_argument("--policy", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--client", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.client:
+        asyncio.run(run_clients(args.client, args.connections, 2 * args.broadcasts))
+    elif args.policy is not None:
+        name, options = POLICIES[args.policy]
+        asyncio.run(measure(load_server(), name, options, args, args.port))
+    else:
+        run_policies(args)
+
+if __name__ == "__main__":
+    main()
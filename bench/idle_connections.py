@@ -0,0 +1,144 @@
+"""
+Server memory per idle socket, before and after the slotted Session.
+
+A server process accepts --connections loopback sockets from --clients client
+processes (each binds its own 127.0.0.x address, so more than one port range of
+sockets fits). RSS growth is divided by the number of sockets twice: when the
+sockets are connected and when every one of them is registered.
+
+  before: the per-connection dict of the old ws_handler, with its eager pipelining
+          semaphore, room_tails dict and task set
+  after:  Session from main.py, through the real ws_handler and Register fields
+
+The server needs a file descriptor per socket and each client process one per
+socket it opens, raise ulimit -n first (the benchmark raises the soft limit to the
+hard one). 50k sockets take about 2 GB with both sides on one host.
+
+    python bench/idle_connections.py [--connections 50000] [--clients 4]
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import io
+import secrets
+import subprocess
+import sys
+
+import websockets
+
+from benchutil import load_server, raise_fd_limit, rss_bytes
+
+def make_legacy_handler(server):
+    async def handler(websocket):
+        # what ws_handler allocated per connection before Session
+        server.connected_clients[websocket] = {"registered": False, "user": None}
+        inflight = asyncio.Semaphore(server.MAX_PIPELINED_REQUESTS)
+        room_tails = {}
+        pipelined = set()
+        client_ip = websocket.remote_address[0]
+        try:
+            async for message in websocket:
+                pass
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            server.connected_clients.pop(websocket, None)
+    return handler
+
+def register_legacy(server, websocket, index):
+    user_id, organization_id = 100000 + index, int(str(1000 + index % 20))
+    server.user_connections.setdefault(user_id, set()).add(websocket)
+    server.organization_connections.setdefault(organization_id, set()).add(websocket)
+    server.connected_clients[websocket].update({
+        "session_token": secrets.token_urlsafe(32),
+        "organization_id": organization_id,
+        "registered": True,
+        "user_id": user_id,
+        "username": f"user{index}",
+    })
+
+def register_session(server, websocket, index):
+    # the assignments of handle_register, with values built like database rows
+    user_id, organization_id = 100000 + index, int(str(1000 + index % 20))
+    server.register_connection(websocket, user_id, organization_id)
+    session = server.connected_clients[websocket]
+    session.session_token = secrets.token_urlsafe(32)
+    session.organization_id = server.intern_organization_id(organization_id)
+    session.registered = True
+    session.user_id = user_id
+    session.username = sys.intern(f"user{index}")
+
+async def run_clients(port, address, connections):
+    raise_fd_limit()
+    sockets = []
+    for _ in range(connections):
+        sockets.append(await websockets.connect(
+            f"ws://127.0.0.1:{port}", local_addr=(address, 0), compression=None, open_timeout=60))
+    print("ready", flush=True)
+    await asyncio.Event().wait()
+
+async def measure(mode, args):
+    limit = raise_fd_limit()
+    if limit < args.connections + 100:
+        sys.exit(f"ulimit -n is {limit}, {args.connections} sockets need more")
+    server = load_server()
+    handler = server.ws_handler if mode == "after" else make_legacy_handler(server)
+    register = register_session if mode == "after" else register_legacy
+
+    gc.collect()
+    ws_server = await websockets.serve(handler, "127.0.0.1", args.port, compression=None, backlog=4096)
+    rss_before = rss_bytes()
+    per_client = args.connections // args.clients
+    clients = []
+    # ws_handler prints a line per connection
+    with contextlib.redirect_stdout(io.StringIO()):
+        for index in range(args.clients):
+            clients.append(await asyncio.create_subprocess_exec(
+                sys.executable, __file__, "--client", str(args.port), "--address", f"127.0.0.{index + 2}",
+                "--connections", str(per_client), stdout=subprocess.PIPE,
+            ))
+        for client in clients:
+            if (await client.stdout.readline()).strip() != b"ready":
+                sys.exit("a client process failed")
+        while len(server.connected_clients) < per_client * args.clients:
+            await asyncio.sleep(0.05)
+    sockets = list(server.connected_clients)
+    gc.collect()
+    connected = (rss_bytes() - rss_before) / len(sockets)
+
+    for index, websocket in enumerate(sockets):
+        register(server, websocket, index)
+    gc.collect()
+    registered = (rss_bytes() - rss_before) / len(sockets)
+    print(f"{mode:<7} {len(sockets)} sockets  {connected:8.0f} bytes/socket connected  {registered:8.0f} bytes/socket registered", flush=True)
+
+    for client in clients:
+        client.terminate()
+        await client.wait()
+    ws_server.close()
+    await ws_server.wait_closed()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=50000)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--port", type=int, default=18800)
+    parser.add_argument("--mode", choices=["before", "after"], help=argparse.SUPPRESS)
+    parser.add_argument("--client", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--address", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.client:
+        asyncio.run(run_clients(args.client, args.address, args.connections))
+    elif args.mode:
+        asyncio.run(measure(args.mode, args))
+    else:
+        for index, mode in enumerate(("before", "after")):
+            # a fresh process per mode, memory freed by the first one would hide the growth
+            subprocess.run([
+                sys.executable, __file__, "--mode", mode, "--port", str(args.port + index),
+                "--connections", str(args.connections), "--clients", str(args.clients),
+            ], check=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+"""
+End-to-end load test: simulated clients against a local server.
+
+The server is started from main.py with the fake push transport (no FCM) and
+--users load users are added to its storage. Client processes
+then connect and Register every user, each room of --room-size users is created
+with UpdateOrMakeRoom, and for --duration seconds BroadcastMessage is sent at
+--rate messages per second and GetHistory at --history-rate reads per second, from
+random users. Reported:
+
+  fan-out  from the BroadcastMessage frame being sent to chat_message arriving at
+           each online member of the room
+  ack      BroadcastMessage until its broadcast_message_response
+  history  GetHistory until its reply
+  server   CPU and RSS of the server process over the load phase
+
+Nothing leaves the host. --storage picks where the server keeps its rows: memory
+measures the server alone, sqlite a fresh file, mysql the database of config.py
+(the default, like the server). The load users are named load-<run>-<n> in
+organization --organization. With --url the server is not started, the users must
+then already exist (--seed adds them to the storage of config.py) and --server-pid
+gives the process to measure.
+
+    python bench/load.py [--storage memory] [--users 2000] [--room-size 10] [--rate 200]
+                         [--history-rate 20] [--duration 30] [--processes 2] [--json]
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import os
+import random
+import secrets
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+from benchutil import cpu_seconds, load_server, raise_fd_limit, rss_bytes
+
+def username(run, index):
+    return f"load-{run}-{index}"
+
+def token(run, index):
+    return f"load-token-{run}-{index}"
+
+def storage_config(args):
+    if args.storage == "sqlite":
+        return {"STORAGE": "sqlite", "SQLITE_PATH": os.path.join(tempfile.mkdtemp(prefix="ccss-load-"), "load.sqlite3")}
+    return {"STORAGE": args.storage} if args.storage else {}
+
+async def seed(server, args):
+    storage = await server.open_storage()
+    await server.migrate_storage(storage)
+    for index in range(args.users):
+        await storage.add_user(username(args.run, index), token(args.run, index), args.organization)
+    return storage
+
+async def seed_only(args):
+    server = load_server(PUSH_TRANSPORT="fake")
+    storage = await seed(server, args)
+    await storage.close()
+
+async def serve(args):
+    raise_fd_limit()
+    server = load_server(SERVER_IP="127.0.0.1", SERVER_PORT=args.port, PUSH_TRANSPORT="fake", **storage_config(args))
+    # main() keeps the storage the users were added to
+    server.storage = await seed(server, args)
+    await server.main()
+
+class Client:
+    """
+    One simulated user: a socket, its session token and the requests waiting for a reply.
+    """
+    def __init__(self, index, name, token):
+        self.index = index
+        self.name = name
+        self.token = token
+        self.websocket = None
+        self.session_token = None
+        self.room = None
+        self.pending = {}  # req_id -> future of the reply
+        self.next_req_id = 0
+
+    async def request(self, event, data=None, **fields):
+        self.next_req_id += 1
+        req_id = self.next_req_id
+        payload = {"event": event, "req_id": req_id, **fields}
+        if data is not None:
+            payload["data"] = dict(data, session_token=self.session_token)
+        future = self.pending[req_id] = asyncio.get_running_loop().create_future()
+        await self.websocket.send(json.dumps(payload))
+        return await future
+
+class LoadRun:
+    """
+    The clients of one client process and what they measured.
+    """
+    def __init__(self, url, run, first, count, room_size):
+        self.url = url
+        self.clients = [Client(index, username(run, index), token(run, index)) for index in range(first, first + count)]
+        self.room_size = room_size
+        self.room_members = {}  # room id -> number of members
+        self.fanout = []
+        self.ack = []
+        self.history = []
+        self.sent = 0
+        self.expected = 0
+        self.errors = 0
+        self.readers = []
+
+    async def read(self, client):
+        async for frame in client.websocket:
+            received = time.time()
+            message = json.loads(frame)
+            if message.get("event") == "chat_message":
+                self.fanout.append(received - json.loads(base64.b64decode(message["data"]["msginfo"]))["sent"])
+                continue
+            future = client.pending.pop(message.get("req_id"), None)
+            if future is not None and not future.done():
+                future.set_result(message)
+
+    async def connect(self, client, gate):
+        async with gate:
+            client.websocket = await websockets.connect(self.url, compression=None, max_queue=None, open_timeout=60)
+            self.readers.append(asyncio.create_task(self.read(client)))
+            reply = await client.request("Register", username=client.name, token=client.token)
+        if reply.get("event") != "register_success":
+            raise RuntimeError(f"{client.name} could not register: {reply}")
+        client.session_token = reply["data"]
+
+    async def make_rooms(self, run):
+        # the first user of every group creates the room, the others are already online
+        groups = [self.clients[i:i + self.room_size] for i in range(0, len(self.clients), self.room_size)]
+        for group in groups:
+            reply = await group[0].request("UpdateOrMakeRoom", {
+                "name": f"load-{run}-room-{group[0].index // self.room_size}",
+                "users": [client.name for client in group],
+                "description": "load test",
+            })
+            if reply["data"].get("status") != "success":
+                raise RuntimeError(f"could not create a room: {reply}")
+            for client in group:
+                client.room = reply["data"]["room"]
+            self.room_members[client.room] = len(group)
+
+    async def broadcast(self, client):
+        # the receivers are the other members, all of them are online
+        self.sent += 1
+        self.expected += self.room_members[client.room] - 1
+        started = time.perf_counter()
+        reply = await client.request("BroadcastMessage", {
+            "room": client.room,
+            "message": f"load message {self.sent} from {client.name}",
+            # base64 of a JSON object, like client/index.html sends it
+            "msginfo": base64.b64encode(json.dumps({"sent": time.time()}).encode()).decode(),
+        })
+        if reply.get("status"):
+            self.ack.append(time.perf_counter() - started)
+        else:
+            self.errors += 1
+
+    async def read_history(self, client):
+        started = time.perf_counter()
+        reply = await client.request("GetHistory", {"room": client.room, "limit": 20})
+        if "error" in reply:
+            self.errors += 1
+        else:
+            self.history.append(time.perf_counter() - started)
+
+    async def drive(self, rate, history_rate, duration):
+        """
+        Sends at rate per second on average, with exponential gaps between sends like
+        independent users. Does not wait for the replies, a slow server gets a backlog.
+        """
+        tasks = set()
+
+        async def schedule(operation, rate):
+            if rate <= 0:
+                return
+            # on a timeline, so time spent starting the sends does not lower the rate
+            now = time.monotonic()
+            deadline = now + duration
+            while True:
+                now += random.expovariate(rate)
+                if now >= deadline:
+                    return
+                await asyncio.sleep(now - time.monotonic())
+                task = asyncio.create_task(operation(random.choice(self.clients)))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        await asyncio.gather(schedule(self.broadcast, rate), schedule(self.read_history, history_rate))
+        if tasks:
+            await asyncio.wait(tasks, timeout=30)
+
+    def results(self):
+        return {
+            "fanout": self.fanout, "ack": self.ack, "history": self.history,
+            "sent": self.sent, "expected": self.expected, "errors": self.errors,
+        }
+
+async def run_clients(args):
+    raise_fd_limit()
+    load = LoadRun(args.url, args.run, args.first, args.count, args.room_size)
+    gate = asyncio.Semaphore(200)
+    started = time.perf_counter()
+    await asyncio.gather(*[load.connect(client, gate) for client in load.clients])
+    await load.make_rooms(args.run)
+    print(json.dumps({"ready": time.perf_counter() - started}), flush=True)
+
+    # the parent starts every client process at once
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.readline)
+    await load.drive(args.rate, args.history_rate, args.duration)
+    # the last chat_message frames can still be on their way
+    await asyncio.sleep(args.drain)
+    print(json.dumps(load.results()), flush=True)
+    for client in load.clients:
+        await client.websocket.close()
+    for reader in load.readers:
+        reader.cancel()
+
+async def wait_for_server(url, process, timeout=120):
+    deadline = time.monotonic() + timeout
+    while True:
+        if process is not None and process.returncode is not None:
+            sys.exit(f"the server exited with {process.returncode}, see --server-log")
+        try:
+            async with websockets.connect(url, open_timeout=5):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                sys.exit(f"no server on {url} after {timeout} s")
+            await asyncio.sleep(0.2)
+
+async def sample_rss(pid, peak, stop):
+    while not stop.is_set():
+        peak[0] = max(peak[0], rss_bytes(pid))
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop.wait(), 0.25)
+
+def percentiles(samples):
+    if len(samples) < 2:
+        return None
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50": cuts[49] * 1000, "p95": cuts[94] * 1000, "p99": cuts[98] * 1000, "max": max(samples) * 1000}
+
+def client_slices(users, room_size, processes):
+    # whole rooms per process, the members of a room count each other as receivers
+    rooms = (users + room_size - 1) // room_size
+    per_process = (rooms + processes - 1) // processes
+    slices = []
+    for first_room in range(0, rooms, per_process):
+        first = first_room * room_size
+        slices.append((first, min(users, (first_room + per_process) * room_size) - first))
+    return slices
+
+async def run_load(args):
+    raise_fd_limit()
+    server = None
+    log = None
+    pid = args.server_pid
+    url = args.url or f"ws://127.0.0.1:{args.port}"
+    if args.url is None:
+        log = open(args.server_log, "w")
+        server = await asyncio.create_subprocess_exec(
+            sys.executable, __file__, "--serve", "--port", str(args.port), "--run", args.run,
+            "--users", str(args.users), "--organization", str(args.organization),
+            *(["--storage", args.storage] if args.storage else []),
+            stdout=log, stderr=subprocess.STDOUT,
+        )
+        pid = server.pid
+    try:
+        await wait_for_server(url, server)
+        summary = await run_phases(args, url, pid)
+    finally:
+        if server is not None:
+            if server.returncode is None:
+                server.send_signal(signal.SIGTERM)
+                await server.wait()
+            log.close()
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(args, summary)
+
+async def run_phases(args, url, pid):
+    clients = []
+    for first, count in client_slices(args.users, args.room_size, args.processes):
+        share = count / args.users
+        clients.append(await asyncio.create_subprocess_exec(
+            sys.executable, __file__, "--client", url, "--run", args.run,
+            "--first", str(first), "--count", str(count), "--room-size", str(args.room_size),
+            "--rate", str(args.rate * share), "--history-rate", str(args.history_rate * share),
+            "--duration", str(args.duration), "--drain", str(args.drain),
+            # the results come back as one line of JSON with every latency sample
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, limit=2**30,
+        ))
+    ready = []
+    for client in clients:
+        line = await client.stdout.readline()
+        if not line:
+            sys.exit("a client process failed")
+        ready.append(json.loads(line)["ready"])
+
+    rss_start = rss_bytes(pid) if pid else None
+    cpu_start = cpu_seconds(pid) if pid else None
+    peak = [0]
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_rss(pid, peak, stop)) if pid else None
+    started = time.perf_counter()
+    for client in clients:
+        client.stdin.write(b"go\n")
+        await client.stdin.drain()
+    merged = {"fanout": [], "ack": [], "history": [], "sent": 0, "expected": 0, "errors": 0}
+    for client in clients:
+        line = await client.stdout.readline()
+        if not line:
+            sys.exit("a client process failed")
+        for name, value in json.loads(line).items():
+            merged[name] += value
+    elapsed = time.perf_counter() - started
+    summary = {
+        "storage": args.storage or "config", "users": args.users, "room_size": args.room_size, "processes": len(clients),
+        "rate": args.rate, "history_rate": args.history_rate, "duration": args.duration,
+        "setup_seconds": max(ready),
+        "sent": merged["sent"], "delivered": len(merged["fanout"]), "expected": merged["expected"],
+        "history_reads": len(merged["history"]), "errors": merged["errors"],
+        "messages_per_second": merged["sent"] / args.duration,
+        "deliveries_per_second": len(merged["fanout"]) / args.duration,
+        "latency_ms": {name: percentiles(merged[name]) for name in ("fanout", "ack", "history")},
+    }
+    if pid:
+        stop.set()
+        await sampler
+        cpu = cpu_seconds(pid) - cpu_start
+        summary["server"] = {
+            "cpu_seconds": cpu, "cpu_percent": cpu / elapsed * 100,
+            "rss_start_mib": rss_start / 2**20, "rss_end_mib": rss_bytes(pid) / 2**20, "rss_peak_mib": peak[0] / 2**20,
+        }
+    for client in clients:
+        await client.wait()
+    return summary
+
+def print_summary(args, summary):
+    print(f"{summary['storage']} storage, {summary['users']} users in rooms of {summary['room_size']}, {summary['rate']} messages/s and "
+          f"{summary['history_rate']} history reads/s for {summary['duration']} s, {summary['processes']} client processes "
+          f"(setup {summary['setup_seconds']:.1f} s)")
+    for name, label in (("fanout", "fan-out"), ("ack", "send ack"), ("history", "history")):
+        latency = summary["latency_ms"][name]
+        if latency is None:
+            print(f"{label:<10} no samples")
+        else:
+            print(f"{label:<10} p50 {latency['p50']:8.2f} ms  p95 {latency['p95']:8.2f} ms  "
+                  f"p99 {latency['p99']:8.2f} ms  max {latency['max']:8.2f} ms")
+    print(f"throughput {summary['messages_per_second']:.1f} messages/s, {summary['deliveries_per_second']:.1f} deliveries/s, "
+          f"{summary['delivered']}/{summary['expected']} delivered, {summary['history_reads']} history reads, "
+          f"{summary['errors']} errors")
+    server = summary.get("server")
+    if server:
+        print(f"server     CPU {server['cpu_seconds']:.1f} s ({server['cpu_percent']:.0f}%), RSS {server['rss_start_mib']:.1f} -> "
+              f"{server['rss_end_mib']:.1f} MiB, peak {server['rss_peak_mib']:.1f} MiB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--room-size", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=200, help="BroadcastMessage per second, all users together")
+    parser.add_argument("--history-rate", type=float, default=20, help="GetHistory per second, all users together")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for the last deliveries")
+    parser.add_argument("--processes", type=int, default=2, help="client processes")
+    parser.add_argument("--port", type=int, default=18900)
+    parser.add_argument("--organization", type=int, default=9000)
+    parser.add_argument("--storage", choices=["mysql", "sqlite", "memory"], help="storage of the started server, STORAGE of config.py by default")
+    parser.add_argument("--run", default=secrets.token_hex(4), help="suffix of the load usernames")
+    parser.add_argument("--url", help="an already running server, its users must exist")
+    parser.add_argument("--server-pid", type=int, help="process to measure with --url")
+    parser.add_argument("--server-log", default=os.devnull, help="output of the started server")
+    parser.add_argument("--seed", action="store_true", help="only add the load users to the database")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--client", help=argparse.SUPPRESS)
+    parser.add_argument("--first", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--count", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        asyncio.run(serve(args))
+    elif args.client:
+        args.url = args.client
+        asyncio.run(run_clients(args))
+    elif args.seed:
+        if args.storage:
+            sys.exit("--seed adds the users to the storage of config.py, the one of the running server")
+        asyncio.run(seed_only(args))
+        print(f"added {args.users} users load-{args.run}-0.. to organization {args.organization}")
+    else:
+        asyncio.run(run_load(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Cost of serializing one page of room history for the wire.
+
+before: the rows are walked to call isoformat() on every datetime, then json.dumps
+after:  the rows go as fetched from the database to the codecs of main.py
+
+    python bench/serialization.py [--rows 20] [--pages 2000] [--info-bytes 2000]
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+
+from benchutil import load_server
+
+def make_page(rows, info_bytes):
+    created = datetime(2024, 5, 1, 12, 0, 0)
+    page = []
+    for i in range(rows):
+        page.append({
+            "id": 100000 + i,
+            "user_id": 1000 + i % 7,
+            "room_id": 42,
+            "message": f"message number {i} of the page",
+            # message_information is a nested blob chosen by the clients
+            "message_information": {
+                "attachments": [{"name": f"file{n}.jpg", "size": 1024 * n, "mime": "image/jpeg"} for n in range(3)],
+                "mentions": [1000, 1001, 1002],
+                "text": "x" * info_bytes,
+            },
+            "created_at": created + timedelta(seconds=i),
+            "updated_at": created + timedelta(seconds=i),
+            "username": f"user{i % 7}",
+        })
+    return page
+
+def copy_page(page):
+    return [dict(msg) for msg in page]
+
+def before(page):
+    # what the history helpers did before the codec layer
+    for msg in page:
+        for field in ("created_at", "updated_at"):
+            if isinstance(msg.get(field), datetime):
+                msg[field] = msg[field].isoformat()
+    return json.dumps({"event": "get_history", "data": page})
+
+def measure(encode, page, pages):
+    copies = [copy_page(page) for _ in range(pages)]
+    start = time.perf_counter()
+    size = 0
+    for copy in copies:
+        size = len(encode(copy))
+    return (time.perf_counter() - start) / pages, size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=2000)
+    parser.add_argument("--info-bytes", type=int, default=2000)
+    args = parser.parse_args()
+
+    server = load_server()
+    page = make_page(args.rows, args.info_bytes)
+
+    cases = [("before: isoformat walk + json.dumps", before)]
+    cases.append((f"after: JSON codec ({'orjson' if server.orjson else 'json'})",
+                  lambda rows: server.json_codec.encode({"event": "get_history", "data": rows})))
+    if server.orjson is not None:
+        # the fallback when orjson is not installed
+        cases.append(("after: JSON codec (json fallback)",
+                      lambda rows: json.dumps({"event": "get_history", "data": rows}, default=server._encode_default)))
+    for codec in server.codecs.values():
+        cases.append((f"after: {codec.label} codec",
+                      lambda rows, codec=codec: codec.encode({"event": "get_history", "data": rows})))
+
+    print(f"{args.rows} rows per page, {args.info_bytes} byte message_information, {args.pages} pages")
+    baseline = None
+    for name, encode in cases:
+        seconds, size = measure(encode, page, args.pages)
+        baseline = baseline or seconds
+        print(f"{name:<42} {seconds * 1e6:9.1f} us/page {size:9d} bytes  x{baseline / seconds:.2f}")
+
+if __name__ == "__main__":
+    main()
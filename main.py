@@ -1,643 +1,2324 @@
 #!/bin/python3
 
+import time
+STARTUP_STARTED = time.perf_counter()
+
 import asyncio
+import bisect
 import json
-from aiohttp import web
+import os
+import sys
+import signal
 import websockets
-import mysql.connector
+from websockets.protocol import State
+from websockets.frames import Opcode
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
 import aiomysql
-from functools import partial
 import secrets
-from datetime import datetime, timedelta
-import firebase_admin
-from firebase_admin import credentials, messaging
-from firebase_admin import exceptions  
+import sqlite3
+import base64
+import binascii
+import contextvars
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+# firebase_admin and aiohttp are imported where they are used, they are slow to import
+# optional dependencies, not needed to run the server: orjson speeds up the JSON codec,
+# msgpack and cbor2 add the binary wire formats, offered to clients only when installed
+#     pip install orjson msgpack cbor2
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
 
 # config file local
 import config
 from config import SERVER_IP, DB_HOST, DB_PORT, DB_USER, DB_PASS, DB_NAME, SERVER_PORT, NOTIFY_USER, NOTIFY_USER_PATH
 
 connected_clients = {}
+# user_id -> set of live websockets, organization_id -> set of live websockets
+user_connections = {}
+organization_connections = {}
 pool = None
+# MySQLStorage, SQLiteStorage or MemoryStorage, opened by main() unless set before
+storage = None
+
+# FCM accepts at most 500 tokens per multicast request
+FCM_MULTICAST_LIMIT = 500
+PUSH_WORKERS = getattr(config, "PUSH_WORKERS", 4)
+push_executor = None
+
+MAX_PIPELINED_REQUESTS = getattr(config, "MAX_PIPELINED_REQUESTS", 8)
+# worker processes sharing SERVER_PORT through SO_REUSEPORT, 1 runs everything in this process
+WORKERS = getattr(config, "WORKERS", 1)
+BACKPLANE_SOCKET = getattr(config, "BACKPLANE_SOCKET", "/tmp/ccss-backplane.sock")
+PRESENCE_MAX_SUBSCRIPTIONS = getattr(config, "PRESENCE_MAX_SUBSCRIPTIONS", 1000)
+
+# permessage-deflate policy. Each compressing socket keeps a zlib compressor of about
+# (1 << (window_bits + 2)) + (1 << (mem_level + 9)) bytes and a decompressor of
+# 1 << client window bits, unless no_context_takeover drops them between messages.
+COMPRESSION = getattr(config, "COMPRESSION", True)
+COMPRESSION_WINDOW_BITS = getattr(config, "COMPRESSION_WINDOW_BITS", 12)
+COMPRESSION_CLIENT_WINDOW_BITS = getattr(config, "COMPRESSION_CLIENT_WINDOW_BITS", COMPRESSION_WINDOW_BITS)
+COMPRESSION_MEM_LEVEL = getattr(config, "COMPRESSION_MEM_LEVEL", 5)
+# messages shorter than this many bytes are sent uncompressed
+COMPRESSION_MIN_SIZE = getattr(config, "COMPRESSION_MIN_SIZE", 256)
+COMPRESSION_NO_CONTEXT_TAKEOVER = getattr(config, "COMPRESSION_NO_CONTEXT_TAKEOVER", False)
+
+# protocol pings, a socket that does not answer within PING_TIMEOUT is closed. None disables them.
+PING_INTERVAL = getattr(config, "PING_INTERVAL", 20)
+PING_TIMEOUT = getattr(config, "PING_TIMEOUT", 20)
+# seconds to wait for the closing handshake, a dead socket stays online until then
+CLOSE_TIMEOUT = getattr(config, "CLOSE_TIMEOUT", 10)
+# seconds a socket may stay connected without registering
+REGISTER_TIMEOUT = getattr(config, "REGISTER_TIMEOUT", 30)
+# seconds a registered socket may go without sending a frame, None keeps it while it answers pings
+IDLE_TIMEOUT = getattr(config, "IDLE_TIMEOUT", None)
+# close code of the sockets closed by the sweeper
+CLOSE_TIMEOUT_CODE = 4408
+
+DB_POOL_MINSIZE = getattr(config, "DB_POOL_MINSIZE", 1)
+DB_POOL_MAXSIZE = getattr(config, "DB_POOL_MAXSIZE", 10)
+# seconds to wait for a free pooled connection before the event fails
+DB_POOL_ACQUIRE_TIMEOUT = getattr(config, "DB_POOL_ACQUIRE_TIMEOUT", 10)
+pool_stats = {"acquires": 0, "timeouts": 0, "wait_total": 0.0, "wait_max": 0.0}
+# where the data helpers keep their rows: "mysql", "sqlite" (the SQLITE_PATH file, one
+# worker only) or "memory" (lost on exit, one worker only)
+STORAGE = getattr(config, "STORAGE", "mysql")
+SQLITE_PATH = getattr(config, "SQLITE_PATH", "ccss.sqlite3")
+# MySQL error codes
+ER_BAD_DB_ERROR = 1049
+ER_NO_SUCH_TABLE = 1146
+
+# number of messages returned by GetLastMessagesInRoom
+LAST_MESSAGES_LIMIT = 20
+# default and largest page size of the history events
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = getattr(config, "HISTORY_MAX_PAGE_SIZE", 200)
+
+# seconds spent in each startup phase
+startup_timings = {}
+
+# client_notifications.msg_type values
+MSG_TYPE_CHAT = 1
+MSG_TYPE_GENERAL = 2
+# minimum minutes between two push notifications to the same user, per message type
+NOTIFICATION_COOLDOWN_MINUTES = {
+    MSG_TYPE_CHAT: getattr(config, "CHAT_NOTIFICATION_COOLDOWN_MINUTES", 5),
+    MSG_TYPE_GENERAL: getattr(config, "GENERAL_NOTIFICATION_COOLDOWN_MINUTES", 0),
+}
+
+async def _add_column_if_missing(cursor, table, column, definition):
+    await cursor.execute(f"SHOW COLUMNS FROM {table} LIKE '{column}'")
+    result = await cursor.fetchone()
+    if result:
+        print(f"✅ Column {column} already exists in {table}.")
+    else:
+        print(f"⚙️ Adding column {column} to {table}...")
+        await cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+async def migrate_base_tables(cursor):
+    # Also brings databases created before schema_version existed up to date,
+    # so every statement here must be safe to run on existing tables.
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS client_notifications (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            organization_id bigint(20) NOT NULL,
+            user_id bigint(20) unsigned NOT NULL,
+            msg_type INT,
+            message TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_organization_id (organization_id),
+            INDEX idx_msg_type (msg_type),
+            INDEX idx_user_id (user_id)
+        )
+    """)
+
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS room_messages (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            organization_id bigint(20) NOT NULL,
+            room_id INT NOT NULL,
+            user_id bigint(20) unsigned NOT NULL,
+            message TEXT NOT NULL,
+            is_deleted tinyint(1) DEFAULT 0,
+            message_information LONGTEXT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_organization_id (organization_id),
+            INDEX idx_room_id (room_id),
+            INDEX idx_user_id (user_id)
+        )
+    """)
+
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS rooms (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(255) DEFAULT NULL,
+            room_type VARCHAR(16) NOT NULL DEFAULT 'group',
+            status INT DEFAULT 0,
+            image VARCHAR(255) DEFAULT NULL,
+            description TEXT DEFAULT NULL,
+            organization_id bigint(20) DEFAULT 0,
+            last_message_at TIMESTAMP NULL DEFAULT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_organization_id (organization_id),
+            INDEX idx_status (status)
+        )
+    """)
+
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS room_participants (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            room_id INT NOT NULL,
+            user_id bigint(20) unsigned NOT NULL,
+            last_message_seen INT, 
+            organization_id INT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_user_id (user_id),
+            INDEX idx_organization_id (organization_id),
+            INDEX idx_room_id (room_id)
+        )
+    """)
+
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS clients (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            username VARCHAR(512) DEFAULT "",
+            token VARCHAR(512) NOT NULL,
+            organization_id INT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_token (token),
+            INDEX idx_organization_id (organization_id)
+        )
+    """)
+
+    await _add_column_if_missing(cursor, "room_participants", "deleted_at", "TIMESTAMP NULL DEFAULT NULL")
+    await _add_column_if_missing(cursor, "room_participants", "silent_notifications", "INT NOT NULL DEFAULT 0")
+    await _add_column_if_missing(cursor, "clients", "device_token", "TEXT DEFAULT NULL")
+    await _add_column_if_missing(cursor, "rooms", "owner_id", "bigint(20) DEFAULT 0")
+    await _add_column_if_missing(cursor, "rooms", "last_message_at", "TIMESTAMP NULL DEFAULT NULL")
+    await _add_column_if_missing(cursor, "rooms", "room_type", "VARCHAR(16) NOT NULL DEFAULT 'group'")
+    await _add_column_if_missing(cursor, "clients", "active", "INT DEFAULT 30")
+
+async def migrate_history_index(cursor):
+    await cursor.execute("SHOW INDEX FROM room_messages WHERE Key_name = 'idx_room_org_deleted_id'")
+    if await cursor.fetchone():
+        return
+    await cursor.execute("""
+        ALTER TABLE room_messages
+        ADD INDEX idx_room_org_deleted_id (room_id, organization_id, is_deleted, id)
+    """)
+
+# Ordered schema migrations: (version, description, coroutine taking a cursor).
+# Append new ones at the end, never change an applied one.
+SCHEMA_MIGRATIONS = [
+    (1, "base tables", migrate_base_tables),
+    (2, "room history index", migrate_history_index),
+]
+
+async def get_schema_version(cursor):
+    try:
+        await cursor.execute("SELECT MAX(version) FROM schema_version")
+    except aiomysql.ProgrammingError as e:
+        if e.args[0] != ER_NO_SUCH_TABLE:
+            raise
+        await cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INT NOT NULL PRIMARY KEY,
+                description VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        return 0
+    result = await cursor.fetchone()
+    return result[0] or 0
 
-async def init_db():
+async def ensure_notify_user(storage):
     notify_user = NOTIFY_USER
     notify_user_path = NOTIFY_USER_PATH
+    if notify_user and notify_user_path:
+        user = await storage.get_user(notify_user, notify_user_path)
+        if user and int(user['organization_id']) == 0:
+            print("✅ Notify user already exists in clients.")
+        else:
+            print("⚙️ Adding notify user to clients...")
+            user_id = await storage.add_user(notify_user, notify_user_path, 0)
+            identity_cache.invalidate(user_id)
+    else:
+        print("ℹ️ NOTIFY_USER or NOTIFY_USER_PATH missing in config; skipping notify user bootstrap.")
 
-    # Connect without specifying DB (to check/create DB)
+async def create_database():
+    # Connect without specifying DB to create it
     conn = await aiomysql.connect(
         host=DB_HOST, port=DB_PORT,
         user=DB_USER, password=DB_PASS
     )
     async with conn.cursor() as cursor:
-        # Check if DB exists
-        await cursor.execute(f"SHOW DATABASES LIKE '{DB_NAME}'")
-        result = await cursor.fetchone()
-        if not result:
-            print(f"Database {DB_NAME} not found. Creating...")
-            await cursor.execute(f"CREATE DATABASE {DB_NAME}")
-        else:
-            print(f"Database {DB_NAME} already exists.")
+        print(f"Database {DB_NAME} not found. Creating...")
+        await cursor.execute(f"CREATE DATABASE IF NOT EXISTS {DB_NAME}")
     await conn.ensure_closed()
 
-    # Reconnect to the new DB
-    conn = await aiomysql.connect(
-        host=DB_HOST, port=DB_PORT,
-        user=DB_USER, password=DB_PASS,
-        db=DB_NAME
+async def init_db(pool):
+    """
+    Applies the pending SCHEMA_MIGRATIONS. When the schema is up to date this is a
+    single version query and no DDL runs.
+    """
+    async with db_connection(pool) as conn:
+        async with conn.cursor() as cursor:
+            version = await get_schema_version(cursor)
+            pending = [migration for migration in SCHEMA_MIGRATIONS if migration[0] > version]
+            if not pending:
+                print(f"✅ Schema is up to date (version {version}).")
+            for migration_version, description, migrate in pending:
+                print(f"⚙️ Applying schema migration {migration_version}: {description}...")
+                await migrate(cursor)
+                await cursor.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                    (migration_version, description),
+                )
+                print(f"✅ Schema migration {migration_version} applied.")
+
+async def create_pool(minsize=DB_POOL_MINSIZE, maxsize=DB_POOL_MAXSIZE):
+    pool = await aiomysql.create_pool(
+        host=DB_HOST,
+        port=DB_PORT,
+        user=DB_USER,
+        password=DB_PASS,
+        db=DB_NAME,
+        autocommit=True,            # Optional: automatically commit INSERT/UPDATE
+        minsize=minsize,    # Minimum number of connections in the pool
+        maxsize=maxsize     # Maximum number of connections
     )
-    async with conn.cursor() as cursor:
-        # Create tables if not exist
-        await cursor.execute("""
-            CREATE TABLE IF NOT EXISTS client_notifications (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                organization_id bigint(20) NOT NULL,
-                user_id bigint(20) unsigned NOT NULL,
-                msg_type INT,
-                message TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                INDEX idx_organization_id (organization_id),
-                INDEX idx_msg_type (msg_type),
-                INDEX idx_user_id (user_id)
-            )
-        """)
+    return pool
 
-        await cursor.execute("""
-            CREATE TABLE IF NOT EXISTS room_messages (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                organization_id bigint(20) NOT NULL,
-                room_id INT NOT NULL,
-                user_id bigint(20) unsigned NOT NULL,
-                message TEXT NOT NULL,
-                is_deleted tinyint(1) DEFAULT 0,
-                message_information LONGTEXT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                INDEX idx_organization_id (organization_id),
-                INDEX idx_room_id (room_id),
-                INDEX idx_user_id (user_id)
-            )
-        """)
+async def acquire_connection(pool):
+    start = time.perf_counter()
+    try:
+        conn = await asyncio.wait_for(pool.acquire(), DB_POOL_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        pool_stats["timeouts"] += 1
+        print(f"Timed out after {DB_POOL_ACQUIRE_TIMEOUT}s waiting for a database connection")
+        raise
+    waited = time.perf_counter() - start
+    pool_stats["acquires"] += 1
+    pool_stats["wait_total"] += waited
+    if waited > pool_stats["wait_max"]:
+        pool_stats["wait_max"] = waited
+    return conn
+
+class UnitOfWork:
+    """
+    Guard against nested acquires within an event. A db_connection or transaction block
+    opened while another block of the same event holds a connection joins that
+    connection, so helpers that call other helpers never hold two at once. Once the
+    outermost block exits the connection goes back to the pool: consecutive queries of
+    an event may run on different connections, and the event does not keep one while it
+    waits on sockets, push sends or the message writer. A transaction() block holds its
+    connection from BEGIN to COMMIT. Queries of one unit of work must not run concurrently.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+        # db_connection blocks using conn
+        self.users = 0
+        self.in_transaction = False
+
+    async def connection(self):
+        if self.conn is None:
+            self.conn = await acquire_connection(self.pool)
+        return self.conn
+
+    @asynccontextmanager
+    async def use(self):
+        self.users += 1
+        try:
+            yield await self.connection()
+        finally:
+            self.users -= 1
+            if self.users == 0:
+                self.release()
+
+    def release(self):
+        if self.conn is not None:
+            self.pool.release(self.conn)
+            self.conn = None
+
+current_unit_of_work = contextvars.ContextVar("current_unit_of_work", default=None)
+
+@asynccontextmanager
+async def unit_of_work(pool):
+    if pool is None or current_unit_of_work.get() is not None:
+        yield current_unit_of_work.get()
+        return
+    uow = UnitOfWork(pool)
+    token = current_unit_of_work.set(uow)
+    try:
+        yield uow
+    finally:
+        current_unit_of_work.reset(token)
+        uow.release()
 
-        await cursor.execute("""
-            CREATE TABLE IF NOT EXISTS rooms (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                name VARCHAR(255) DEFAULT NULL,
-                room_type VARCHAR(16) NOT NULL DEFAULT 'group',
-                status INT DEFAULT 0,
-                image VARCHAR(255) DEFAULT NULL,
-                description TEXT DEFAULT NULL,
-                organization_id bigint(20) DEFAULT 0,
-                last_message_at TIMESTAMP NULL DEFAULT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                INDEX idx_organization_id (organization_id),
-                INDEX idx_status (status)
-            )
-        """)
+@asynccontextmanager
+async def db_connection(pool):
+    """
+    Yields the connection of the current unit of work, or a connection of its own
+    when called outside of one (startup, background tasks).
+    """
+    uow = current_unit_of_work.get()
+    if uow is not None and uow.pool is pool:
+        async with uow.use() as conn:
+            yield conn
+        return
+    conn = await acquire_connection(pool)
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
 
-        await cursor.execute("""
-            CREATE TABLE IF NOT EXISTS room_participants (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                room_id INT NOT NULL,
-                user_id bigint(20) unsigned NOT NULL,
-                last_message_seen INT, 
-                organization_id INT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                INDEX idx_user_id (user_id),
-                INDEX idx_organization_id (organization_id),
-                INDEX idx_room_id (room_id)
-            )
-        """)
+@asynccontextmanager
+async def transaction(pool):
+    """
+    Runs the block in an explicit transaction, committed when the block succeeds and
+    rolled back otherwise. Nested transactions join the outer one.
+    """
+    uow = current_unit_of_work.get()
+    if uow is not None and uow.pool is pool and uow.in_transaction:
+        async with uow.use() as conn:
+            yield conn
+        return
+    async with db_connection(pool) as conn:
+        if uow is not None and uow.pool is pool:
+            uow.in_transaction = True
+        try:
+            await conn.begin()
+            try:
+                yield conn
+            except BaseException:
+                await conn.rollback()
+                raise
+            await conn.commit()
+        finally:
+            if uow is not None and uow.pool is pool:
+                uow.in_transaction = False
 
-        await cursor.execute("""
-            CREATE TABLE IF NOT EXISTS clients (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                username VARCHAR(512) DEFAULT "",
-                token VARCHAR(512) NOT NULL,
-                organization_id INT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                INDEX idx_token (token),
-                INDEX idx_organization_id (organization_id)
-            )
-        """)
+def _in_placeholders(values):
+    return ','.join(['%s'] * len(values))
 
-        await cursor.execute("""
-            SHOW COLUMNS FROM room_participants LIKE 'deleted_at'
-            """)
-        result = await cursor.fetchone()
-        if result:
-            print(f"✅ Column deleted_at already exists in room_participants.")
+class MySQLStorage:
+    """
+    The rows behind the data helpers, in MySQL through the aiomysql pool. MemoryStorage
+    and SQLiteStorage have the same methods. Rows are dicts named after the columns of
+    the MySQL tables, timestamps are naive local datetimes. Queries run on the
+    connection of the current unit of work.
+
+    add_messages runs on writer_pool, a pool of its own for the MessageWriter when one
+    is given, so group commits never queue behind the events for a connection.
+
+    add_messages takes the ids of a multi-row INSERT as consecutive from LAST_INSERT_ID(),
+    stepping by auto_increment_increment. InnoDB only guarantees that for simple inserts
+    with innodb_autoinc_lock_mode 0 or 1. With 2, the default of MySQL 8, concurrent
+    inserts interleave their ids, the first batch finds that out and switches to inserting
+    row by row (still one commit per batch). MESSAGE_WRITER_MULTI_ROW = False does the
+    same from the start.
+    """
+    name = "mysql"
+
+    def __init__(self, pool, multi_row=True, writer_pool=None):
+        self.pool = pool
+        self.writer_pool = writer_pool or pool
+        self.multi_row = multi_row
+        self.id_step = None
+
+    async def migrate(self):
+        await init_db(self.pool)
+
+    async def close(self):
+        for pool in {self.pool, self.writer_pool}:
+            pool.close()
+            await pool.wait_closed()
+
+    async def fetchall(self, sql, params=()):
+        async with db_connection(self.pool) as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute(sql, params)
+                return list(await cursor.fetchall())
+
+    async def fetchone(self, sql, params=()):
+        async with db_connection(self.pool) as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute(sql, params)
+                return await cursor.fetchone()
+
+    async def execute(self, sql, params=()):
+        # :return: the number of rows changed
+        async with db_connection(self.pool) as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(sql, params)
+                return cursor.rowcount
+
+    async def get_user(self, username, token):
+        return await self.fetchone("SELECT * FROM clients WHERE username = %s AND token = %s", (username, token,))
+
+    async def get_user_id(self, username, organization_id):
+        row = await self.fetchone("SELECT id FROM clients WHERE username = %s AND organization_id = %s LIMIT 1", (username, int(organization_id)))
+        return row['id'] if row else None
+
+    async def add_user(self, username, token, organization_id):
+        async with db_connection(self.pool) as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("INSERT INTO clients (username, token, organization_id) VALUES (%s, %s, %s)", (username, token, int(organization_id)))
+                return cursor.lastrowid
+
+    async def get_usernames(self, user_ids):
+        rows = await self.fetchall(f"SELECT id, username FROM clients WHERE id IN ({_in_placeholders(user_ids)})", list(user_ids))
+        return {row['id']: row['username'] for row in rows}
+
+    async def get_organization_users(self, organization_id, user_ids):
+        # :return: the ids out of user_ids that belong to the organization
+        rows = await self.fetchall(f"SELECT id FROM clients WHERE organization_id = %s AND id IN ({_in_placeholders(user_ids)})", [int(organization_id)] + list(user_ids))
+        return {row['id'] for row in rows}
+
+    async def get_device_tokens(self, organization_id, user_ids):
+        # :return: dict of user_id -> device_token column (a JSON list or None)
+        rows = await self.fetchall(f"""
+            SELECT id, device_token
+            FROM clients
+            WHERE organization_id = %s
+              AND id IN ({_in_placeholders(user_ids)})
+        """, (int(organization_id), *user_ids))
+        return {row['id']: row['device_token'] for row in rows}
+
+    async def set_device_token(self, user_id, organization_id, device_token):
+        await self.execute(
+            "UPDATE clients SET device_token = %s WHERE id = %s AND organization_id = %s",
+            (device_token, user_id, int(organization_id)),
+        )
+
+    async def get_last_notifications(self, organization_id, user_ids):
+        # :return: dict of user_id -> created_at of their latest notification, for the users that had one
+        rows = await self.fetchall(f"""
+            SELECT user_id, MAX(created_at) AS created_at
+            FROM client_notifications
+            WHERE organization_id = %s
+              AND user_id IN ({_in_placeholders(user_ids)})
+            GROUP BY user_id
+        """, (int(organization_id), *user_ids))
+        return {row['user_id']: row['created_at'] for row in rows}
+
+    async def add_notifications(self, user_ids, organization_id, message, msg_type):
+        values = ','.join(['(%s, %s, %s, %s)'] * len(user_ids))
+        params = []
+        for user_id in user_ids:
+            params.extend((user_id, int(organization_id), message, msg_type))
+        await self.execute(f"INSERT INTO client_notifications (user_id, organization_id, message, msg_type) VALUES {values}", params)
+
+    async def get_silent_members(self, room_id, organization_id, user_ids):
+        # :return: dict of user_id -> silent_notifications for the active members out of user_ids
+        rows = await self.fetchall(f"""
+            SELECT user_id, silent_notifications
+            FROM room_participants
+            WHERE room_id = %s
+              AND organization_id = %s
+              AND deleted_at IS NULL
+              AND user_id IN ({_in_placeholders(user_ids)})
+            ORDER BY id
+        """, (room_id, int(organization_id), *user_ids))
+        return {row['user_id']: row['silent_notifications'] for row in rows}
+
+    async def get_user_rooms(self, user_id):
+        return await self.fetchall("""
+            SELECT r.id, r.name, r.description, r.room_type, r.last_message_at, ru.last_message_seen, r.owner_id, ru.silent_notifications
+            FROM rooms r 
+            JOIN room_participants ru ON ru.room_id = r.id
+            WHERE ru.user_id = %s
+            AND ru.deleted_at IS NULL
+            ORDER BY r.last_message_at DESC, r.id DESC
+        """, (user_id,))
+
+    async def count_unread(self, user_id, last_seen):
+        """
+        :param last_seen: dict of room_id -> id of the last message the user has seen.
+        :return: dict of room_id -> (number of newer messages of other users, id of the newest
+            of them), rooms without any are left out.
+        """
+        # one grouped query for every room
+        ranges = " OR ".join(["(m.room_id = %s AND m.id > %s)"] * len(last_seen))
+        params = [user_id]
+        for room_id, msg_id in last_seen.items():
+            params.extend((room_id, msg_id or 0))
+        rows = await self.fetchall(f"""
+            SELECT m.room_id, COUNT(m.id) AS unread, MAX(m.id) AS last_id
+            FROM room_messages m
+            WHERE m.is_deleted = 0
+              AND m.user_id <> %s
+              AND ({ranges})
+            GROUP BY m.room_id
+        """, params)
+        return {row['room_id']: (row['unread'], row['last_id']) for row in rows}
+
+    async def add_messages(self, rows):
+        """
+        Inserts (room_id, user_id, organization_id, message, msginfo) rows and moves the
+        last_message_at of their rooms, in one transaction.
+        :return: the ids of the rows, in order.
+        """
+        async with transaction(self.writer_pool) as conn:
+            async with conn.cursor() as cursor:
+                if self.multi_row and self.id_step is None:
+                    await cursor.execute("SELECT @@auto_increment_increment, @@innodb_autoinc_lock_mode")
+                    step, lock_mode = await cursor.fetchone()
+                    self.id_step = step or 1
+                    if lock_mode == 2:
+                        print("innodb_autoinc_lock_mode is 2, the message writer inserts messages row by row")
+                        self.multi_row = False
+                if self.multi_row:
+                    values = ",".join(["(%s, %s, %s, %s, %s)"] * len(rows))
+                    await cursor.execute(
+                        f"INSERT INTO room_messages (room_id, user_id, organization_id, message, message_information) VALUES {values}",
+                        [value for row in rows for value in row],
+                    )
+                    first_id = cursor.lastrowid
+                    ids = [first_id + i * self.id_step for i in range(len(rows))]
+                else:
+                    ids = []
+                    for row in rows:
+                        await cursor.execute("INSERT INTO room_messages (room_id, user_id, organization_id, message, message_information) VALUES( %s, %s, %s, %s, %s)", row)
+                        ids.append(cursor.lastrowid)
+
+                room_ids = list(dict.fromkeys(row[0] for row in rows))
+                await cursor.execute(f"UPDATE rooms SET last_message_at = NOW() WHERE id IN ({_in_placeholders(room_ids)})", room_ids)
+        return ids
+
+    async def edit_message(self, user_id, msg_id, message, msginfo, room_id, organization_id):
+        return await self.execute("UPDATE room_messages SET message = %s, message_information = %s WHERE id=%s AND user_id=%s AND room_id=%s AND organization_id=%s", ( message, msginfo, msg_id, user_id, room_id, organization_id))
+
+    async def delete_message(self, user_id, room_id, msg_id, organization_id):
+        return await self.execute("""
+            UPDATE room_messages m
+              SET is_deleted = 1
+            WHERE room_id = %s
+              AND organization_id = %s
+              AND user_id = %s
+              AND id = %s
+        """, (room_id, organization_id, user_id, msg_id))
+
+    async def get_messages(self, room_id, organization_id, anchor_id, direction, limit):
+        """
+        One page of room history, walking the (room_id, organization_id, is_deleted, id) index.
+        :param anchor_id: Exclusive bound, None starts at the newest (backward) or oldest (forward) message.
+        :param direction: "backward" for older messages, newest first, "forward" for newer ones, oldest first.
+        """
+        if direction == "forward":
+            condition, order = "AND m.id > %s", "ASC"
+            anchor_id = anchor_id or 0
+        elif anchor_id is None:
+            condition, order = "", "DESC"
         else:
-            print(f"⚙️ Adding column deleted_at to room_participants...")
-            await cursor.execute(f"""
-                ALTER TABLE room_participants
-                ADD COLUMN deleted_at TIMESTAMP NULL DEFAULT NULL
-                """)
-            
-        await cursor.execute("""
-            SHOW COLUMNS FROM room_participants LIKE 'silent_notifications'
-            """)
-        result = await cursor.fetchone()
-        if result:
-            print(f"✅ Column silent_notifications already exists in room_participants.")
+            condition, order = "AND m.id < %s", "DESC"
+        params = (room_id, organization_id) + ((anchor_id,) if condition else ()) + (int(limit),)
+        return await self.fetchall(f"""
+            SELECT m.id, m.user_id, m.room_id, m.message, m.message_information, m.created_at, m.updated_at
+            FROM room_messages m
+            WHERE m.room_id = %s
+              AND m.organization_id = %s
+              AND m.is_deleted = 0
+              {condition}
+            ORDER BY m.id {order}
+            LIMIT %s
+        """, params)
+
+    async def set_last_seen(self, rows):
+        # rows of (user_id, room_id, msg_id), written with one UPDATE
+        seen = " UNION ALL ".join(["SELECT %s AS user_id, %s AS room_id, %s AS msg_id"] * len(rows))
+        await self.execute(f"""
+            UPDATE room_participants rp
+            JOIN ({seen}) seen ON rp.user_id = seen.user_id AND rp.room_id = seen.room_id
+            SET rp.last_message_seen = seen.msg_id
+        """, [value for row in rows for value in row])
+
+    async def clear_last_seen(self, user_id, room_id):
+        await self.execute("""
+            UPDATE room_participants 
+            SET last_message_seen = 0
+            WHERE room_id = %s AND user_id = %s
+            AND deleted_at IS NULL
+        """, (room_id, user_id))
+
+    async def get_room_members(self, room_id):
+        # :return: (list of active member ids, organization_id or None when there are none)
+        rows = await self.fetchall("""
+            SELECT user_id, organization_id
+            FROM room_participants 
+            WHERE room_id = %s
+            AND deleted_at IS NULL
+        """, (room_id,))
+        return [row['user_id'] for row in rows], rows[0]['organization_id'] if rows else None
+
+    async def get_room_owners(self, room_id):
+        rows = await self.fetchall("""
+            SELECT owner_id
+            FROM rooms
+            WHERE id = %s
+        """, (room_id,))
+        return [row['owner_id'] for row in rows]
+
+    async def is_room_owner(self, user_id, room_id, organization_id):
+        row = await self.fetchone("""
+            SELECT id
+            FROM rooms
+            WHERE id = %s 
+            AND owner_id = %s 
+            AND organization_id = %s
+        """, (room_id, user_id, organization_id))
+        return row is not None
+
+    async def leave_room(self, room_id, user_id):
+        changed = await self.execute("""
+            UPDATE room_participants 
+            SET deleted_at = NOW() 
+            WHERE room_id = %s
+            AND user_id = %s
+        """, (room_id, user_id,))
+        return changed > 0
+
+    async def set_room_silent(self, room_id, user_id, silent):
+        changed = await self.execute("""
+            UPDATE room_participants
+            SET silent_notifications = %s
+            WHERE room_id = %s
+            AND user_id = %s
+        """, (1 if silent else 0, room_id, user_id,))
+        return changed > 0
+
+    async def find_direct_room(self, organization_id, user_a_id, user_b_id):
+        row = await self.fetchone("""
+            SELECT r.id
+            FROM rooms r
+            JOIN room_participants rp ON rp.room_id = r.id
+            WHERE r.organization_id = %s
+              AND r.room_type = 'direct'
+            GROUP BY r.id
+            HAVING COUNT(DISTINCT rp.user_id) = 2
+               AND SUM(CASE WHEN rp.user_id = %s THEN 1 ELSE 0 END) > 0
+               AND SUM(CASE WHEN rp.user_id = %s THEN 1 ELSE 0 END) > 0
+            ORDER BY r.id DESC
+            LIMIT 1
+        """, (int(organization_id), int(user_a_id), int(user_b_id)))
+        return row["id"] if row else None
+
+    async def save_room(self, user_id, room_name, participant_ids, description, organization_id, room_type):
+        """
+        Creates the room, or updates the one of the same name when user_id owns it, with
+        participant_ids as its members. A direct room between the same two users is reused.
+        :return: the room id, None when the name is taken by a room of another owner.
+        """
+        async with transaction(self.pool) as conn:
+            async with conn.cursor() as cursor:
+                return await self._save_room(cursor, user_id, room_name, participant_ids, description, organization_id, room_type)
+
+    async def _save_room(self, cursor, user_id, room_name, participant_ids, description, organization_id, room_type):
+        if room_type == "direct" and len(participant_ids) == 2:
+            direct_room_id = await self.find_direct_room(organization_id, participant_ids[0], participant_ids[1])
+            if direct_room_id:
+                for uid in participant_ids:
+                    await self._ensure_participant(cursor, direct_room_id, uid, organization_id)
+                return direct_room_id
+
+        await cursor.execute("SELECT id FROM rooms WHERE name = %s AND organization_id = %s", (room_name, organization_id))
+        existing_room = await cursor.fetchone()
+        if existing_room:
+            room_id = existing_room[0]
+            if await self.is_room_owner(user_id, room_id, organization_id) == False:
+                return None
+            await cursor.execute(
+                "UPDATE rooms SET description = %s, name = %s, room_type = %s WHERE id = %s",
+                (description, room_name, room_type, room_id),
+            )
+            await cursor.execute("DELETE FROM room_participants WHERE room_id = %s", (room_id,))
         else:
-            print(f"⚙️ Adding column silent_notifications to room_participants...")
-            await cursor.execute(f"""
-                ALTER TABLE room_participants
-                ADD COLUMN silent_notifications INT NOT NULL DEFAULT 0
-                """)
+            if organization_id:
+                await cursor.execute(
+                    "INSERT INTO rooms (name, organization_id, description, owner_id, room_type) VALUES (%s, %s, %s, %s, %s)",
+                    (room_name, int(organization_id), description, user_id, room_type),
+                )
+            else:
+                await cursor.execute(
+                    "INSERT INTO rooms (name, description, owner_id, room_type) VALUES (%s, %s, %s, %s)",
+                    (room_name, description, user_id, room_type),
+                )
+            room_id = cursor.lastrowid
 
-        await cursor.execute("""
-            SHOW COLUMNS FROM clients LIKE 'device_token'
-            """)
-        result = await cursor.fetchone()
-        if result:
-            print(f"✅ Column device_token already exists in clients.")
-        else:
-            print(f"⚙️ Adding column device_token to clients...")
-            await cursor.execute(f"""
-                ALTER TABLE clients
-                ADD COLUMN device_token TEXT DEFAULT NULL
-                """)
-            
-        await cursor.execute("""
-            SHOW COLUMNS FROM rooms LIKE 'owner_id'
-            """)
-        result = await cursor.fetchone()
-        if result:
-            print(f"✅ Column owner_id already exists in rooms.")
-        else:
-            print(f"⚙️ Adding column owner_id to rooms...")
-            await cursor.execute(f"""
-                ALTER TABLE rooms
-                ADD COLUMN owner_id bigint(20) DEFAULT 0
-                """)
+        for uid in participant_ids:
+            await cursor.execute(
+                "INSERT INTO room_participants (room_id, user_id, last_message_seen, organization_id) VALUES (%s, %s, %s, %s)",
+                (room_id, uid, 0, int(organization_id)),
+            )
+        return room_id
 
+    async def _ensure_participant(self, cursor, room_id, participant_id, organization_id):
         await cursor.execute("""
-            SHOW COLUMNS FROM rooms LIKE 'last_message_at'
-            """)
-        result = await cursor.fetchone()
-        if result:
-            print(f"✅ Column last_message_at already exists in rooms.")
-        else:
-            print(f"⚙️ Adding column last_message_at to rooms...")
-            await cursor.execute(f"""
-                ALTER TABLE rooms
-                ADD COLUMN last_message_at TIMESTAMP NULL DEFAULT NULL
-                """)
+            SELECT id
+            FROM room_participants
+            WHERE room_id = %s
+              AND user_id = %s
+              AND organization_id = %s
+              AND deleted_at IS NULL
+            ORDER BY id DESC
+            LIMIT 1
+        """, (room_id, participant_id, int(organization_id)))
+        existing_active = await cursor.fetchone()
+        if existing_active:
+            return
 
         await cursor.execute("""
-            SHOW COLUMNS FROM rooms LIKE 'room_type'
-            """)
-        result = await cursor.fetchone()
-        if result:
-            print(f"✅ Column room_type already exists in rooms.")
-        else:
-            print(f"⚙️ Adding column room_type to rooms...")
-            await cursor.execute(f"""
-                ALTER TABLE rooms
-                ADD COLUMN room_type VARCHAR(16) NOT NULL DEFAULT 'group'
-                """)
+            SELECT id
+            FROM room_participants
+            WHERE room_id = %s
+              AND user_id = %s
+              AND organization_id = %s
+            ORDER BY id DESC
+            LIMIT 1
+        """, (room_id, participant_id, int(organization_id)))
+        existing_any = await cursor.fetchone()
+        if existing_any:
+            await cursor.execute("""
+                UPDATE room_participants
+                SET deleted_at = NULL
+                WHERE id = %s
+            """, (existing_any[0],))
+            return
 
         await cursor.execute("""
-            SHOW COLUMNS FROM clients LIKE 'active'
-            """)
-        result = await cursor.fetchone()
-        if result:
-            print(f"✅ Column active already exists in clients.")
+            INSERT INTO room_participants (room_id, user_id, last_message_seen, organization_id)
+            VALUES (%s, %s, %s, %s)
+        """, (room_id, participant_id, 0, int(organization_id)))
+
+class MemoryStorage:
+    """
+    The rows of MySQLStorage in dicts of this process, lost when it exits. For tests,
+    benchmarks that leave the database out and single worker deployments. Of the
+    notifications only the time of the latest one per user is kept.
+    """
+    name = "memory"
+    pool = None
+
+    def __init__(self):
+        self.clients = {}  # id -> row
+        self.usernames = {}  # username -> ids of the clients rows
+        self.rooms = {}  # id -> row
+        self.participants = {}  # room id -> participant rows, by id
+        self.user_participants = {}  # user id -> participant rows, by id
+        self.messages = {}  # room id -> message rows, by id
+        self.notified = {}  # (organization_id, user_id) -> created_at of the latest notification
+        self.last_ids = {}  # table -> last id handed out
+
+    @staticmethod
+    def now():
+        return datetime.now().replace(microsecond=0)
+
+    def next_id(self, table):
+        self.last_ids[table] = self.last_ids.get(table, 0) + 1
+        return self.last_ids[table]
+
+    async def migrate(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def get_user(self, username, token):
+        for user_id in self.usernames.get(username, ()):
+            row = self.clients[user_id]
+            if row['token'] == token:
+                return dict(row)
+        return None
+
+    async def get_user_id(self, username, organization_id):
+        for user_id in self.usernames.get(username, ()):
+            if self.clients[user_id]['organization_id'] == int(organization_id):
+                return user_id
+        return None
+
+    async def add_user(self, username, token, organization_id):
+        user_id = self.next_id("clients")
+        now = self.now()
+        self.clients[user_id] = {
+            "id": user_id, "username": username, "token": token, "organization_id": int(organization_id),
+            "device_token": None, "active": 30, "created_at": now, "updated_at": now,
+        }
+        self.usernames.setdefault(username, []).append(user_id)
+        return user_id
+
+    async def get_usernames(self, user_ids):
+        rows = (self.clients.get(id_key(user_id)) for user_id in user_ids)
+        return {row['id']: row['username'] for row in rows if row is not None}
+
+    async def get_organization_users(self, organization_id, user_ids):
+        rows = (self.clients.get(id_key(user_id)) for user_id in user_ids)
+        return {row['id'] for row in rows if row is not None and row['organization_id'] == int(organization_id)}
+
+    async def get_device_tokens(self, organization_id, user_ids):
+        rows = (self.clients.get(id_key(user_id)) for user_id in user_ids)
+        return {row['id']: row['device_token'] for row in rows if row is not None and row['organization_id'] == int(organization_id)}
+
+    async def set_device_token(self, user_id, organization_id, device_token):
+        row = self.clients.get(id_key(user_id))
+        if row is not None and row['organization_id'] == int(organization_id):
+            row['device_token'] = device_token
+
+    async def get_last_notifications(self, organization_id, user_ids):
+        last_sent = {}
+        for user_id in user_ids:
+            created_at = self.notified.get((int(organization_id), user_id))
+            if created_at is not None:
+                last_sent[user_id] = created_at
+        return last_sent
+
+    async def add_notifications(self, user_ids, organization_id, message, msg_type):
+        now = self.now()
+        for user_id in user_ids:
+            self.notified[(int(organization_id), user_id)] = now
+
+    def active_participants(self, room_id):
+        return [row for row in self.participants.get(id_key(room_id), ()) if row['deleted_at'] is None]
+
+    async def get_silent_members(self, room_id, organization_id, user_ids):
+        wanted = set(user_ids)
+        return {
+            row['user_id']: row['silent_notifications']
+            for row in self.active_participants(room_id)
+            if row['organization_id'] == int(organization_id) and row['user_id'] in wanted
+        }
+
+    async def get_user_rooms(self, user_id):
+        rooms = []
+        for participant in self.user_participants.get(user_id, ()):
+            room = self.rooms.get(participant['room_id'])
+            if room is None or participant['deleted_at'] is not None:
+                continue
+            rooms.append({
+                "id": room['id'], "name": room['name'], "description": room['description'],
+                "room_type": room['room_type'], "last_message_at": room['last_message_at'],
+                "last_message_seen": participant['last_message_seen'], "owner_id": room['owner_id'],
+                "silent_notifications": participant['silent_notifications'],
+            })
+        # like ORDER BY last_message_at DESC, id DESC in MySQL: rooms without messages last
+        rooms.sort(key=lambda room: (room['last_message_at'] is not None, room['last_message_at'] or datetime.min, room['id']), reverse=True)
+        return rooms
+
+    async def count_unread(self, user_id, last_seen):
+        counts = {}
+        for room_id, msg_id in last_seen.items():
+            msgs = self.messages.get(id_key(room_id), [])
+            start = bisect.bisect_right(msgs, int(msg_id or 0), key=lambda msg: msg['id'])
+            unread = [msg['id'] for msg in msgs[start:] if not msg['is_deleted'] and msg['user_id'] != user_id]
+            if unread:
+                counts[room_id] = (len(unread), unread[-1])
+        return counts
+
+    async def add_messages(self, rows):
+        now = self.now()
+        ids = []
+        for room_id, user_id, organization_id, message, msginfo in rows:
+            msg_id = self.next_id("room_messages")
+            room_id = id_key(room_id)
+            self.messages.setdefault(room_id, []).append({
+                "id": msg_id, "organization_id": int(organization_id), "room_id": room_id, "user_id": user_id,
+                "message": message, "is_deleted": 0, "message_information": msginfo,
+                "created_at": now, "updated_at": now,
+            })
+            room = self.rooms.get(room_id)
+            if room is not None:
+                room['last_message_at'] = now
+            ids.append(msg_id)
+        return ids
+
+    def find_message(self, user_id, room_id, msg_id, organization_id):
+        msgs = self.messages.get(id_key(room_id), [])
+        msg_id = id_key(msg_id)
+        index = bisect.bisect_left(msgs, msg_id, key=lambda msg: msg['id']) if isinstance(msg_id, int) else len(msgs)
+        if index < len(msgs):
+            msg = msgs[index]
+            if msg['id'] == msg_id and msg['user_id'] == user_id and msg['organization_id'] == int(organization_id):
+                return msg
+        return None
+
+    async def edit_message(self, user_id, msg_id, message, msginfo, room_id, organization_id):
+        # like MySQL, only rows that change count
+        msg = self.find_message(user_id, room_id, msg_id, organization_id)
+        if msg is None or (msg['message'], msg['message_information']) == (message, msginfo):
+            return 0
+        msg['message'] = message
+        msg['message_information'] = msginfo
+        return 1
+
+    async def delete_message(self, user_id, room_id, msg_id, organization_id):
+        msg = self.find_message(user_id, room_id, msg_id, organization_id)
+        if msg is None or msg['is_deleted']:
+            return 0
+        msg['is_deleted'] = 1
+        return 1
+
+    async def get_messages(self, room_id, organization_id, anchor_id, direction, limit):
+        msgs = self.messages.get(id_key(room_id), [])
+        if direction == "forward":
+            start = bisect.bisect_right(msgs, int(anchor_id or 0), key=lambda msg: msg['id'])
+            candidates = msgs[start:]
         else:
-            print(f"⚙️ Adding column active to clients...")
-            await cursor.execute(f"""
-                ALTER TABLE clients
-                ADD COLUMN active INT DEFAULT 30
-                """)
+            end = len(msgs) if anchor_id is None else bisect.bisect_left(msgs, int(anchor_id), key=lambda msg: msg['id'])
+            candidates = reversed(msgs[:end])
+        page = []
+        for msg in candidates:
+            if len(page) >= limit:
+                break
+            if not msg['is_deleted'] and msg['organization_id'] == int(organization_id):
+                page.append({
+                    "id": msg['id'], "user_id": msg['user_id'], "room_id": msg['room_id'], "message": msg['message'],
+                    "message_information": msg['message_information'], "created_at": msg['created_at'], "updated_at": msg['updated_at'],
+                })
+        return page
+
+    async def set_last_seen(self, rows):
+        for user_id, room_id, msg_id in rows:
+            for participant in self.participants.get(id_key(room_id), ()):
+                if participant['user_id'] == user_id:
+                    participant['last_message_seen'] = msg_id
+
+    async def clear_last_seen(self, user_id, room_id):
+        for participant in self.active_participants(room_id):
+            if participant['user_id'] == user_id:
+                participant['last_message_seen'] = 0
+
+    async def get_room_members(self, room_id):
+        rows = self.active_participants(room_id)
+        return [row['user_id'] for row in rows], rows[0]['organization_id'] if rows else None
+
+    async def get_room_owners(self, room_id):
+        room = self.rooms.get(id_key(room_id))
+        return [room['owner_id']] if room is not None else []
+
+    async def is_room_owner(self, user_id, room_id, organization_id):
+        room = self.rooms.get(id_key(room_id))
+        return room is not None and room['owner_id'] == user_id and room['organization_id'] == int(organization_id)
+
+    async def leave_room(self, room_id, user_id):
+        now = self.now()
+        changed = 0
+        for participant in self.participants.get(id_key(room_id), ()):
+            if participant['user_id'] == user_id and participant['deleted_at'] != now:
+                participant['deleted_at'] = now
+                changed += 1
+        return changed > 0
+
+    async def set_room_silent(self, room_id, user_id, silent):
+        value = 1 if silent else 0
+        changed = 0
+        for participant in self.participants.get(id_key(room_id), ()):
+            if participant['user_id'] == user_id and participant['silent_notifications'] != value:
+                participant['silent_notifications'] = value
+                changed += 1
+        return changed > 0
+
+    async def find_direct_room(self, organization_id, user_a_id, user_b_id):
+        for room_id in sorted(self.rooms, reverse=True):
+            room = self.rooms[room_id]
+            if room['organization_id'] != int(organization_id) or room['room_type'] != 'direct':
+                continue
+            # deleted participants count too, like in the MySQL query
+            members = {row['user_id'] for row in self.participants.get(room_id, ())}
+            if len(members) == 2 and int(user_a_id) in members and int(user_b_id) in members:
+                return room_id
+        return None
+
+    async def save_room(self, user_id, room_name, participant_ids, description, organization_id, room_type):
+        if room_type == "direct" and len(participant_ids) == 2:
+            direct_room_id = await self.find_direct_room(organization_id, participant_ids[0], participant_ids[1])
+            if direct_room_id:
+                for uid in participant_ids:
+                    self.ensure_participant(direct_room_id, uid, organization_id)
+                return direct_room_id
+
+        organization_id = int(organization_id or 0)
+        room = next((room for room in self.rooms.values() if room['name'] == room_name and room['organization_id'] == organization_id), None)
+        if room is not None:
+            if not await self.is_room_owner(user_id, room['id'], organization_id):
+                return None
+            room.update(description=description, name=room_name, room_type=room_type)
+            for participant in self.participants.pop(room['id'], ()):
+                self.user_participants[participant['user_id']].remove(participant)
+        else:
+            now = self.now()
+            room = {
+                "id": self.next_id("rooms"), "name": room_name, "room_type": room_type, "status": 0, "image": None,
+                "description": description, "organization_id": organization_id, "owner_id": user_id,
+                "last_message_at": None, "created_at": now, "updated_at": now,
+            }
+            self.rooms[room['id']] = room
+
+        for uid in participant_ids:
+            self.add_participant(room['id'], uid, organization_id)
+        return room['id']
+
+    def add_participant(self, room_id, user_id, organization_id):
+        now = self.now()
+        participant = {
+            "id": self.next_id("room_participants"), "room_id": room_id, "user_id": user_id, "last_message_seen": 0,
+            "organization_id": int(organization_id), "deleted_at": None, "silent_notifications": 0,
+            "created_at": now, "updated_at": now,
+        }
+        self.participants.setdefault(room_id, []).append(participant)
+        self.user_participants.setdefault(user_id, []).append(participant)
+
+    def ensure_participant(self, room_id, user_id, organization_id):
+        rows = [row for row in self.participants.get(room_id, ()) if row['user_id'] == user_id and row['organization_id'] == int(organization_id)]
+        if any(row['deleted_at'] is None for row in rows):
+            return
+        if rows:
+            rows[-1]['deleted_at'] = None
+            return
+        self.add_participant(room_id, user_id, organization_id)
+
+def _sqlite_timestamp(value):
+    return datetime.fromisoformat(value.decode())
+
+def _sqlite_placeholders(values):
+    return ','.join(['?'] * len(values))
+
+class SQLiteStorage:
+    """
+    The rows of MySQLStorage in a SQLite file, for deployments without a MySQL server.
+    Queries run on the event loop thread: the file is local and the queries are short,
+    a round trip to a thread would cost more than most of them. That only holds while
+    one process owns the file, so it cannot run WORKERS > 1: a write waiting for the
+    lock of another worker would stop every socket of its worker for the wait.
+    """
+    name = "sqlite"
+    pool = None
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS client_notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            organization_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            msg_type INTEGER,
+            message TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+            updated_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+        );
+        CREATE INDEX IF NOT EXISTS idx_client_notifications_user ON client_notifications (organization_id, user_id);
+        CREATE TABLE IF NOT EXISTS room_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            organization_id INTEGER NOT NULL,
+            room_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            is_deleted INTEGER DEFAULT 0,
+            message_information TEXT NULL,
+            created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+            updated_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+        );
+        CREATE INDEX IF NOT EXISTS idx_room_org_deleted_id ON room_messages (room_id, organization_id, is_deleted, id);
+        CREATE TABLE IF NOT EXISTS rooms (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT DEFAULT NULL,
+            room_type TEXT NOT NULL DEFAULT 'group',
+            status INTEGER DEFAULT 0,
+            image TEXT DEFAULT NULL,
+            description TEXT DEFAULT NULL,
+            organization_id INTEGER DEFAULT 0,
+            owner_id INTEGER DEFAULT 0,
+            last_message_at TIMESTAMP NULL DEFAULT NULL,
+            created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+            updated_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+        );
+        CREATE INDEX IF NOT EXISTS idx_rooms_name ON rooms (organization_id, name);
+        CREATE TABLE IF NOT EXISTS room_participants (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            last_message_seen INTEGER,
+            organization_id INTEGER NOT NULL,
+            deleted_at TIMESTAMP NULL DEFAULT NULL,
+            silent_notifications INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+            updated_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+        );
+        CREATE INDEX IF NOT EXISTS idx_room_participants_room ON room_participants (room_id);
+        CREATE INDEX IF NOT EXISTS idx_room_participants_user ON room_participants (user_id);
+        CREATE TABLE IF NOT EXISTS clients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT DEFAULT '',
+            token TEXT NOT NULL,
+            organization_id INTEGER NOT NULL,
+            device_token TEXT DEFAULT NULL,
+            active INTEGER DEFAULT 30,
+            created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+            updated_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+        );
+        CREATE INDEX IF NOT EXISTS idx_clients_username ON clients (username);
+        CREATE INDEX IF NOT EXISTS idx_clients_organization_id ON clients (organization_id);
+    """
 
-        if notify_user and notify_user_path:
-            await cursor.execute(
-                """
-                SELECT id
-                FROM clients
-                WHERE username = %s AND token = %s AND organization_id = 0
-                LIMIT 1
-                """,
-                (notify_user, notify_user_path),
+    def __init__(self, path):
+        self.path = path
+        sqlite3.register_converter("TIMESTAMP", _sqlite_timestamp)
+        # autocommit, transaction() opens the explicit ones
+        self.conn = sqlite3.connect(path, timeout=DB_POOL_ACQUIRE_TIMEOUT, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+
+    @contextmanager
+    def transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def fetchall(self, sql, params=()):
+        return [dict(row) for row in self.conn.execute(sql, params)]
+
+    def fetchone(self, sql, params=()):
+        row = self.conn.execute(sql, params).fetchone()
+        return dict(row) if row is not None else None
+
+    def execute(self, sql, params=()):
+        return self.conn.execute(sql, params).rowcount
+
+    async def migrate(self):
+        self.conn.executescript(self.SCHEMA)
+
+    async def close(self):
+        self.conn.close()
+
+    async def get_user(self, username, token):
+        return self.fetchone("SELECT * FROM clients WHERE username = ? AND token = ?", (username, token))
+
+    async def get_user_id(self, username, organization_id):
+        row = self.fetchone("SELECT id FROM clients WHERE username = ? AND organization_id = ? LIMIT 1", (username, int(organization_id)))
+        return row['id'] if row else None
+
+    async def add_user(self, username, token, organization_id):
+        return self.conn.execute("INSERT INTO clients (username, token, organization_id) VALUES (?, ?, ?)", (username, token, int(organization_id))).lastrowid
+
+    async def get_usernames(self, user_ids):
+        rows = self.fetchall(f"SELECT id, username FROM clients WHERE id IN ({_sqlite_placeholders(user_ids)})", list(user_ids))
+        return {row['id']: row['username'] for row in rows}
+
+    async def get_organization_users(self, organization_id, user_ids):
+        rows = self.fetchall(f"SELECT id FROM clients WHERE organization_id = ? AND id IN ({_sqlite_placeholders(user_ids)})", [int(organization_id)] + list(user_ids))
+        return {row['id'] for row in rows}
+
+    async def get_device_tokens(self, organization_id, user_ids):
+        rows = self.fetchall(f"SELECT id, device_token FROM clients WHERE organization_id = ? AND id IN ({_sqlite_placeholders(user_ids)})", [int(organization_id)] + list(user_ids))
+        return {row['id']: row['device_token'] for row in rows}
+
+    async def set_device_token(self, user_id, organization_id, device_token):
+        self.execute("UPDATE clients SET device_token = ? WHERE id = ? AND organization_id = ?", (device_token, user_id, int(organization_id)))
+
+    async def get_last_notifications(self, organization_id, user_ids):
+        # MAX() loses the declared type, the column is read through a subquery instead
+        rows = self.fetchall(f"""
+            SELECT n.user_id, n.created_at
+            FROM client_notifications n
+            WHERE n.id IN (
+                SELECT MAX(id) FROM client_notifications
+                WHERE organization_id = ? AND user_id IN ({_sqlite_placeholders(user_ids)})
+                GROUP BY user_id
+            )
+        """, [int(organization_id)] + list(user_ids))
+        return {row['user_id']: row['created_at'] for row in rows}
+
+    async def add_notifications(self, user_ids, organization_id, message, msg_type):
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO client_notifications (user_id, organization_id, message, msg_type) VALUES (?, ?, ?, ?)",
+                [(user_id, int(organization_id), message, msg_type) for user_id in user_ids],
             )
-            result = await cursor.fetchone()
-            if result:
-                print("✅ Notify user already exists in clients.")
-            else:
-                print("⚙️ Adding notify user to clients...")
-                await cursor.execute(
-                    """
-                    INSERT INTO clients (username, token, organization_id)
-                    VALUES (%s, %s, 0)
-                    """,
-                    (notify_user, notify_user_path),
-                )
-        else:
-            print("ℹ️ NOTIFY_USER or NOTIFY_USER_PATH missing in config; skipping notify user bootstrap.")
 
-        print("✅ Tables ensured.")
-    await conn.commit()
-    await conn.ensure_closed()
+    async def get_silent_members(self, room_id, organization_id, user_ids):
+        rows = self.fetchall(f"""
+            SELECT user_id, silent_notifications
+            FROM room_participants
+            WHERE room_id = ? AND organization_id = ? AND deleted_at IS NULL
+              AND user_id IN ({_sqlite_placeholders(user_ids)})
+            ORDER BY id
+        """, [room_id, int(organization_id)] + list(user_ids))
+        return {row['user_id']: row['silent_notifications'] for row in rows}
+
+    async def get_user_rooms(self, user_id):
+        return self.fetchall("""
+            SELECT r.id, r.name, r.description, r.room_type, r.last_message_at, ru.last_message_seen, r.owner_id, ru.silent_notifications
+            FROM rooms r
+            JOIN room_participants ru ON ru.room_id = r.id
+            WHERE ru.user_id = ?
+            AND ru.deleted_at IS NULL
+            ORDER BY r.last_message_at IS NULL, r.last_message_at DESC, r.id DESC
+        """, (user_id,))
+
+    async def count_unread(self, user_id, last_seen):
+        ranges = " OR ".join(["(m.room_id = ? AND m.id > ?)"] * len(last_seen))
+        params = [user_id]
+        for room_id, msg_id in last_seen.items():
+            params.extend((room_id, msg_id or 0))
+        rows = self.fetchall(f"""
+            SELECT m.room_id, COUNT(m.id) AS unread, MAX(m.id) AS last_id
+            FROM room_messages m
+            WHERE m.is_deleted = 0
+              AND m.user_id <> ?
+              AND ({ranges})
+            GROUP BY m.room_id
+        """, params)
+        return {row['room_id']: (row['unread'], row['last_id']) for row in rows}
+
+    async def add_messages(self, rows):
+        with self.transaction() as conn:
+            ids = [
+                conn.execute("INSERT INTO room_messages (room_id, user_id, organization_id, message, message_information) VALUES (?, ?, ?, ?, ?)", row).lastrowid
+                for row in rows
+            ]
+            room_ids = list(dict.fromkeys(row[0] for row in rows))
+            conn.execute(f"UPDATE rooms SET last_message_at = datetime('now', 'localtime') WHERE id IN ({_sqlite_placeholders(room_ids)})", room_ids)
+        return ids
+
+    async def edit_message(self, user_id, msg_id, message, msginfo, room_id, organization_id):
+        # like MySQL, only rows that change count
+        return self.execute("""
+            UPDATE room_messages SET message = ?, message_information = ?
+            WHERE id = ? AND user_id = ? AND room_id = ? AND organization_id = ?
+              AND (message IS NOT ? OR message_information IS NOT ?)
+        """, (message, msginfo, msg_id, user_id, room_id, organization_id, message, msginfo))
+
+    async def delete_message(self, user_id, room_id, msg_id, organization_id):
+        return self.execute("""
+            UPDATE room_messages SET is_deleted = 1
+            WHERE room_id = ? AND organization_id = ? AND user_id = ? AND id = ? AND is_deleted <> 1
+        """, (room_id, organization_id, user_id, msg_id))
+
+    async def get_messages(self, room_id, organization_id, anchor_id, direction, limit):
+        if direction == "forward":
+            condition, order = "AND id > ?", "ASC"
+            anchor_id = anchor_id or 0
+        elif anchor_id is None:
+            condition, order = "", "DESC"
+        else:
+            condition, order = "AND id < ?", "DESC"
+        params = (room_id, organization_id) + ((anchor_id,) if condition else ()) + (int(limit),)
+        return self.fetchall(f"""
+            SELECT id, user_id, room_id, message, message_information, created_at, updated_at
+            FROM room_messages
+            WHERE room_id = ? AND organization_id = ? AND is_deleted = 0 {condition}
+            ORDER BY id {order}
+            LIMIT ?
+        """, params)
+
+    async def set_last_seen(self, rows):
+        with self.transaction() as conn:
+            conn.executemany(
+                "UPDATE room_participants SET last_message_seen = ? WHERE user_id = ? AND room_id = ?",
+                [(msg_id, user_id, room_id) for user_id, room_id, msg_id in rows],
+            )
 
-async def create_pool():
-    pool = await aiomysql.create_pool(
-        host=DB_HOST,
-        port=DB_PORT,
-        user=DB_USER,
-        password=DB_PASS,
-        db=DB_NAME,
-        autocommit=True,     # Optional: automatically commit INSERT/UPDATE
-        minsize=1,           # Minimum number of connections in the pool
-        maxsize=10           # Maximum number of connections
-    )
-    return pool
+    async def clear_last_seen(self, user_id, room_id):
+        self.execute("UPDATE room_participants SET last_message_seen = 0 WHERE room_id = ? AND user_id = ? AND deleted_at IS NULL", (room_id, user_id))
+
+    async def get_room_members(self, room_id):
+        rows = self.fetchall("SELECT user_id, organization_id FROM room_participants WHERE room_id = ? AND deleted_at IS NULL", (room_id,))
+        return [row['user_id'] for row in rows], rows[0]['organization_id'] if rows else None
+
+    async def get_room_owners(self, room_id):
+        return [row['owner_id'] for row in self.fetchall("SELECT owner_id FROM rooms WHERE id = ?", (room_id,))]
+
+    async def is_room_owner(self, user_id, room_id, organization_id):
+        return self._is_room_owner(user_id, room_id, organization_id)
+
+    def _is_room_owner(self, user_id, room_id, organization_id):
+        return self.fetchone("SELECT id FROM rooms WHERE id = ? AND owner_id = ? AND organization_id = ?", (room_id, user_id, organization_id)) is not None
+
+    async def leave_room(self, room_id, user_id):
+        return self.execute("""
+            UPDATE room_participants SET deleted_at = datetime('now', 'localtime')
+            WHERE room_id = ? AND user_id = ? AND deleted_at IS NOT datetime('now', 'localtime')
+        """, (room_id, user_id)) > 0
+
+    async def set_room_silent(self, room_id, user_id, silent):
+        value = 1 if silent else 0
+        return self.execute("""
+            UPDATE room_participants SET silent_notifications = ?
+            WHERE room_id = ? AND user_id = ? AND silent_notifications <> ?
+        """, (value, room_id, user_id, value)) > 0
+
+    async def find_direct_room(self, organization_id, user_a_id, user_b_id):
+        return self._find_direct_room(organization_id, user_a_id, user_b_id)
+
+    def _find_direct_room(self, organization_id, user_a_id, user_b_id):
+        row = self.fetchone("""
+            SELECT r.id
+            FROM rooms r
+            JOIN room_participants rp ON rp.room_id = r.id
+            WHERE r.organization_id = ?
+              AND r.room_type = 'direct'
+            GROUP BY r.id
+            HAVING COUNT(DISTINCT rp.user_id) = 2
+               AND SUM(CASE WHEN rp.user_id = ? THEN 1 ELSE 0 END) > 0
+               AND SUM(CASE WHEN rp.user_id = ? THEN 1 ELSE 0 END) > 0
+            ORDER BY r.id DESC
+            LIMIT 1
+        """, (int(organization_id), int(user_a_id), int(user_b_id)))
+        return row["id"] if row else None
+
+    async def save_room(self, user_id, room_name, participant_ids, description, organization_id, room_type):
+        with self.transaction() as conn:
+            return self._save_room(conn, user_id, room_name, participant_ids, description, organization_id, room_type)
+
+    def _save_room(self, conn, user_id, room_name, participant_ids, description, organization_id, room_type):
+        if room_type == "direct" and len(participant_ids) == 2:
+            direct_room_id = self._find_direct_room(organization_id, participant_ids[0], participant_ids[1])
+            if direct_room_id:
+                for uid in participant_ids:
+                    self._ensure_participant(conn, direct_room_id, uid, organization_id)
+                return direct_room_id
+
+        existing_room = conn.execute("SELECT id FROM rooms WHERE name = ? AND organization_id = ?", (room_name, organization_id or 0)).fetchone()
+        if existing_room:
+            room_id = existing_room[0]
+            if not self._is_room_owner(user_id, room_id, organization_id or 0):
+                return None
+            conn.execute("UPDATE rooms SET description = ?, name = ?, room_type = ? WHERE id = ?", (description, room_name, room_type, room_id))
+            conn.execute("DELETE FROM room_participants WHERE room_id = ?", (room_id,))
+        else:
+            room_id = conn.execute(
+                "INSERT INTO rooms (name, organization_id, description, owner_id, room_type) VALUES (?, ?, ?, ?, ?)",
+                (room_name, int(organization_id or 0), description, user_id, room_type),
+            ).lastrowid
+
+        conn.executemany(
+            "INSERT INTO room_participants (room_id, user_id, last_message_seen, organization_id) VALUES (?, ?, ?, ?)",
+            [(room_id, uid, 0, int(organization_id)) for uid in participant_ids],
+        )
+        return room_id
+
+    def _ensure_participant(self, conn, room_id, participant_id, organization_id):
+        rows = conn.execute("""
+            SELECT id, deleted_at FROM room_participants
+            WHERE room_id = ? AND user_id = ? AND organization_id = ?
+            ORDER BY id DESC
+        """, (room_id, participant_id, int(organization_id))).fetchall()
+        if any(row['deleted_at'] is None for row in rows):
+            return
+        if rows:
+            conn.execute("UPDATE room_participants SET deleted_at = NULL WHERE id = ?", (rows[0]['id'],))
+            return
+        conn.execute(
+            "INSERT INTO room_participants (room_id, user_id, last_message_seen, organization_id) VALUES (?, ?, ?, ?)",
+            (room_id, participant_id, 0, int(organization_id)),
+        )
 
 def _can_send_message(last_sent_time , cooldown_minutes ) :
     if last_sent_time is None:
         return True  # no previous message
-    now = datetime.utcnow()
+    # client_notifications.created_at is filled by the storage in local time, like room_messages
+    now = datetime.now()
     elapsed = now - last_sent_time
     return elapsed > timedelta(minutes=cooldown_minutes)
 
+class NotificationCooldowns:
+    """
+    Remembers when each (organization_id, user_id) was last sent a push notification,
+    so the cooldown check does not read client_notifications on every message.
+    Entries are trusted for ttl seconds, after that they are warmed again from the
+    database. Past maxsize entries the least recently used one is evicted.
+    """
+    def __init__(self, maxsize=100000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (last_sent, expires_at)
+
+    def missing(self, organization_id, user_ids):
+        now = time.monotonic()
+        result = []
+        for user_id in user_ids:
+            entry = self.entries.get((int(organization_id), user_id))
+            if entry is None or entry[1] < now:
+                result.append(user_id)
+        return result
+
+    def record(self, organization_id, user_id, last_sent):
+        key = (int(organization_id), user_id)
+        self.entries[key] = (last_sent, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def can_send(self, organization_id, user_id, msg_type):
+        # unknown users count as never notified, warm them with warm_notification_cooldowns first
+        key = (int(organization_id), user_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            return True
+        self.entries.move_to_end(key)
+        return _can_send_message(entry[0], NOTIFICATION_COOLDOWN_MINUTES.get(msg_type, 0))
+
+notification_cooldowns = NotificationCooldowns(
+    getattr(config, "NOTIFICATION_COOLDOWN_CACHE_SIZE", 100000),
+    getattr(config, "NOTIFICATION_COOLDOWN_CACHE_TTL", 3600),
+)
+
+def record_notifications_sent(organization_id, user_ids, sent_at):
+    for user_id in user_ids:
+        notification_cooldowns.record(organization_id, user_id, sent_at)
+    # the other workers trust their own entries for the ttl, keep them in step
+    backplane.publish("notified", organization_id=organization_id, user_ids=list(user_ids), sent_at=sent_at)
+
+async def warm_notification_cooldowns( user_ids, organization_id ) :
+    missing = notification_cooldowns.missing(organization_id, user_ids)
+    if not missing:
+        return
+    last_sent = await storage.get_last_notifications(organization_id, missing)
+    for user_id in missing:
+        notification_cooldowns.record(organization_id, user_id, last_sent.get(user_id))
+
 async def get_user_id_using_username( pool, username, organization_id ) :
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("SELECT id FROM clients WHERE username = %s AND organization_id = %s LIMIT 1", (username, int(organization_id)))
-            result = await cursor.fetchone()
-            user_id = result['id'] if result else None
-            return user_id
-
-async def can_send_message( pool, user_id, organization_id, room_id ) :
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("SELECT silent_notifications FROM room_participants WHERE user_id = %s AND organization_id = %s AND room_id = %s AND deleted_at IS NULL ORDER BY id DESC LIMIT 1", (user_id, int(organization_id), room_id))
-            result = await cursor.fetchone()
-            silent = result['silent_notifications'] if result else None
-            if silent == 1 : 
-                return False
-            await cursor.execute("SELECT created_at FROM client_notifications WHERE user_id = %s AND organization_id = %s ORDER BY id DESC LIMIT 1", (user_id, int(organization_id)))
-            result = await cursor.fetchone()
-            last_sent = result['created_at'] if result else None
-            return _can_send_message(last_sent, 5)
+    return await storage.get_user_id(username, organization_id)
+
+def _parse_device_tokens(json_device_tokens, user_id):
+    if json_device_tokens is None:
+        return None
+    try:
+        device_tokens = json.loads(json_device_tokens)
+    except json.JSONDecodeError:
+        print(f"send_room_notifications: Invalid device_token JSON for user {user_id}")
+        return None
+    if not isinstance(device_tokens, list):
+        print(f"send_room_notifications: Invalid device_token payload for user {user_id}")
+        return None
+    return device_tokens
+
+async def get_offline_notification_targets( pool, user_ids, organization_id, room_id ) :
+    """
+    Finds the offline room members that may get a chat notification: not silenced,
+    outside the cooldown window and with device tokens. Uses one query per
+    attribute for all members instead of one round per member.
+    :return: dict of user_id -> list of device tokens
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+    silent = await storage.get_silent_members(room_id, organization_id, user_ids)
+    user_ids = [uid for uid in user_ids if silent.get(uid) != 1]
+    if not user_ids:
+        return {}
+
+    await warm_notification_cooldowns(user_ids, organization_id)
+    user_ids = [uid for uid in user_ids if notification_cooldowns.can_send(organization_id, uid, MSG_TYPE_CHAT)]
+    if not user_ids:
+        return {}
+
+    targets = {}
+    for user_id, json_device_tokens in (await storage.get_device_tokens(organization_id, user_ids)).items():
+        device_tokens = _parse_device_tokens(json_device_tokens, user_id)
+        if device_tokens is not None:
+            targets[user_id] = device_tokens
+    return targets
 
 async def store_send_notification_message (pool, user_id, message, msg_type, organization_id):
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("INSERT INTO client_notifications (user_id, organization_id, message, msg_type) VALUES( %s, %s, %s, %s)", (user_id, int( organization_id), message, msg_type))
-            msg_id = cursor.lastrowid
-            return msg_id
+    await storage.add_notifications([user_id], organization_id, message, msg_type)
 
 async def send_general_notifcation_message( pool, user_id, organization_id, msg_title, msg_body, message_data ) :
     data = {
         "type": "notification",
-        "data": f"{message_data}"
+        "data": message_data if isinstance(message_data, str) else json.dumps(message_data)
     }
     print(f"    -->>   In function send_general_notifcation_message {user_id}")
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("SELECT device_token FROM clients WHERE id = %s AND organization_id = %s", 
-                        (user_id, int(organization_id)))
-            result = await cursor.fetchone()
-            json_device_tokens = result['device_token'] if result else None
-            if( json_device_tokens == None ) :
-                return
-            try:
-                device_tokens = json.loads(json_device_tokens)
-            except json.JSONDecodeError:
-                print(f"    -->>   send_notifcation_message: Invalid device_token JSON for user {user_id}")
-                return
-            if not isinstance(device_tokens, list):
-                print(f"    -->>   send_notifcation_message: Invalid device_token payload for user {user_id}")
-                return
-            invalid_tokens = []
-            for tok in device_tokens:
-                print(f"    -->>   send_notifcation_message: Sending notification message to {user_id}")
-                status = send_push_notification( tok.get('token'), msg_title, msg_body, data )
-                if status == "unregistered":
-                    invalid_tokens.append(tok.get('token'))
-            if invalid_tokens:
-                device_tokens = [t for t in device_tokens if t.get("token") not in invalid_tokens]
-                new_value = json.dumps(device_tokens) if device_tokens else None
-                await cursor.execute(
-                    "UPDATE clients SET device_token = %s WHERE id = %s AND organization_id = %s",
-                    (new_value, user_id, int(organization_id)),
-                )
-            await store_send_notification_message( pool, user_id, msg_title, 2, organization_id)    
+    if NOTIFICATION_COOLDOWN_MINUTES.get(MSG_TYPE_GENERAL):
+        await warm_notification_cooldowns([user_id], organization_id)
+        if not notification_cooldowns.can_send(organization_id, user_id, MSG_TYPE_GENERAL):
+            print(f"    -->>   send_notifcation_message: {user_id} was notified recently, skipping")
+            return
+    json_device_tokens = (await storage.get_device_tokens(organization_id, [user_id])).get(user_id)
+    if( json_device_tokens == None ) :
+        return
+    try:
+        device_tokens = json.loads(json_device_tokens)
+    except json.JSONDecodeError:
+        print(f"    -->>   send_notifcation_message: Invalid device_token JSON for user {user_id}")
+        return
+    if not isinstance(device_tokens, list):
+        print(f"    -->>   send_notifcation_message: Invalid device_token payload for user {user_id}")
+        return
+    print(f"    -->>   send_notifcation_message: Sending notification message to {user_id}")
+    # before the push, so the other workers skip the user while it is sent
+    record_notifications_sent(organization_id, [user_id], datetime.now())
+    statuses = await dispatch_push( [tok.get('token') for tok in device_tokens], msg_title, msg_body, data )
+    invalid_tokens = [tok for tok, status in statuses.items() if status == "unregistered"]
+    if invalid_tokens:
+        device_tokens = [t for t in device_tokens if t.get("token") not in invalid_tokens]
+        new_value = json.dumps(device_tokens) if device_tokens else None
+        await storage.set_device_token(user_id, organization_id, new_value)
+    await store_send_notification_message( pool, user_id, msg_title, MSG_TYPE_GENERAL, organization_id)    
+
+async def store_send_notification_messages (pool, user_ids, message, msg_type, organization_id):
+    if not user_ids:
+        return
+    await storage.add_notifications(user_ids, organization_id, message, msg_type)
 
-async def send_notifcation_message( pool, user_id, organization_id, msg_title, msg_body, room_id ) :
+async def send_room_notifications( pool, user_ids, organization_id, msg_title, msg_body, room_id ) :
     data = {
         "type": "chat_msg",
         "data": f"{room_id}"
     }
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("SELECT device_token FROM clients WHERE id = %s AND organization_id = %s", (user_id, int(organization_id)))
-            result = await cursor.fetchone()
-            json_device_tokens = result['device_token'] if result else None
-            if( json_device_tokens == None ) :
-                return
-    
-            try:
-                device_tokens = json.loads(json_device_tokens)
-            except json.JSONDecodeError:
-                print(f"send_notifcation_message: Invalid device_token JSON for user {user_id}")
-                return
-            if not isinstance(device_tokens, list):
-                print(f"send_notifcation_message: Invalid device_token payload for user {user_id}")
-                return
-            invalid_tokens = []
-            for tok in device_tokens:
-                print(f"send_notifcation_message: Sending notification message to {user_id} ")
-                status = send_push_notification( tok.get('token'), msg_title, msg_body, data )
-                if status == "unregistered":
-                    invalid_tokens.append(tok.get('token'))
-            if invalid_tokens:
-                device_tokens = [t for t in device_tokens if t.get("token") not in invalid_tokens]
-                new_value = json.dumps(device_tokens) if device_tokens else None
-                await cursor.execute(
-                    "UPDATE clients SET device_token = %s WHERE id = %s AND organization_id = %s",
-                    (new_value, user_id, int(organization_id)),
-                )
-    
-            await store_send_notification_message( pool, user_id, msg_title, 1, organization_id)    
-                
+    targets = await get_offline_notification_targets( pool, user_ids, organization_id, room_id )
+    if not targets:
+        return
+    print(f"send_room_notifications: Sending notification message to {list(targets)} ")
+    tokens = [tok.get('token') for device_tokens in targets.values() for tok in device_tokens]
+    # before the push, so the other workers skip the users while it is sent
+    record_notifications_sent(organization_id, targets, datetime.now())
+    statuses = await dispatch_push( tokens, msg_title, msg_body, data )
+
+    for user_id, device_tokens in targets.items():
+        valid_tokens = [t for t in device_tokens if statuses.get(t.get("token")) != "unregistered"]
+        if len(valid_tokens) == len(device_tokens):
+            continue
+        new_value = json.dumps(valid_tokens) if valid_tokens else None
+        await storage.set_device_token(user_id, organization_id, new_value)
+
+    await store_send_notification_messages( pool, list(targets), msg_title, MSG_TYPE_CHAT, organization_id )
+
 async def get_user_id( username, organization_id ) :
-    global pool
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("SELECT id FROM clients WHERE username = %s AND organization_id = %s", (username, int(organization_id)))
-            user = await cursor.fetchone()
-            return user['id'] if user else None  # None if not found, dict if found
+    return await storage.get_user_id(username, organization_id)  # None if not found
 
 async def check_user(username, token):
-    global pool
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("SELECT * FROM clients WHERE username = %s AND token = %s", (username, token,))
-            user = await cursor.fetchone()
-            return user  # None if not found, dict if found
-
-async def is_user_room_owner(pool, user_id, room_id, organization_id):
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                SELECT id
-                FROM rooms
-                WHERE id = %s 
-                AND owner_id = %s 
-                AND organization_id = %s
-            """, (room_id, user_id, organization_id))
-            if await cursor.fetchone():
-                return True
-            else :
-                return False
+    user = await storage.get_user(username, token)
+    if user:
+        # a username change shows up here first, the other workers drop their entry
+        cached = identity_cache.get(user['id'])
+        if cached is not None and cached[0] != user['username']:
+            backplane.publish("user_changed", user_id=user['id'])
+        identity_cache.put(user['id'], user['username'])
+    return user  # None if not found, dict if found
+
+class IdentityCache:
+    """
+    user_id -> username, so history and member lists do not join clients.
+    Entries live for ttl seconds, past maxsize the least recently used one is evicted.
+    Unknown ids are not cached, a user added later is found on the next lookup.
+    """
+    def __init__(self, maxsize=100000, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # user_id -> (username, expires_at)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(user_id)
+        return entry
+
+    def put(self, user_id, username):
+        self.entries[user_id] = (username, time.monotonic() + self.ttl)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self.entries.pop(user_id, None)
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+identity_cache = IdentityCache(
+    getattr(config, "IDENTITY_CACHE_SIZE", 100000),
+    getattr(config, "IDENTITY_CACHE_TTL", 600),
+)
+
+async def get_usernames(pool, user_ids):
+    """
+    :return: dict of user_id -> username for the ids that exist in clients.
+    """
+    names = {}
+    missing = []
+    for user_id in set(user_ids):
+        entry = identity_cache.get(user_id)
+        if entry is None:
+            missing.append(user_id)
+        else:
+            names[user_id] = entry[0]
+    if missing:
+        found = await storage.get_usernames(missing)
+        for user_id, username in found.items():
+            identity_cache.put(user_id, username)
+        names.update(found)
+    return names
+
+async def add_usernames(pool, msgs):
+    names = await get_usernames(pool, [msg['user_id'] for msg in msgs])
+    for msg in msgs:
+        msg['username'] = names.get(msg['user_id'])
+    return msgs
+
+class ChangeClock:
+    """
+    Remembers when each key last changed, so a cache fill that read the database
+    before a change of its key does not store stale rows, while changes of other keys
+    leave it alone. Only the last max_keys changed keys are kept, a fill that started
+    before they were dropped counts as stale for every key.
+    """
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.now = 0
+        self.changed = {}  # key -> value of now at its last change
+        self.forgotten = 0
+
+    def touch(self, key):
+        self.now += 1
+        self.changed[key] = self.now
+        if len(self.changed) > self.max_keys:
+            self.changed.clear()
+            self.forgotten = self.now
+
+    def changed_since(self, key, since):
+        return since < self.forgotten or self.changed.get(key, 0) > since
+
+class UnreadCounters:
+    """
+    Unread message count per (room, user), kept up to date in memory as messages are
+    broadcast and read. A count that is not known (after a restart, a ClearLastMessageSeen
+    or a read that did not reach the newest message) is recomputed from the database the
+    next time the user asks for their rooms.
+    """
+    def __init__(self):
+        self.rooms = {}  # room -> {user_id: unread count}
+        self.last_msg_ids = {}  # room -> id of the newest message broadcast since start
+        # room -> {user_id: id of the newest message in the count read from the database}. A
+        # message committed before that read but broadcast after it is already counted.
+        self.counted = {}
+        # touched on every change of a room so a reconcile racing with it does not cache stale counts
+        self.changes = ChangeClock()
+
+    def get(self, room_id, user_id):
+        return self.rooms.get(id_key(room_id), {}).get(user_id)
+
+    def message_sent(self, room_id, msg_id, recipient_ids):
+        room = id_key(room_id)
+        self.changes.touch(room)
+        self.last_msg_ids[room] = msg_id
+        counts = self.rooms.get(room)
+        if not counts:
+            return
+        counted = self.counted.get(room, {})
+        for user_id in recipient_ids:
+            if user_id in counts and msg_id > counted.get(user_id, 0):
+                counts[user_id] += 1
+
+    def message_seen(self, room_id, user_id, msg_id):
+        room = id_key(room_id)
+        self.changes.touch(room)
+        counts = self.rooms.setdefault(room, {})
+        last_msg_id = self.last_msg_ids.get(room)
+        if last_msg_id is not None and str(msg_id).isdigit() and int(msg_id) >= last_msg_id:
+            counts[user_id] = 0
+        else:
+            counts.pop(user_id, None)
+            self.counted.get(room, {}).pop(user_id, None)
+
+    def forget_user(self, room_id, user_id):
+        room = id_key(room_id)
+        self.changes.touch(room)
+        counts = self.rooms.get(room)
+        if counts:
+            counts.pop(user_id, None)
+        self.counted.get(room, {}).pop(user_id, None)
+
+    def forget_room(self, room_id):
+        room = id_key(room_id)
+        self.changes.touch(room)
+        self.rooms.pop(room, None)
+        self.counted.pop(room, None)
+
+    def reconciled(self, user_id, counts, since):
+        # counts: room_id -> (unread count, id of the newest unread message or None), read
+        # from the database after changes.now was since
+        for room_id, (count, last_id) in counts.items():
+            room = id_key(room_id)
+            if self.changes.changed_since(room, since):
+                continue
+            self.rooms.setdefault(room, {})[user_id] = count
+            if last_id is not None:
+                self.counted.setdefault(room, {})[user_id] = last_id
+            else:
+                self.counted.get(room, {}).pop(user_id, None)
+
+    def stats(self):
+        return {"rooms": len(self.rooms), "counters": sum(len(counts) for counts in self.rooms.values())}
+
+unread_counters = UnreadCounters()
 
 async def get_user_rooms(pool, user_id):
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                SELECT r.id, r.name, r.description, r.room_type, r.last_message_at, ru.last_message_seen, r.owner_id, ru.silent_notifications
-                FROM rooms r 
-                JOIN room_participants ru ON ru.room_id = r.id
-                WHERE ru.user_id = %s
-                AND ru.deleted_at IS NULL
-                ORDER BY r.last_message_at DESC, r.id DESC
-            """, (user_id,))
-            rooms = await cursor.fetchall()
-            for room in rooms:
-                for field, value in room.items():
-                    if isinstance(value, datetime):
-                        room[field] = value.isoformat()
-            return rooms
-
-async def store_new_message (pool, user_id, message, msginfo, room_id, organization_id):
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("INSERT INTO room_messages (room_id, user_id, organization_id, message, message_information) VALUES( %s, %s, %s, %s, %s)", (room_id, user_id, int( organization_id), message, msginfo))       
-            await cursor.execute("UPDATE rooms SET last_message_at = NOW() WHERE id = %s", (room_id,))
-            msg_id = cursor.lastrowid
-            return msg_id
+    rooms = await storage.get_user_rooms(user_id)
+
+    for room in rooms:
+        pending = last_seen_buffer.get(user_id, room['id'])
+        if pending is not None:
+            room['last_message_seen'] = pending
+
+    unknown = [room for room in rooms if unread_counters.get(room['id'], user_id) is None]
+    counts = {}
+    if unknown:
+        # one storage round for every room whose count is not known yet
+        since = unread_counters.changes.now
+        counts = dict.fromkeys((room['id'] for room in unknown), (0, None))
+        counts.update(await storage.count_unread(user_id, {room['id']: room['last_message_seen'] for room in unknown}))
+        unread_counters.reconciled(user_id, counts, since)
+
+    for room in rooms:
+        unread = unread_counters.get(room['id'], user_id)
+        room['unread'] = unread if unread is not None else counts.get(room['id'], (0, None))[0]
+    return rooms
+
+class MessageWriter:
+    """
+    Group commit for room_messages. Messages submitted within window seconds of each
+    other are written with one storage.add_messages call, on MySQL one transaction with
+    a multi-row INSERT and one UPDATE of rooms.last_message_at per batch. Each submit()
+    resolves to the id of its own row.
+    """
+    def __init__(self, window=0.002, max_batch=500):
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = []
+        # the batch being written
+        self.writing = []
+        self.wakeup = None
+        self.task = None
+        self.batches = 0
+        self.messages = 0
+
+    def start(self, pool):
+        self.wakeup = asyncio.Event()
+        # a fresh context, the writer must not join the unit of work of the event that started it
+        self.task = asyncio.create_task(self.run(pool), context=contextvars.Context())
+
+    async def stop(self):
+        if self.task is not None:
+            # let submitted messages, and the batch being written, reach the database before the pool closes
+            while (self.queue or self.writing) and not self.task.done():
+                self.wakeup.set()
+                await asyncio.sleep(self.window or 0.001)
+            self.task.cancel()
+            self.task = None
+        for params, future in self.writing + self.queue:
+            if not future.done():
+                future.set_exception(RuntimeError("message writer stopped"))
+        self.writing = []
+        self.queue = []
+
+    async def submit(self, pool, room_id, user_id, organization_id, message, msginfo):
+        if self.task is None:
+            self.start(pool)
+        future = asyncio.get_running_loop().create_future()
+        self.queue.append(((room_id, user_id, int(organization_id), message, msginfo), future))
+        self.wakeup.set()
+        return await future
+
+    async def run(self, pool):
+        while True:
+            await self.wakeup.wait()
+            if self.window:
+                # let the rest of the burst arrive
+                await asyncio.sleep(self.window)
+            self.wakeup.clear()
+            while self.queue:
+                batch, self.queue = self.queue[:self.max_batch], self.queue[self.max_batch:]
+                self.writing = batch
+                try:
+                    ids = await self.write(pool, [params for params, future in batch])
+                except Exception as e:
+                    print(f"MessageWriter: writing {len(batch)} messages failed: {e}")
+                    for params, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                finally:
+                    self.writing = []
+                for (params, future), msg_id in zip(batch, ids):
+                    if not future.done():
+                        future.set_result(msg_id)
+
+    async def write(self, pool, rows):
+        ids = await storage.add_messages(rows)
+        self.batches += 1
+        self.messages += len(rows)
+        return ids
+
+    def stats(self):
+        return {
+            "queued": len(self.queue),
+            "writing": len(self.writing),
+            "batches": self.batches,
+            "messages": self.messages,
+        }
+
+message_writer = MessageWriter(
+    getattr(config, "MESSAGE_WRITER_WINDOW", 0.002),
+    getattr(config, "MESSAGE_WRITER_MAX_BATCH", 500),
+)
+
+async def store_new_message (pool, user_id, message, msginfo, room_id, organization_id, username=None):
+    msg_id = await message_writer.submit(pool, room_id, user_id, organization_id, message, msginfo)
+    # the storage fills created_at with its own clock, the server is expected to share its time zone
+    now = datetime.now().replace(microsecond=0)
+    msg = {
+        "id": msg_id,
+        "user_id": user_id,
+        "username": username,
+        "room_id": room_id,
+        "message": message,
+        "message_information": msginfo,
+        "created_at": now,
+        "updated_at": now,
+    }
+    backplane.publish("message_stored", room_id=room_id, organization_id=organization_id, msg=msg)
+    history_cache.append(room_id, organization_id, msg)
+    return msg_id
 
 async def edit_message_in_room (pool, user_id, msg_id, message, msginfo, room_id, organization_id):
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("UPDATE room_messages SET message = %s, message_information = %s WHERE id=%s AND user_id=%s AND room_id=%s AND organization_id=%s", ( message, msginfo, msg_id, user_id, room_id, organization_id))
-            return cursor.rowcount
+    changed = await storage.edit_message(user_id, msg_id, message, msginfo, room_id, organization_id)
+    if changed > 0:
+        history_cache.edit(room_id, organization_id, msg_id, message, msginfo)
+        backplane.publish("message_edited", room_id=room_id, organization_id=organization_id, msg_id=msg_id, message=message, msginfo=msginfo)
+    return changed
+
+class LastSeenBuffer:
+    """
+    Write-behind buffer for LastSeenMsg. Keeps the highest msg_id per (user_id, room_id)
+    and writes all of them with one UPDATE every interval seconds, or sooner once
+    max_pending entries are waiting. Reads see the buffered values before they are written.
+    """
+    # rows per UPDATE statement
+    BATCH_SIZE = 1000
+
+    def __init__(self, interval=1.0, max_pending=1000):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self.flushing = {}
+        self.flushed = None
+        self.wakeup = None
+        self.task = None
+        self.flushes = 0
+        self.rows_written = 0
+
+    @staticmethod
+    def key(user_id, room_id):
+        return user_id, id_key(room_id)
+
+    def record(self, user_id, room_id, msg_id):
+        key = self.key(user_id, room_id)
+        if msg_id > self.pending.get(key, 0):
+            self.pending[key] = msg_id
+        if len(self.pending) >= self.max_pending and self.wakeup is not None:
+            self.wakeup.set()
+
+    def get(self, user_id, room_id):
+        key = self.key(user_id, room_id)
+        return self.pending.get(key, self.flushing.get(key))
+
+    async def discard(self, user_id, room_id):
+        # drops the buffered value and waits until an in-flight write of it is done,
+        # so a later direct UPDATE of the row is not overwritten
+        key = self.key(user_id, room_id)
+        self.pending.pop(key, None)
+        while key in self.flushing and self.flushed is not None:
+            await self.flushed.wait()
+
+    async def flush(self, pool):
+        if not self.pending or self.flushing:
+            return
+        self.flushing, self.pending = self.pending, {}
+        self.flushed = asyncio.Event()
+        rows = list(self.flushing.items())
+        try:
+            for i in range(0, len(rows), self.BATCH_SIZE):
+                batch = rows[i:i + self.BATCH_SIZE]
+                await storage.set_last_seen([(user_id, room_id, msg_id) for (user_id, room_id), msg_id in batch])
+            self.flushes += 1
+            self.rows_written += len(rows)
+        except Exception as e:
+            print(f"LastSeenBuffer: flush of {len(rows)} rows failed, retrying later: {e}")
+            for key, msg_id in rows:
+                if key not in self.pending:
+                    self.pending[key] = msg_id
+        finally:
+            self.flushing = {}
+            self.flushed.set()
+
+    async def run(self, pool):
+        self.wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush(pool)
+
+    def start(self, pool):
+        self.task = asyncio.create_task(self.run(pool))
+
+    async def stop(self, pool):
+        if self.flushing:
+            await self.flushed.wait()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush(pool)
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+        }
+
+last_seen_buffer = LastSeenBuffer(
+    getattr(config, "LAST_SEEN_FLUSH_INTERVAL", 1.0),
+    getattr(config, "LAST_SEEN_FLUSH_SIZE", 1000),
+)
 
 async def update_last_seen_msg_in_room(pool, user_id, room_id, msg_id, organization_id) :
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                UPDATE room_participants 
-                SET last_message_seen = %s
-                WHERE room_id = %s 
-                AND user_id = %s
-            """, (msg_id, room_id, user_id))
-            await conn.commit()
-            if cursor.rowcount > 0:
-                return True
-            else:
-                return False
+    try:
+        msg_id = int(msg_id)
+    except (TypeError, ValueError):
+        return False
+    members, room_organization_id = await get_room_members(pool, room_id)
+    if user_id not in members:
+        return False
+    last_seen_buffer.record(user_id, room_id, msg_id)
+    unread_counters.message_seen(room_id, user_id, msg_id)
+    backplane.publish("message_seen", room_id=room_id, user_id=user_id, msg_id=msg_id)
+    return True
+
+class RoomHistory:
+    __slots__ = ("messages", "last_access")
+
+    def __init__(self, messages, maxlen):
+        self.messages = deque(messages, maxlen=maxlen)
+        self.last_access = time.monotonic()
+
+class HistoryCache:
+    """
+    Ring buffer of the latest messages of each active (room_id, organization_id),
+    oldest first, as returned by the database. Rooms are evicted when idle
+    for idle_seconds or, least recently used first, when the total number of
+    cached messages is over max_messages.
+    """
+    def __init__(self, per_room=LAST_MESSAGES_LIMIT, max_messages=200000, idle_seconds=3600):
+        self.per_room = max(per_room, LAST_MESSAGES_LIMIT)
+        self.max_messages = max_messages
+        self.idle_seconds = idle_seconds
+        self.rooms = OrderedDict()
+        self.size = 0
+        # touched on every change of a room so a fill racing with it does not cache stale rows
+        self.changes = ChangeClock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(room_id, organization_id):
+        return id_key(room_id), int(organization_id)
+
+    def latest(self, room_id, organization_id, limit):
+        key = self.key(room_id, organization_id)
+        room = self.rooms.get(key)
+        if room is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        room.last_access = time.monotonic()
+        self.rooms.move_to_end(key)
+        msgs = list(room.messages)[-limit:]
+        msgs.reverse()
+        return msgs
+
+    def fill(self, room_id, organization_id, msgs, since):
+        # msgs are the newest messages of the room, newest first, as returned by the database
+        # after changes.now was since
+        key = self.key(room_id, organization_id)
+        if self.changes.changed_since(key, since):
+            return
+        self.discard(key)
+        room = RoomHistory(reversed(msgs), self.per_room)
+        self.rooms[key] = room
+        self.size += len(room.messages)
+        self.evict()
+
+    def append(self, room_id, organization_id, msg):
+        key = self.key(room_id, organization_id)
+        self.changes.touch(key)
+        room = self.rooms.get(key)
+        if room is None:
+            return
+        if len(room.messages) == room.messages.maxlen:
+            self.size -= 1
+        room.messages.append(msg)
+        self.size += 1
+
+    def edit(self, room_id, organization_id, msg_id, message, msginfo):
+        key = self.key(room_id, organization_id)
+        self.changes.touch(key)
+        room = self.rooms.get(key)
+        if room is None:
+            return
+        for msg in room.messages:
+            if str(msg["id"]) == str(msg_id):
+                msg["message"] = message
+                msg["message_information"] = msginfo
+                break
+
+    def remove(self, room_id, organization_id, msg_id):
+        # the buffer would be one message short, the next read refills it
+        key = self.key(room_id, organization_id)
+        self.changes.touch(key)
+        room = self.rooms.get(key)
+        if room is not None and any(str(msg["id"]) == str(msg_id) for msg in room.messages):
+            self.discard(key)
+
+    def discard(self, key):
+        room = self.rooms.pop(key, None)
+        if room is not None:
+            self.size -= len(room.messages)
+
+    def evict(self):
+        idle_before = time.monotonic() - self.idle_seconds
+        while self.rooms:
+            key, room = next(iter(self.rooms.items()))
+            if self.size <= self.max_messages and room.last_access >= idle_before:
+                break
+            self.discard(key)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "rooms": len(self.rooms),
+            "messages": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+history_cache = HistoryCache(
+    getattr(config, "HISTORY_CACHE_MESSAGES_PER_ROOM", LAST_MESSAGES_LIMIT),
+    getattr(config, "HISTORY_CACHE_MAX_MESSAGES", 200000),
+    getattr(config, "HISTORY_CACHE_IDLE_SECONDS", 3600),
+)
 
 async def get_last_messages_in_room(pool, user_id, room_id, organization_id) :
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                SELECT m.id, m.user_id, u.username, m.room_id, m.message, m.message_information, m.created_at, m.updated_at
-                FROM room_messages m
-                JOIN clients u ON m.user_id = u.id
-                WHERE m.room_id = %s
-                  AND m.organization_id = %s
-                  AND m.is_deleted = 0
-                ORDER BY m.id DESC
-                LIMIT 20
-            """, (room_id, organization_id))
-            msgs = await cursor.fetchall()
-
-            for msg in msgs:
-                for field in ("created_at", "updated_at"):
-                    if isinstance(msg.get(field), datetime):
-                        msg[field] = msg[field].isoformat()
-
-            return msgs
+    msgs = history_cache.latest(room_id, organization_id, LAST_MESSAGES_LIMIT)
+    if msgs is not None:
+        return await add_usernames(pool, msgs)
+
+    since = history_cache.changes.now
+    msgs = await storage.get_messages(room_id, organization_id, None, "backward", history_cache.per_room)
+    history_cache.fill(room_id, organization_id, msgs, since)
+    return await add_usernames(pool, msgs[:LAST_MESSAGES_LIMIT])
 
 async def delete_message_in_room(pool, user_id, room_id, msg_id, organization_id) :
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                UPDATE room_messages m
-                  SET is_deleted = 1
-                WHERE room_id = %s
-                  AND organization_id = %s
-                  AND user_id = %s
-                  AND id = %s
-            """, (room_id, organization_id, user_id, msg_id))
-            await conn.commit()
-            if cursor.rowcount > 0:
-                return True
-            else:
-                return False
+    if await storage.delete_message(user_id, room_id, msg_id, organization_id) > 0:
+        history_cache.remove(room_id, organization_id, msg_id)
+        unread_counters.forget_room(room_id)
+        backplane.publish("message_deleted", room_id=room_id, organization_id=organization_id, msg_id=msg_id)
+        return True
+    else:
+        return False
 
         
+async def get_room_messages_page(pool, room_id, organization_id, anchor_id, direction, limit) :
+    """
+    One page of room history with the usernames, see storage.get_messages.
+    :param anchor_id: Exclusive bound, None starts at the newest (backward) or oldest (forward) message.
+    :param direction: "backward" for older messages, newest first, "forward" for newer ones, oldest first.
+    """
+    msgs = await storage.get_messages(room_id, organization_id, anchor_id, direction, limit)
+    return await add_usernames(pool, msgs)
+
 async def get_prev_messages_in_room(pool, user_id, room_id, organization_id, last_id) :
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                SELECT m.id, m.user_id, u.username, m.room_id, m.message, m.message_information, m.created_at, m.updated_at
-                FROM room_messages m
-                JOIN clients u ON m.user_id = u.id
-                WHERE m.room_id = %s
-                  AND m.organization_id = %s
-                  AND m.is_deleted = 0
-                  AND m.id < %s
-                ORDER BY m.id DESC
-                LIMIT 20
-            """, (room_id, organization_id, last_id))
-            msgs = await cursor.fetchall()
-            for msg in msgs:
-                for field in ("created_at", "updated_at"):
-                    if isinstance(msg.get(field), datetime):
-                        msg[field] = msg[field].isoformat()
-            return msgs
-        
+    return await get_room_messages_page(pool, room_id, organization_id, last_id, "backward", HISTORY_PAGE_SIZE)
+
 async def get_messages_in_room(pool, user_id, room_id, organization_id, last_id) :
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                SELECT m.id, m.user_id, u.username, m.room_id, m.message, m.message_information, m.created_at, m.updated_at
-                FROM room_messages m
-                JOIN clients u ON m.user_id = u.id
-                WHERE m.room_id = %s
-                  AND m.organization_id = %s
-                  AND m.is_deleted = 0
-                  AND m.id > %s
-                ORDER BY m.id ASC
-                LIMIT 20
-            """, (room_id, organization_id, last_id))
-            msgs = await cursor.fetchall()
-            for msg in msgs:
-                for field in ("created_at", "updated_at"):
-                    if isinstance(msg.get(field), datetime):
-                        msg[field] = msg[field].isoformat()
-            return msgs
-        
+    return await get_room_messages_page(pool, room_id, organization_id, last_id, "forward", HISTORY_PAGE_SIZE)
+
+def encode_history_cursor(room_id, msg_id):
+    return base64.urlsafe_b64encode(f"{room_id}:{msg_id}".encode()).decode().rstrip("=")
+
+def decode_history_cursor(cursor, room_id):
+    """
+    :return: the message id of a cursor made by encode_history_cursor for the same room.
+    :raise ValueError: when the cursor is malformed or belongs to another room.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        cursor_room, msg_id = raw.split(":")
+        msg_id = int(msg_id)
+    except (TypeError, ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError("invalid cursor")
+    if cursor_room != str(room_id):
+        raise ValueError("cursor belongs to another room")
+    return msg_id
+
+async def get_history(pool, room_id, organization_id, cursor=None, direction="backward", limit=HISTORY_PAGE_SIZE):
+    """
+    :return: (messages, next_cursor) where next_cursor is None when there are no more messages.
+    """
+    anchor_id = decode_history_cursor(cursor, room_id) if cursor else None
+    limit = max(1, min(int(limit), HISTORY_MAX_PAGE_SIZE))
+    # one extra row tells whether there is a next page
+    msgs = await get_room_messages_page(pool, room_id, organization_id, anchor_id, direction, limit + 1)
+    if len(msgs) <= limit:
+        return msgs, None
+    msgs = msgs[:limit]
+    return msgs, encode_history_cursor(room_id, msgs[-1]["id"])
+
+def id_key(value):
+    # ids come from the database as ints and from clients as ints or strings,
+    # dicts keyed by room, user or message id use the int
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+class RoomMembershipCache:
+    """
+    LRU cache of room_id -> (set of active member ids, organization_id).
+    Helpers that change room_participants update or invalidate the entry.
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        # bumped on every change so a lookup racing with a change does not cache stale members
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, room_id):
+        key = id_key(room_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, room_id, members, organization_id, generation=None):
+        entry = (set(members), organization_id)
+        if generation is not None and generation != self.generation:
+            return entry
+        key = id_key(room_id)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def invalidate(self, room_id):
+        self.generation += 1
+        self.entries.pop(id_key(room_id), None)
+
+    def discard_member(self, room_id, user_id):
+        self.generation += 1
+        entry = self.entries.get(id_key(room_id))
+        if entry is not None:
+            entry[0].discard(user_id)
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+room_members_cache = RoomMembershipCache(getattr(config, "ROOM_MEMBERS_CACHE_SIZE", 10000))
+
+async def get_room_members(pool, room_id):
+    """
+    :return: (set of active member ids, organization_id) of a room, served from room_members_cache when possible.
+    The set is shared with the cache, do not modify it.
+    """
+    entry = room_members_cache.get(room_id)
+    if entry is not None:
+        return entry
+    generation = room_members_cache.generation
+    members, organization_id = await storage.get_room_members(room_id)
+    return room_members_cache.put(room_id, members, organization_id, generation)
+
 async def get_users_in_room(pool, room_id):
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                SELECT user_id
-                FROM room_participants 
-                WHERE room_id = %s
-                AND deleted_at IS NULL
-            """, (room_id,))        
-            rows = await cursor.fetchall()
-            return [row['user_id'] for row in rows]  # return only the IDs
+    members, organization_id = await get_room_members(pool, room_id)
+    return list(members)  # return only the IDs
 
 async def leave_room ( pool, room_id, user_id) :
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                UPDATE room_participants 
-                SET deleted_at = NOW() 
-                WHERE room_id = %s
-                AND user_id = %s
-            """, (room_id, user_id,))
-            if cursor.rowcount > 0:
-                return True
-            else :
-                return False
+    if await storage.leave_room(room_id, user_id):
+        room_members_cache.discard_member(room_id, user_id)
+        unread_counters.forget_user(room_id, user_id)
+        backplane.publish("member_left", room_id=room_id, user_id=user_id)
+        return True
+    else :
+        return False
 
 async def silent_room ( pool, room_id, user_id) :
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                UPDATE room_participants
-                SET silent_notifications = 1 
-                WHERE room_id = %s
-                AND user_id = %s
-            """, (room_id, user_id,))
-            if cursor.rowcount > 0:
-                return True
-            else :
-                return False
+    return await storage.set_room_silent(room_id, user_id, True)
             
 async def unsilent_room ( pool, room_id, user_id) :
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                UPDATE room_participants
-                SET silent_notifications = 0
-                WHERE room_id = %s
-                AND user_id = %s
-            """, (room_id, user_id,))
-            if cursor.rowcount > 0:
-                return True
-            else :
-                return False
+    return await storage.set_room_silent(room_id, user_id, False)
 
 async def get_room_owner(pool, room_id):
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                SELECT u.id, u.username
-                FROM rooms r
-                JOIN clients u ON r.owner_id = u.id
-                WHERE r.id = %s
-            """, (room_id,))
-            users = await cursor.fetchall()
-            for user in users:
-                uid = user['id']
-                user["online"] = isUserOnline( uid )
-            return users
+    owner_ids = await storage.get_room_owners(room_id)
+    names = await get_usernames(pool, owner_ids)
+    return [
+        {"id": uid, "username": names[uid], "online": isUserOnline( uid )}
+        for uid in owner_ids if uid in names
+    ]
 
 async def get_user_names_in_room(pool, room_id):
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                SELECT u.id, u.username
-                FROM room_participants rp
-                JOIN clients u ON rp.user_id = u.id
-                WHERE rp.room_id = %s
-                AND rp.deleted_at IS NULL
-            """, (room_id,))
-            users = await cursor.fetchall()
-            for user in users:
-                uid = user['id']
-                user["online"] = isUserOnline( uid )
-            return users
-
-async def mark_msg_not_read(pool, user_ids, room_id, msg_id):
-    if not user_ids:
-        return
-    placeholders = ','.join(['%s'] * len(user_ids))
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            sql = f"""
-                UPDATE room_participants 
-                SET last_message_seen = {msg_id} - 1
-                WHERE room_id = %s 
-                AND user_id IN ({placeholders})
-            """
-            await cursor.execute(sql, (room_id, *user_ids)) # TODO might be hard on the database if there are many people in room
-            await conn.commit()
+    members, organization_id = await get_room_members(pool, room_id)
+    member_ids = list(members)
+    names = await get_usernames(pool, member_ids)
+    return [
+        {"id": uid, "username": names[uid], "online": isUserOnline( uid )}
+        for uid in member_ids if uid in names
+    ]
 
 async def clear_user_last_seen_msg(pool, user_id, room_id):
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            sql = f"""
-                UPDATE room_participants 
-                SET last_message_seen = 0
-                WHERE room_id = %s AND user_id = %s
-                AND deleted_at IS NULL
-            """
-            await cursor.execute(sql, (room_id, user_id))
-            await conn.commit()
+    await last_seen_buffer.discard(user_id, room_id)
+    await storage.clear_last_seen(user_id, room_id)
+    unread_counters.forget_user(room_id, user_id)
+    backplane.publish("last_seen_cleared", room_id=room_id, user_id=user_id)
 
 def normalize_room_type(room_type, participant_count):
     if isinstance(room_type, str):
@@ -672,159 +2353,1373 @@ async def resolve_user_ids(pool, raw_user_ids, creator_user_id, organization_id)
     resolved.add(int(creator_user_id))
     return list(resolved)
 
-async def find_existing_direct_room(pool, organization_id, user_a_id, user_b_id):
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                SELECT r.id
-                FROM rooms r
-                JOIN room_participants rp ON rp.room_id = r.id
-                WHERE r.organization_id = %s
-                  AND r.room_type = 'direct'
-                GROUP BY r.id
-                HAVING COUNT(DISTINCT rp.user_id) = 2
-                   AND SUM(CASE WHEN rp.user_id = %s THEN 1 ELSE 0 END) > 0
-                   AND SUM(CASE WHEN rp.user_id = %s THEN 1 ELSE 0 END) > 0
-                ORDER BY r.id DESC
-                LIMIT 1
-            """, (int(organization_id), int(user_a_id), int(user_b_id)))
-            row = await cursor.fetchone()
-            return row["id"] if row else None
-
-async def ensure_room_participant(cursor, room_id, participant_id, organization_id):
-    await cursor.execute("""
-        SELECT id
-        FROM room_participants
-        WHERE room_id = %s
-          AND user_id = %s
-          AND organization_id = %s
-          AND deleted_at IS NULL
-        ORDER BY id DESC
-        LIMIT 1
-    """, (room_id, participant_id, int(organization_id)))
-    existing_active = await cursor.fetchone()
-    if existing_active:
-        return
-
-    await cursor.execute("""
-        SELECT id
-        FROM room_participants
-        WHERE room_id = %s
-          AND user_id = %s
-          AND organization_id = %s
-        ORDER BY id DESC
-        LIMIT 1
-    """, (room_id, participant_id, int(organization_id)))
-    existing_any = await cursor.fetchone()
-    if existing_any:
-        await cursor.execute("""
-            UPDATE room_participants
-            SET deleted_at = NULL
-            WHERE id = %s
-        """, (existing_any[0],))
-        return
-
-    await cursor.execute("""
-        INSERT INTO room_participants (room_id, user_id, last_message_seen, organization_id)
-        VALUES (%s, %s, %s, %s)
-    """, (room_id, participant_id, 0, int(organization_id)))
-
 async def create_or_update_room(pool, user_id, room_name, user_ids, description, organization_id, requested_room_type=None):
     participant_ids = await resolve_user_ids(pool, user_ids, user_id, organization_id)
     room_type = normalize_room_type(requested_room_type, len(participant_ids))
     if isinstance(requested_room_type, str) and requested_room_type.strip().lower() in {"dm", "direct_message", "direct"} and len(participant_ids) != 2:
         return None, "direct"
 
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            if room_type == "direct" and len(participant_ids) == 2:
-                direct_room_id = await find_existing_direct_room(pool, organization_id, participant_ids[0], participant_ids[1])
-                if direct_room_id:
-                    for uid in participant_ids:
-                        await ensure_room_participant(cursor, direct_room_id, uid, organization_id)
-                    await conn.commit()
-                    return direct_room_id, room_type
-
-            await cursor.execute("SELECT id FROM rooms WHERE name = %s AND organization_id = %s", (room_name, organization_id))
-            existing_room = await cursor.fetchone()
-            if existing_room:
-                room_id = existing_room[0]
-                if await is_user_room_owner(pool, user_id, room_id, organization_id) == False:
-                    return None, room_type
-                await cursor.execute(
-                    "UPDATE rooms SET description = %s, name = %s, room_type = %s WHERE id = %s",
-                    (description, room_name, room_type, room_id),
-                )
-                await cursor.execute("DELETE FROM room_participants WHERE room_id = %s", (room_id,))
-            else:
-                if organization_id:
-                    await cursor.execute(
-                        "INSERT INTO rooms (name, organization_id, description, owner_id, room_type) VALUES (%s, %s, %s, %s, %s)",
-                        (room_name, int(organization_id), description, user_id, room_type),
-                    )
-                else:
-                    await cursor.execute(
-                        "INSERT INTO rooms (name, description, owner_id, room_type) VALUES (%s, %s, %s, %s)",
-                        (room_name, description, user_id, room_type),
-                    )
-                room_id = cursor.lastrowid
+    room_id = await storage.save_room(user_id, room_name, participant_ids, description, organization_id, room_type)
+    if room_id:
+        # after the commit, so a concurrent lookup cannot cache the old members again
+        room_members_cache.invalidate(room_id)
+        unread_counters.forget_room(room_id)
+        backplane.publish("room_changed", room_id=room_id)
+    return room_id, room_type
+
+def _encode_default(value):
+    # rows keep the datetimes of the database, they go on the wire in ISO format
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+def _isoformat_datetimes(value):
+    if isinstance(value, dict):
+        return {key: _isoformat_datetimes(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_isoformat_datetimes(item) for item in value]
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+class JsonCodec:
+    """
+    Wire format of a connection. encode returns str or bytes, sent as a text frame
+    when text is True. decode raises ValueError on a malformed frame.
+    Uses orjson when it is installed, the json module otherwise.
+    """
+    subprotocol = None
+    label = "JSON"
+    text = True
+
+    def encode(self, payload):
+        if orjson is not None:
+            return orjson.dumps(payload, default=_encode_default, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(payload, default=_encode_default)
+
+    def decode(self, frame):
+        if orjson is not None:
+            return orjson.loads(frame)
+        return json.loads(frame)
+
+class MsgpackCodec(JsonCodec):
+    subprotocol = "ccss.msgpack"
+    label = "MessagePack"
+    text = False
+
+    def encode(self, payload):
+        return msgpack.packb(payload, default=_encode_default)
+
+    def decode(self, frame):
+        if not isinstance(frame, bytes):
+            raise ValueError("expected a binary frame")
+        try:
+            return msgpack.unpackb(frame, strict_map_key=False)
+        except (msgpack.UnpackException, TypeError) as e:
+            raise ValueError(str(e))
+
+class CborCodec(JsonCodec):
+    subprotocol = "ccss.cbor"
+    label = "CBOR"
+    text = False
+
+    def encode(self, payload):
+        # cbor2 refuses naive datetimes before calling default, convert them first
+        return cbor2.dumps(_isoformat_datetimes(payload))
+
+    def decode(self, frame):
+        if not isinstance(frame, bytes):
+            raise ValueError("expected a binary frame")
+        try:
+            return cbor2.loads(frame)
+        except cbor2.CBORDecodeError as e:
+            raise ValueError(str(e))
+
+json_codec = JsonCodec()
+# subprotocol -> codec, in the server's order of preference
+codecs = {}
+if msgpack is not None:
+    codecs[MsgpackCodec.subprotocol] = MsgpackCodec()
+if cbor2 is not None:
+    codecs[CborCodec.subprotocol] = CborCodec()
+
+def select_subprotocol(connection, subprotocols):
+    # a client that offers none of ours, or no subprotocol at all, talks JSON
+    for subprotocol in codecs:
+        if subprotocol in subprotocols:
+            return subprotocol
+    return None
+
+def get_codec(websocket):
+    return codecs.get(websocket.subprotocol, json_codec)
+
+class MinSizePerMessageDeflate(PerMessageDeflate):
+    """
+    permessage-deflate that sends messages shorter than min_size uncompressed.
+    RFC 7692 lets the sender choose per message, the compressor state is not touched.
+    """
+    def __init__(self, *args, min_size=0):
+        super().__init__(*args)
+        self.min_size = min_size
+
+    def encode(self, frame):
+        if frame.fin and frame.opcode in (Opcode.TEXT, Opcode.BINARY) and len(frame.data) < self.min_size:
+            return frame
+        return super().encode(frame)
+
+class MinSizePerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, min_size=0, **kwargs):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, MinSizePerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            min_size=self.min_size,
+        )
+
+def compression_options(enabled=COMPRESSION, window_bits=COMPRESSION_WINDOW_BITS,
+                        client_window_bits=COMPRESSION_CLIENT_WINDOW_BITS, mem_level=COMPRESSION_MEM_LEVEL,
+                        min_size=COMPRESSION_MIN_SIZE, no_context_takeover=COMPRESSION_NO_CONTEXT_TAKEOVER):
+    """
+    :return: the compression keyword arguments of websockets.serve for a policy,
+    by default the one of the config.
+    """
+    if not enabled:
+        return {"compression": None}
+    return {
+        "compression": None,
+        "extensions": [MinSizePerMessageDeflateFactory(
+            min_size=min_size,
+            server_no_context_takeover=no_context_takeover,
+            client_no_context_takeover=no_context_takeover,
+            server_max_window_bits=window_bits,
+            client_max_window_bits=client_window_bits,
+            compress_settings={"memLevel": mem_level},
+        )],
+    }
 
-            for uid in participant_ids:
-                await cursor.execute(
-                    "INSERT INTO room_participants (room_id, user_id, last_message_seen, organization_id) VALUES (%s, %s, %s, %s)",
-                    (room_id, uid, 0, int(organization_id)),
-                )
+class LocalBackplane:
+    """
+    Backplane of a single worker process. There is no other worker to reach,
+    publish only counts the messages.
+    """
+    def __init__(self):
+        self.worker_id = 0
+        self.published = 0
 
-            await conn.commit()
-            return room_id, room_type
+    async def start(self, handler):
+        pass
+
+    def publish(self, kind, **fields):
+        self.published += 1
+
+    async def stop(self):
+        pass
+
+    def stats(self):
+        return {"type": "local", "worker": self.worker_id, "published": self.published}
+
+class UnixSocketBackplane:
+    """
+    Backplane between the worker processes of one host, through the BackplaneBroker
+    of the parent process. Messages are JSON lines {"kind", "worker", ...fields},
+    the broker relays every line to all the other workers.
+
+    When the connection to the broker is lost the handler gets a "broker_lost" message,
+    messages published until the reconnect are dropped. The connection is retried with
+    a backoff of reconnect_min doubling up to reconnect_max seconds, the handler then
+    gets a "reconnected" message.
+    """
+    def __init__(self, path, worker_id, reconnect_min=0.5, reconnect_max=10):
+        self.path = path
+        self.worker_id = worker_id
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.reader = None
+        self.writer = None
+        self.handler = None
+        self.task = None
+        self.draining = None
+        self.published = 0
+        self.received = 0
+        self.reconnects = 0
+
+    async def start(self, handler):
+        self.handler = handler
+        await self.connect()
+        self.task = asyncio.create_task(self.run(), context=contextvars.Context())
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.publish("hello")
+
+    def publish(self, kind, **fields):
+        if self.writer is None or self.writer.is_closing():
+            return
+        fields["kind"] = kind
+        fields["worker"] = self.worker_id
+        self.writer.write(json.dumps(fields, default=_encode_default).encode() + b"\n")
+        self.published += 1
+        if self.draining is None:
+            self.draining = asyncio.create_task(self.drain(self.writer), context=contextvars.Context())
+
+    async def drain(self, writer):
+        # publish is called from synchronous code, the writes are flushed here
+        try:
+            await writer.drain()
+        except (ConnectionError, RuntimeError):
+            # a lost connection is noticed by run
+            pass
+        finally:
+            self.draining = None
+
+    def dispatch(self, message):
+        try:
+            self.handler(message)
+        except Exception as e:
+            print(f"Backplane: handling {str(message)[:200]!r} failed: {e}")
+
+    async def run(self):
+        while True:
+            try:
+                async for line in self.reader:
+                    self.received += 1
+                    try:
+                        message = json.loads(line)
+                    except ValueError:
+                        print(f"Backplane: malformed line {line[:200]!r}")
+                        continue
+                    self.dispatch(message)
+            except ConnectionError as e:
+                print(f"Backplane: lost the broker connection: {e}")
+            else:
+                print("Backplane: the broker closed the connection")
+            self.writer.close()
+            self.writer = None
+            self.dispatch({"kind": "broker_lost"})
+            await self.reconnect()
+
+    async def reconnect(self):
+        delay = self.reconnect_min
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.connect()
+            except OSError as e:
+                delay = min(delay * 2, self.reconnect_max)
+                print(f"Backplane: reconnecting failed, next try in {delay}s: {e}")
+                continue
+            self.reconnects += 1
+            print("Backplane: reconnected to the broker")
+            self.dispatch({"kind": "reconnected"})
+            return
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def stats(self):
+        return {"type": "unix", "worker": self.worker_id, "published": self.published, "received": self.received,
+                "reconnects": self.reconnects, "connected": self.writer is not None}
+
+class BackplaneBroker:
+    """
+    Runs in the parent process and relays the lines of each worker to all the others.
+    When a worker goes away the others get a worker_gone message.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.writers = {}  # writer -> worker id, None until its hello
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.serve, self.path)
+
+    async def serve(self, reader, writer):
+        self.writers[writer] = None
+        try:
+            async for line in reader:
+                if self.writers[writer] is None:
+                    self.writers[writer] = json.loads(line).get("worker")
+                self.relay(line, writer)
+        finally:
+            worker_id = self.writers.pop(writer)
+            writer.close()
+            if worker_id is not None:
+                self.relay(json.dumps({"kind": "worker_gone", "worker": worker_id}).encode() + b"\n", None)
+
+    def relay(self, line, sender):
+        for writer in self.writers:
+            if writer is not sender and not writer.is_closing():
+                writer.write(line)
+
+    async def stop(self):
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+        await self.server.wait_closed()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+# backplane message kind -> handler(message), filled by @backplane_handler
+backplane_handlers = {}
+backplane = LocalBackplane()
+# user_id -> ids of the other workers the user has sockets on
+remote_presence = {}
+# notification tasks started by backplane handlers
+backplane_tasks = set()
+
+def backplane_handler(kind):
+    def decorator(handler):
+        backplane_handlers[kind] = handler
+        return handler
+    return decorator
+
+def handle_backplane_message(message):
+    handler = backplane_handlers.get(message.get("kind"))
+    if handler is None:
+        print(f"Backplane: unknown message kind {message.get('kind')!r}")
+        return
+    handler(message)
+
+def start_backplane_task(coro):
+    task = asyncio.create_task(coro, context=contextvars.Context())
+    backplane_tasks.add(task)
+    task.add_done_callback(backplane_tasks.discard)
+
+@backplane_handler("hello")
+@backplane_handler("reconnected")
+def on_backplane_hello(message):
+    # a worker (re)started or this one is back on the broker, tell them who is online here
+    backplane.publish("presence_snapshot", user_ids=list(user_connections))
+
+@backplane_handler("broker_lost")
+def on_broker_lost(message):
+    # the other workers are out of reach, their snapshots come back after the reconnect
+    for user_id, workers in list(remote_presence.items()):
+        for worker in list(workers):
+            on_presence({"user_id": user_id, "online": False, "worker": worker})
+
+@backplane_handler("presence_snapshot")
+def on_presence_snapshot(message):
+    for user_id in message["user_ids"]:
+        on_presence({"user_id": user_id, "online": True, "worker": message["worker"]})
+
+@backplane_handler("presence")
+def on_presence(message):
+    user_id = message["user_id"]
+    was_online = isUserOnline(user_id)
+    if message["online"]:
+        remote_presence.setdefault(user_id, set()).add(message["worker"])
+    else:
+        workers = remote_presence.get(user_id)
+        if workers is not None:
+            workers.discard(message["worker"])
+            if not workers:
+                del remote_presence[user_id]
+    if isUserOnline(user_id) != was_online:
+        presence_notifier.changed(user_id, not was_online)
+
+@backplane_handler("worker_gone")
+def on_worker_gone(message):
+    for user_id in list(remote_presence):
+        on_presence({"user_id": user_id, "online": False, "worker": message["worker"]})
+
+def fallback_worker(user_id):
+    # the one worker that sends the push when a delivered user turns out to be gone
+    return min(remote_presence[user_id])
+
+@backplane_handler("deliver")
+def on_deliver(message):
+    # relayed to every worker, those with sockets of the users write to them
+    sockets = []
+    missing = []
+    for user_id, worker in zip(message["user_ids"], message["fallback_workers"]):
+        user_sockets = get_user_connections(user_id)
+        if user_sockets:
+            sockets.extend(user_sockets)
+        elif worker == backplane.worker_id and not isUserOnline(user_id):
+            missing.append(user_id)
+    broadcast_message(message["message"], sockets)
+    # the users left this worker meanwhile, fall back to a push like the sender would have
+    if missing and message.get("room_id") is not None:
+        start_backplane_task(send_room_notifications(pool, missing, message["organization_id"], "New Message", "A new chat message is sent to you", message["room_id"]))
+    elif missing and message.get("title") is not None:
+        for user_id in missing:
+            start_backplane_task(send_general_notifcation_message(pool, user_id, message["organization_id"], message["title"], message["body"], message["message"]))
+
+@backplane_handler("message_stored")
+def on_message_stored(message):
+    room_id, msg = message["room_id"], message["msg"]
+    key = history_cache.key(room_id, message["organization_id"])
+    room = history_cache.rooms.get(key)
+    cached = False
+    if room is not None and room.messages and room.messages[-1]["id"] >= msg["id"]:
+        # already there when this worker refilled the room after the sender committed
+        cached = any(row["id"] == msg["id"] for row in room.messages)
+        if not cached:
+            # arrived after a newer message, refill rather than keep the buffer out of order
+            history_cache.discard(key)
+    if not cached:
+        history_cache.append(room_id, message["organization_id"], msg)
+    entry = room_members_cache.get(room_id)
+    if entry is None:
+        unread_counters.forget_room(room_id)
+    else:
+        unread_counters.message_sent(room_id, msg["id"], entry[0] - {msg["user_id"]})
+
+@backplane_handler("message_edited")
+def on_message_edited(message):
+    history_cache.edit(message["room_id"], message["organization_id"], message["msg_id"], message["message"], message["msginfo"])
+
+@backplane_handler("message_deleted")
+def on_message_deleted(message):
+    history_cache.remove(message["room_id"], message["organization_id"], message["msg_id"])
+    unread_counters.forget_room(message["room_id"])
+
+@backplane_handler("message_seen")
+def on_message_seen(message):
+    unread_counters.message_seen(message["room_id"], message["user_id"], message["msg_id"])
+
+@backplane_handler("last_seen_cleared")
+def on_last_seen_cleared(message):
+    unread_counters.forget_user(message["room_id"], message["user_id"])
+
+@backplane_handler("member_left")
+def on_member_left(message):
+    room_members_cache.discard_member(message["room_id"], message["user_id"])
+    unread_counters.forget_user(message["room_id"], message["user_id"])
+
+@backplane_handler("notified")
+def on_notified(message):
+    sent_at = datetime.fromisoformat(message["sent_at"])
+    for user_id in message["user_ids"]:
+        notification_cooldowns.record(message["organization_id"], user_id, sent_at)
+
+@backplane_handler("user_changed")
+def on_user_changed(message):
+    identity_cache.invalidate(message["user_id"])
+
+@backplane_handler("room_changed")
+def on_room_changed(message):
+    room_members_cache.invalidate(message["room_id"])
+    unread_counters.forget_room(message["room_id"])
+
+class PresenceNotifier:
+    """
+    Pushes online/offline changes to the sockets that subscribed to a user. Changes
+    are collected for window seconds and only pushed when the state at the end of
+    the window differs from the state before it, so a reconnecting client is not
+    reported at all. Each subscriber gets one "presence" frame per window.
+    """
+    def __init__(self, window=1.0):
+        self.window = window
+        self.watchers = {}  # user_id -> set of subscribed sockets
+        self.pending = {}  # user_id -> online state before the window
+        self.timer = None
+        self.pushed = 0
+        self.coalesced = 0
+
+    def subscribe(self, websocket, subscriptions, user_ids):
+        for user_id in user_ids:
+            if user_id not in subscriptions and len(subscriptions) < PRESENCE_MAX_SUBSCRIPTIONS:
+                subscriptions.add(user_id)
+                self.watchers.setdefault(user_id, set()).add(websocket)
+
+    def unsubscribe(self, websocket, subscriptions, user_ids=None):
+        for user_id in list(subscriptions if user_ids is None else user_ids):
+            if user_id not in subscriptions:
+                continue
+            subscriptions.discard(user_id)
+            sockets = self.watchers.get(user_id)
+            if sockets is not None:
+                sockets.discard(websocket)
+                if not sockets:
+                    del self.watchers[user_id]
+
+    def changed(self, user_id, online):
+        # online is the new state of the user on this worker or another one
+        if user_id not in self.watchers:
+            return
+        if user_id not in self.pending:
+            self.pending[user_id] = not online
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        self.timer = None
+        pending, self.pending = self.pending, {}
+        changes = {}  # socket -> list of changes
+        for user_id, was_online in pending.items():
+            online = isUserOnline(user_id)
+            if online == was_online:
+                self.coalesced += 1
+                continue
+            for websocket in self.watchers.get(user_id, ()):
+                changes.setdefault(websocket, []).append({"user_id": user_id, "online": online})
+        for websocket, data in changes.items():
+            self.pushed += 1
+            broadcast_message({"event": "presence", "data": data}, [websocket])
+
+    def stats(self):
+        return {
+            "watched_users": len(self.watchers),
+            "pending": len(self.pending),
+            "pushed": self.pushed,
+            "coalesced": self.coalesced,
+        }
+
+presence_notifier = PresenceNotifier(getattr(config, "PRESENCE_DEBOUNCE_SECONDS", 1.0))
+
+class Session:
+    """
+    State of one socket, in connected_clients. The registration fields are set by
+    Register, inflight and pipelined when the client first pipelines a request.
+    """
+    __slots__ = ("client_ip", "registered", "user_id", "username", "organization_id", "session_token",
+                 "presence", "room_tails", "inflight", "pipelined", "connected_at", "last_activity", "timer_slot")
+
+    def __init__(self, client_ip):
+        self.client_ip = client_ip
+        self.connected_at = self.last_activity = time.monotonic()
+        self.timer_slot = None  # see IdleSweeper
+        self.registered = False
+        self.user_id = None
+        self.username = None
+        self.organization_id = None
+        self.session_token = None
+        self.presence = None  # user ids watched through SubscribePresence
+        self.room_tails = {}  # see take_room_turn
+        self.inflight = None
+        self.pipelined = None
+
+class IdleSweeper:
+    """
+    Closes the sockets that did not register within register_timeout seconds and, when
+    idle_timeout is set, the registered ones that sent no frame for that long.
+
+    Sockets wait in a timer wheel of tick second slots, in the slot of their deadline,
+    so a tick only looks at the sockets of one slot. Activity only moves the deadline
+    in the Session; a socket found in its slot before its deadline goes to the slot of
+    the new one. Sockets with no deadline are not in the wheel, protocol pings reap those.
+    """
+    def __init__(self, register_timeout=30, idle_timeout=None, tick=1.0, slots=256):
+        self.register_timeout = register_timeout
+        self.idle_timeout = idle_timeout
+        self.tick = tick
+        self.wheel = [set() for _ in range(slots)]
+        self.current = int(time.monotonic() / tick)  # last tick swept
+        self.task = None
+        self.closing = set()
+        self.reaped = {"register_timeout": 0, "idle_timeout": 0, "ping_timeout": 0, "stale": 0}
+
+    def deadline(self, session):
+        if not session.registered:
+            return session.connected_at + self.register_timeout if self.register_timeout else None
+        if self.idle_timeout:
+            return session.last_activity + self.idle_timeout
+        return None
+
+    def schedule(self, websocket, session):
+        # (re)places a socket by the deadline of its session, call after registration too
+        self.forget(websocket, session)
+        deadline = self.deadline(session)
+        if deadline is None:
+            return
+        # never in the slot being swept
+        slot = max(int(deadline / self.tick), self.current + 1) % len(self.wheel)
+        self.wheel[slot].add(websocket)
+        session.timer_slot = slot
+
+    def forget(self, websocket, session):
+        if session.timer_slot is not None:
+            self.wheel[session.timer_slot].discard(websocket)
+            session.timer_slot = None
+
+    def sweep(self, now):
+        while self.current < int(now / self.tick):
+            self.current += 1
+            index = self.current % len(self.wheel)
+            due, self.wheel[index] = self.wheel[index], set()
+            for websocket in due:
+                session = connected_clients.get(websocket)
+                if session is None:
+                    continue
+                session.timer_slot = None
+                deadline = self.deadline(session)
+                if deadline is None:
+                    continue
+                if deadline > now:
+                    self.schedule(websocket, session)
+                    continue
+                self.reap(websocket, session, "idle_timeout" if session.registered else "register_timeout")
+
+    def reap(self, websocket, session, reason):
+        if websocket.state is State.CLOSED:
+            # the connection is gone but its handler did not clean up
+            self.reaped["stale"] += 1
+            unregister_connection(websocket)
+            if session.presence:
+                presence_notifier.unsubscribe(websocket, session.presence)
+            connected_clients.pop(websocket, None)
+            return
+        self.reaped[reason] += 1
+        # ws_handler removes the socket once the close completes
+        task = asyncio.create_task(websocket.close(CLOSE_TIMEOUT_CODE, reason.replace("_", " ")), context=contextvars.Context())
+        self.closing.add(task)
+        task.add_done_callback(self.closing.discard)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.sweep(time.monotonic())
+
+    def start(self):
+        self.current = int(time.monotonic() / self.tick)
+        self.task = asyncio.create_task(self.run(), context=contextvars.Context())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def stats(self):
+        return dict(self.reaped, watched=sum(len(slot) for slot in self.wheel))
+
+idle_sweeper = IdleSweeper(REGISTER_TIMEOUT, IDLE_TIMEOUT)
+
+# organization_id -> the one int object shared by the sessions of the organization
+organization_ids = {}
+
+def intern_organization_id(organization_id):
+    return organization_ids.setdefault(organization_id, organization_id)
+
+def register_connection( websocket, user_id, organization_id ):
+    # a socket may register again with another user, drop the old entries first
+    unregister_connection( websocket )
+    if user_id not in user_connections:
+        backplane.publish("presence", user_id=user_id, online=True)
+        if user_id not in remote_presence:
+            presence_notifier.changed(user_id, True)
+    user_connections.setdefault(user_id, set()).add(websocket)
+    organization_connections.setdefault(organization_id, set()).add(websocket)
+
+def unregister_connection( websocket ):
+    session = connected_clients.get(websocket)
+    if session is None or not session.registered:
+        return
+    for index, key in ((user_connections, session.user_id), (organization_connections, session.organization_id)):
+        sockets = index.get(key)
+        if sockets is None:
+            continue
+        sockets.discard(websocket)
+        if not sockets:
+            del index[key]
+            if index is user_connections:
+                backplane.publish("presence", user_id=key, online=False)
+                if key not in remote_presence:
+                    presence_notifier.changed(key, False)
+
+def get_user_connections( user_id ):
+    return user_connections.get(user_id, ())
 
 def isUserOnline( user_id ):
-    for ws, info in connected_clients.items():
-        if info.get("user_id") == user_id :
-            return True
-    return False
+    # on this worker or on any other
+    return user_id in user_connections or user_id in remote_presence
+
+def broadcast_message( message, sockets ):
+    # The payload is encoded once per codec in use and written to every open transport
+    # without awaiting each send. Returns the number of sockets skipped because they were closed.
+    by_codec = {}
+    skipped = 0
+    for ws in sockets:
+        if ws.state is State.OPEN:
+            by_codec.setdefault(get_codec(ws), []).append(ws)
+        else:
+            skipped += 1
+    for codec, open_sockets in by_codec.items():
+        websockets.broadcast(open_sockets, codec.encode(message), text=codec.text)
+    return skipped
 
 async def send_general_notification_msg_to_users( pool, message, user_id, organization_id, msg_title, msg_body ):
-    tasks = []
-    found = False
     print(f"   -->>    In function send_general_notification_msg_to_users {user_id} ")
-    for ws, info in connected_clients.items():
-        ws_user_id = info.get("user_id")
-        if(user_id == ws_user_id) :
-            found = True
-            tasks.append(ws.send(message))
-            break
-
-    if found == False:
+    sockets = list(get_user_connections(user_id))
+    if user_id in remote_presence:
+        # devices on other workers, besides the ones here
+        print(f"   -->>    sending to {user_id} is online on another worker")
+        backplane.publish("deliver", user_ids=[user_id], fallback_workers=[fallback_worker(user_id)], message=message,
+                          organization_id=organization_id, title=msg_title, body=msg_body)
+        if not sockets:
+            return 0
+    if not sockets:
         print(f"    -->>   sending to {user_id} is offline using firebase")
         await send_general_notifcation_message( pool, user_id, organization_id, msg_title, msg_body, message ) 
-    if tasks:
-        print(f"   -->>    sending to {user_id} is online - using websockets")
-        await asyncio.gather(*tasks, return_exceptions=True)
+        return 0
+    print(f"   -->>    sending to {user_id} is online - using websockets")
+    return broadcast_message(message, sockets)
 
 async def send_msg_to_users( pool, message, user_ids, organization_id, room_id ):
-    tasks = []
+    sockets = []
+    remote_user_ids = []
+    offline_user_ids = []
     for user_id in user_ids:
-        found = False
-        for ws, info in connected_clients.items():
-            ws_user_id = info.get("user_id")
-            if(user_id == ws_user_id) :
-                found = True
-                tasks.append(ws.send(message))
-                break
-        if found == False:
-            if await can_send_message(pool, user_id, organization_id, room_id ):
-                await send_notifcation_message( pool, user_id, organization_id, "New Message", "A new chat message is sent to you", room_id )
-    if tasks:
-        await asyncio.gather(*tasks, return_exceptions=True)
+        user_sockets = get_user_connections(user_id)
+        if user_sockets:
+            sockets.extend(user_sockets)
+        # a user may have devices here and on other workers
+        if user_id in remote_presence:
+            remote_user_ids.append(user_id)
+        elif not user_sockets:
+            offline_user_ids.append(user_id)
+
+    if remote_user_ids:
+        backplane.publish("deliver", user_ids=remote_user_ids, fallback_workers=[fallback_worker(user_id) for user_id in remote_user_ids],
+                          message=message, organization_id=organization_id, room_id=room_id)
+    skipped = broadcast_message(message, sockets)
+    if skipped:
+        print(f"send_msg_to_users: skipped {skipped} closed sockets in room {room_id}")
+
+    await send_room_notifications( pool, offline_user_ids, organization_id, "New Message", "A new chat message is sent to you", room_id )
+    return skipped
+
+# event name -> EventHandler, filled by register_event / @event_handler
+event_handlers = {}
+# event name -> {"count", "errors", "total_time", "max_time"}
+event_stats = {}
+# name -> callable returning a dict, reported by GetServerStats
+stats_sources = {
+    "room_members_cache": lambda: room_members_cache.stats(),
+    "history_cache": lambda: history_cache.stats(),
+    "identity_cache": lambda: identity_cache.stats(),
+    "unread_counters": lambda: unread_counters.stats(),
+    "last_seen_buffer": lambda: last_seen_buffer.stats(),
+    "message_writer": lambda: message_writer.stats(),
+    "connections": lambda: {"sockets": len(connected_clients), "users": len(user_connections), "remote_users": len(remote_presence)},
+    "backplane": lambda: backplane.stats(),
+    "presence": lambda: presence_notifier.stats(),
+    "sweeper": lambda: idle_sweeper.stats(),
+    "events": lambda: event_stats,
+    "startup": lambda: startup_timings,
+    "db_pool": lambda: dict(pool_stats, storage=storage.name if storage else None, size=pool.size if pool else 0, free=pool.freesize if pool else 0),
+}
+
+class EventHandler:
+    __slots__ = ("name", "handler", "auth", "limit", "semaphore")
+
+    def __init__(self, name, handler, auth=True, limit=None):
+        self.name = name
+        self.handler = handler
+        self.auth = auth
+        self.limit = limit
+        self.semaphore = None
+
+class EventRequest:
+    """
+    What an event handler gets: the socket, its Session, the decoded frame and
+    its "data" member. req_id is the optional client request id echoed in replies.
+    """
+    __slots__ = ("websocket", "session", "event", "content", "data", "req_id")
+
+    def __init__(self, websocket, session, event, content):
+        self.websocket = websocket
+        self.session = session
+        self.event = event
+        self.content = content
+        self.req_id = content.get("req_id")
+        data = content.get("data")
+        self.data = data if isinstance(data, dict) else {}
+
+def register_event(name, handler, auth=True, limit=None):
+    """
+    Registers the coroutine handler(request) for an event name.
+    :param auth: The client must be registered and send its session_token in data.
+    :param limit: Optional maximum number of concurrent runs of this event across all clients.
+    """
+    event_handlers[name] = EventHandler(name, handler, auth, limit)
+
+def event_handler(name, auth=True, limit=None):
+    def decorator(handler):
+        register_event(name, handler, auth, limit)
+        return handler
+    return decorator
+
+async def reply(request, payload):
+    if request.req_id is not None:
+        payload["req_id"] = request.req_id
+    codec = get_codec(request.websocket)
+    await request.websocket.send(codec.encode(payload), text=codec.text)
+
+async def dispatch_event(request):
+    entry = event_handlers.get(request.event)
+    session = request.session
+
+    if entry is None or (entry.auth and not session.registered):
+        print(f"{request.session.client_ip}: Event '{request.event}'")
+        if not session.registered:
+            print(f"{request.session.client_ip}: Client not registered yet")
+            await reply(request, {
+                "event":"register_error",
+                "data":"You must send a register event first"})
+        return
+
+    if entry.auth:
+        session_token = request.data.get('session_token')
+        if not session_token:
+            await reply(request, {
+                "error":"invalid token",
+                "data":"Session token is missing"
+            })
+            return
+        if session.session_token != session_token :
+            print(f"{request.session.client_ip}: invalid token Session token is invalid")
+            await reply(request, {
+                "error":"invalid token",
+                "data":"Session token is invalid"
+            })
+            return
+
+    stats = event_stats.get(entry.name)
+    if stats is None:
+        stats = event_stats[entry.name] = {"count": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0}
+    if entry.limit and entry.semaphore is None:
+        entry.semaphore = asyncio.Semaphore(entry.limit)
+
+    start = time.perf_counter()
+    try:
+        if entry.semaphore is not None:
+            await entry.semaphore.acquire()
+        try:
+            # nested queries of the event join the connection of the outer one
+            async with unit_of_work(pool):
+                await entry.handler(request)
+        finally:
+            if entry.semaphore is not None:
+                entry.semaphore.release()
+    except websockets.ConnectionClosed:
+        raise
+    except Exception as err:
+        stats["errors"] += 1
+        print(f"WebSocket error in '{entry.name}': {err}")
+    finally:
+        elapsed = time.perf_counter() - start
+        stats["count"] += 1
+        stats["total_time"] += elapsed
+        if elapsed > stats["max_time"]:
+            stats["max_time"] = elapsed
+
+#resgiter client # Param are: username, token
+@event_handler("Register", auth=False)
+async def handle_register(request):
+    session = request.session
+    username = request.content.get("username")
+    token = request.content.get("token")
+    print(f"{request.session.client_ip}: user_id '{username}'")
+    user = await check_user(username, token)
+    if user == None :
+        await reply(request, {
+            "event":"register_error",
+            "data":"invalid user"})
+        return
+
+    register_connection(request.websocket, user['id'], user["organization_id"])
+    session.session_token = secrets.token_urlsafe(32)
+    session.organization_id = intern_organization_id(user["organization_id"])
+    session.registered = True
+    session.user_id = user['id']
+    session.username = sys.intern(user['username']) if user['username'] else user['username']
+    idle_sweeper.schedule(request.websocket, session)
+
+    await reply(request, {
+        "event":"register_success",
+        "data":session.session_token})
+
+## send notifications to clients
+@event_handler("notification")
+async def handle_notification(request):
+    content = request.content
+    session = request.session
+    data = request.data
+    organization_id = content.get("organization_id")
+    if organization_id is None:
+        print(f"{request.session.client_ip}: invalid organization id")
+        await reply(request, {
+            "error":"invalid organization id",
+            "data":"organization id is missing"
+        })
+        return
+
+    org_id = session.organization_id
+    if int(org_id) > 0 and int(org_id) != int(organization_id) :
+        print(f"{request.session.client_ip}: invalid organization id does not match client organization id")
+        await reply(request, {
+            "error":"invalid organization id",
+            "data":"invalid organization id"
+        })
+        return
+
+    username = content.get("username")
+    user_id = await get_user_id_using_username(pool, username, organization_id)
+    if user_id != None:
+        msg_title = content.get("title")
+        msg_body = content.get("body")
+        notification_message = {
+            "event": "notification",
+            "data": {
+                "title": msg_title,
+                "body": msg_body,
+                "message": data['notification'],
+            }
+        }
+        await send_general_notification_msg_to_users(pool, notification_message, user_id, organization_id, msg_title, msg_body)
+        await reply(request, {
+            "event":"notification_success",
+            })
+    else :
+        print(f"{request.session.client_ip}: username is not found")
+        await reply(request, {
+            "event":"notification_failed",
+            "data":"username is not found"})
+
+## get list of rooms  param: session_token
+@event_handler("GetRooms")
+async def handle_get_rooms(request):
+    rooms = await get_user_rooms(pool, request.session.user_id)
+    if rooms == None :
+        await reply(request, {
+            "event":"get_rooms_failed",
+            "data":"User not registered in any rooms"})
+    else : 
+        await reply(request, {
+            "event": "get_rooms",
+            "data": rooms 
+            })
+
+## create a rooms param: session_token, name, users, description, type(optional: group/direct)
+@event_handler("UpdateOrMakeRoom")
+async def handle_update_or_make_room(request):
+    data = request.data
+    session = request.session
+    user_id = session.user_id
+    room_name = data["name"]
+    user_names = data["users"]
+    description = data["description"]
+    requested_room_type = data.get("type")
+    org_id = session.organization_id
+    room_id, room_type = await create_or_update_room(
+        pool, user_id, room_name, user_names, description, org_id, requested_room_type
+    )
+    if room_id == None: 
+        await reply(request, {
+            "event":"update_or_make_room",
+            "data":{ 
+                "room": room_id,
+                "type": room_type,
+                "status": "failed",
+                "msg":"Failed to create a room"
+                }
+            })
+    else:
+        await reply(request, {
+            "event":"update_or_make_room",
+            "data":{
+                "room": room_id,
+                "name": room_name,
+                "type": room_type,
+                "status": "success"
+                }
+            })
+
+## get the users in a room -- param: session_token, room id
+@event_handler("GetUsersInRoom")
+async def handle_get_users_in_room(request):
+    room_id = request.data['room']
+    owners = await get_room_owner(pool, room_id)
+    users = await get_user_names_in_room( pool, room_id )
+    await reply(request, {
+        "event":"room_users",
+        "room":room_id,
+        "users":users or [],
+        "owners":owners or []
+    })
+
+## leave room -- param: session_token, room id
+@event_handler("LeaveRoom")
+async def handle_leave_room(request):
+    user_id = request.session.user_id
+    res = await leave_room( pool, request.data['room'], user_id )
+    if( res == True ) :
+        await reply(request, {
+            "event":"leave_room_success",
+        })
+    else : 
+        await reply(request, {
+            "event":"leave_room_failed",
+        })
+
+## silent room notifications -- param: session_token, room id
+@event_handler("SilentRoom")
+async def handle_silent_room(request):
+    user_id = request.session.user_id
+    res = await silent_room( pool, request.data['room'], user_id )
+    if( res == True ) :
+        await reply(request, {
+            "event":"silent_room_success",
+        })
+    else : 
+        await reply(request, {
+            "event":"silent_room_failed",
+        })
+
+## unsilent room notifications -- param: session_token, room id
+@event_handler("UnSilentRoom")
+async def handle_unsilent_room(request):
+    user_id = request.session.user_id
+    res = await unsilent_room( pool, request.data['room'], user_id )
+    if( res == True ) :
+        await reply(request, {
+            "event":"unsilent_room_success",
+        })
+    else : 
+        await reply(request, {
+            "event":"unsilent_room_failed",
+        })
+
+## Clear the last seen -- param: session_token, room id
+@event_handler("ClearLastMessageSeen")
+async def handle_clear_last_message_seen(request):
+    room_id = request.data['room']
+    user_id = request.session.user_id
+    await clear_user_last_seen_msg( pool, user_id, room_id )
+    await reply(request, {
+            "event":"cleared_last_seen_msgs",
+            "data":""
+        })
+
+## Get all msgs in room after specific msg --- param: session_token, room id, last msg seen
+@event_handler("GetMessagesInRoom")
+async def handle_get_messages_in_room(request):
+    data = request.data
+    session = request.session
+    room_id = data['room']
+    last_id = data['last_id']
+    user_id = session.user_id
+    organization_id = session.organization_id
+
+    msgs = await get_messages_in_room( pool, user_id, room_id, organization_id, last_id )
+    await reply(request, {
+            "event":"messages_in_room",
+            "data": msgs
+        })
+
+## Get all msgs in room before a specific msg --- param: session_token, room id, last msg seen
+@event_handler("GetPrevMessagesInRoom")
+async def handle_get_prev_messages_in_room(request):
+    data = request.data
+    session = request.session
+    room_id = data['room']
+    last_id = data['last_id']
+    user_id = session.user_id
+    organization_id = session.organization_id
+    msgs = await get_prev_messages_in_room( pool, user_id, room_id, organization_id, last_id )
+    await reply(request, {
+            "event":"prev_messages_in_room",
+            "data": msgs
+        })
+
+## Page through the history of a room --- param: session_token, room id, cursor(optional), direction(optional: backward/forward), limit(optional)
+@event_handler("GetHistory")
+async def handle_get_history(request):
+    data = request.data
+    room_id = data['room']
+    direction = data.get("direction") or "backward"
+    if direction not in ("backward", "forward"):
+        await reply(request, {
+            "event":"history",
+            "room": room_id,
+            "error":"direction must be backward or forward"})
+        return
+    try:
+        limit = int(data.get("limit") or HISTORY_PAGE_SIZE)
+    except (TypeError, ValueError):
+        await reply(request, {
+            "event":"history",
+            "room": room_id,
+            "error":"limit must be an integer"})
+        return
+    try:
+        msgs, next_cursor = await get_history(
+            pool, room_id, request.session.organization_id,
+            data.get("cursor"), direction, limit,
+        )
+    except ValueError as e:
+        await reply(request, {
+            "event":"history",
+            "room": room_id,
+            "error": str(e)})
+        return
+    await reply(request, {
+            "event":"history",
+            "room": room_id,
+            "direction": direction,
+            "data": msgs,
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None,
+        })
+
+## Get the last messages in a room --- param: session_token, room id, last msg seen
+@event_handler("GetLastMessagesInRoom")
+async def handle_get_last_messages_in_room(request):
+    session = request.session
+    room_id = request.data['room']
+    user_id = session.user_id
+    organization_id = session.organization_id
+
+    msgs = await get_last_messages_in_room( pool, user_id, room_id, organization_id )
+    await reply(request, {
+            "event":"last_messages_in_room",
+            "data": msgs
+        })
+
+## delete msg in room --- param: session_token, room id, msg_id
+@event_handler("DeleteMessageInRoom")
+async def handle_delete_message_in_room(request):
+    data = request.data
+    session = request.session
+    room_id = data['room']
+    user_id = session.user_id
+    msg_id = data['msg_id']
+    organization_id = session.organization_id
+
+    res = await delete_message_in_room( pool, user_id, room_id, msg_id, organization_id )
+    await reply(request, {
+            "event":"delete_messages_in_room",
+            "success": res
+        })
+
+## edit msg in room --- param: session_token, room id, msg_id
+@event_handler("EditMessageInRoom")
+async def handle_edit_message_in_room(request):
+    data = request.data
+    session = request.session
+    room_id = data['room']
+    user_id = session.user_id
+    msg_id = data['msg_id']
+    organization_id = session.organization_id
+    msg = data['message']
+    info = data['msginfo']
+
+    result = await edit_message_in_room( pool, user_id, msg_id, msg, info, room_id, organization_id )
+    if(result > 0 ) :
+        await reply(request, {
+                "event":"edit_message_in_room",
+                "data": result
+            })
+        
+        user_ids = await get_users_in_room( pool, room_id )
+
+        #broadcast it to online users
+        broadcast_data = {
+            "event": "chat_message_updated",
+            "data": {
+                "username": session.username,
+                'msgid': msg_id,
+                "room":room_id,
+                "message": data['message'],
+                "msginfo": data['msginfo'],
+            }
+        }
+        await send_msg_to_users( pool, broadcast_data, user_ids, organization_id, room_id )
+
+    else :
+        await reply(request, {
+                "event":"edit_message_in_room",
+                "data": "failed"
+            })
+
+@event_handler("Ping")
+async def handle_ping(request):
+    await reply(request, {
+        "event":"ping_response",
+        "status": True,
+        "user_id": request.session.user_id
+        })
+
+@event_handler("GetUserStatus")
+async def handle_get_user_status(request):
+    user_id = request.session.user_id
+    await reply(request, {
+        "event":"user_status_response",
+        "user_id": user_id,
+        "status": isUserOnline(user_id),
+        })
+
+async def resolve_presence_targets(pool, session, data):
+    """
+    :return: ids of the users a client may watch out of data["rooms"] (rooms it is a
+    member of) and data["users"] (users of its organization, any for organization 0).
+    """
+    user_ids = set()
+    for room_id in data.get("rooms") or []:
+        members, organization_id = await get_room_members(pool, room_id)
+        if session.user_id in members:
+            user_ids.update(members)
+    requested = [user_id for user_id in data.get("users") or [] if isinstance(user_id, int)]
+    if requested and int(session.organization_id) == 0:
+        user_ids.update(requested)
+    elif requested:
+        user_ids.update(await storage.get_organization_users(session.organization_id, requested))
+    user_ids.discard(session.user_id)
+    return user_ids
+
+## watch the presence of room members and users -- param: session_token, rooms, users
+## replies with their current state, changes are pushed as "presence" events
+@event_handler("SubscribePresence")
+async def handle_subscribe_presence(request):
+    session = request.session
+    user_ids = await resolve_presence_targets(pool, session, request.data)
+    if session.presence is None:
+        session.presence = set()
+    subscriptions = session.presence
+    presence_notifier.subscribe(request.websocket, subscriptions, user_ids)
+    await reply(request, {
+        "event":"presence_subscribed",
+        "data": [{"user_id": user_id, "online": isUserOnline(user_id)} for user_id in user_ids if user_id in subscriptions],
+        })
+
+## stop watching -- param: session_token, users (optional, all when missing)
+@event_handler("UnsubscribePresence")
+async def handle_unsubscribe_presence(request):
+    subscriptions = request.session.presence
+    if subscriptions:
+        presence_notifier.unsubscribe(request.websocket, subscriptions, request.data.get("users"))
+    await reply(request, {
+        "event":"presence_unsubscribed",
+        })
+
+## got the event and payload
+@event_handler("LastSeenMsg")
+async def handle_last_seen_msg(request):
+    data = request.data
+    session = request.session
+    room_id = data['room']
+    user_id = session.user_id
+    msg_id = data['msg_id']
+    organization_id = session.organization_id
+    result = await update_last_seen_msg_in_room( pool, user_id, room_id, msg_id, organization_id )
+    await reply(request, {
+        "event":"update_last_seen_msg_in_room",
+        "status": result
+    })
+
+## got the event and payload
+@event_handler("BroadcastMessage")
+async def handle_broadcast_message(request):
+    data = request.data
+    session = request.session
+    user_id = session.user_id
+    organization_id = session.organization_id
+    room_id = data['room']
+    user_ids = await get_users_in_room( pool, room_id )
+    print(f"{user_id}: Got BroadcastMessage ")
+
+    if user_id in user_ids:
+        user_ids.remove(user_id)
+    else:
+        await reply(request, {
+            "event":"broadcast_message_response",
+            "status": False
+        })
+        return
+
+    #store the msg for offline users
+    id = await store_new_message(pool, user_id, data['message'], data['msginfo'], room_id, session.organization_id, session.username)
+
+    #broadcast it to online users
+    broadcast_data = {
+        "event": "chat_message",
+        "data": {
+            "username": session.username,
+            'msgid': id,
+            "room":room_id,
+            "message": data['message'],
+            "msginfo": data['msginfo'],
+        }
+    }
+    unread_counters.message_sent(room_id, id, user_ids)
+    await send_msg_to_users( pool, broadcast_data, user_ids, organization_id, room_id )
+
+    await reply(request, {
+            "event":"broadcast_message_response",
+            "status": True,
+            "msgid": id
+        })
+
+## server counters, only for organization 0 (service) clients --- param: session_token
+@event_handler("GetServerStats")
+async def handle_get_server_stats(request):
+    if int(request.session.organization_id) != 0:
+        await reply(request, {
+            "event":"server_stats",
+            "error":"not allowed"})
+        return
+    await reply(request, {
+        "event":"server_stats",
+        "data": {name: source() for name, source in stats_sources.items()}
+        })
+
+def take_room_turn(request, room_tails):
+    """
+    Queues an event behind the earlier events of the same connection and room, so writes
+    to a room keep the order in which the client sent them. Must be called in frame order.
+    :param room_tails: per connection dict of room -> future of the last event queued for it.
+    :return: the turn to pass to run_event, None when the event is not about a room.
+    """
+    room = request.data.get("room")
+    if room is None:
+        return None
+    room = id_key(room)
+    previous = room_tails.get(room)
+    done = asyncio.get_running_loop().create_future()
+    room_tails[room] = done
+    return room, previous, done
+
+async def run_event(request, turn, room_tails):
+    if turn is None:
+        await dispatch_event(request)
+        return
+
+    room, previous, done = turn
+    try:
+        if previous is not None:
+            await asyncio.shield(previous)
+        await dispatch_event(request)
+    finally:
+        done.set_result(None)
+        if room_tails.get(room) is done:
+            del room_tails[room]
+
+async def run_pipelined_event(request, turn, room_tails, inflight):
+    try:
+        await run_event(request, turn, room_tails)
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        inflight.release()
 
 # WebSocket server
 async def ws_handler( websocket ):
-    global pool
-
-    connected_clients[websocket] = {"registered": False, "user": None}
-    registered = False
-    
     # Prefer proxy-provided client IPs when behind nginx.
     headers = None
     if hasattr(websocket, "request_headers"):
@@ -836,583 +3731,163 @@ async def ws_handler( websocket ):
         client_ip = forwarded_for.split(",")[0].strip()
     else:
         client_ip = headers.get("X-Real-IP") if headers else None
-    client_ip = client_ip or websocket.remote_address[0]
+    client_ip = sys.intern(client_ip or websocket.remote_address[0])
     client_port = websocket.remote_address[1]
-    print(f"{client_ip}:{client_port}: New socket connection")
+    session = connected_clients[websocket] = Session(client_ip)
+    idle_sweeper.schedule(websocket, session)
+    codec = get_codec(websocket)
+    print(f"{client_ip}:{client_port}: New socket connection ({codec.label})")
 
     try:
         async for message in websocket:
+            session.last_activity = time.monotonic()
             try:
                 print(f"Got message {message}")
-                theMessageContent = json.loads(message)
-            except json.JSONDecodeError:
-                await websocket.send(json.dumps({"error": "Invalid JSON"}))
+                theMessageContent = codec.decode(message)
+            except ValueError:
+                await websocket.send(codec.encode({"error": f"Invalid {codec.label}"}), text=codec.text)
+                continue
+            if not isinstance(theMessageContent, dict):
+                await websocket.send(codec.encode({"error": f"Invalid {codec.label}"}), text=codec.text)
                 continue
 
-            try:
-                client_info =connected_clients[websocket]
-                event = theMessageContent.get("event")
-                print(f"Request Event from {client_ip} '{event}'")
-
-                #resgiter client # Param are: user_id
-                if not client_info["registered"]:
-                    event = theMessageContent.get("event")
-                    if event=="Register" :
-                        print(f"{client_ip}: Event '{event}'")
-                        username = theMessageContent.get("username")
-                        token = theMessageContent.get("token")
-                        print(f"{client_ip}: user_id '{username}'")
-                        user = await check_user(username, token)
-                        if user == None :
-                            await websocket.send(json.dumps({
-                                "event":"register_error",
-                                "data":"invalid user"}))
-                            continue
-
-                        client_info["session_token"] = secrets.token_urlsafe(32)
-                        client_info["organization_id"] = user["organization_id"]
-                        client_info["registered"] = True
-                        client_info["user_id"] = user['id']
-                        client_info["username"] = user['username']
-
-                        await websocket.send( json.dumps({
-                            "event":"register_success",
-                            "data":client_info['session_token']}))
-                    else:
-                        print(f"{client_ip}: Event '{event}'")
-                        print(f"{client_ip}: Client not registered yet")
-                        await websocket.send(json.dumps({
-                            "event":"register_error",
-                            "data":"You must send a register event first"}))                
-                    continue
-
-                ## send notifications to clients
-                if event == "notification":
-                    data = theMessageContent.get("data") or {}
-                    session_token = data.get('session_token')
-                    if client_info['session_token'] != session_token :
-                        print(f"{client_ip}: invalid token Session token is invalid")
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-
-                    organization_id = theMessageContent.get("organization_id")
-                    if organization_id is None:
-                        print(f"{client_ip}: invalid organization id")
-                        await websocket.send(json.dumps({
-                            "error":"invalid organization id",
-                            "data":"organization id is missing"
-                        }))
-                        continue
-
-                    org_id = client_info['organization_id']
-                    if int(org_id) > 0 and int(org_id) != int(organization_id) :
-                        print(f"{client_ip}: invalid organization id does not match client organization id")
-                        await websocket.send(json.dumps({
-                            "error":"invalid organization id",
-                            "data":"invalid organization id"
-                        }))
-                        continue
-
-                    username = theMessageContent.get("username")
-                    user_id = await get_user_id_using_username(pool, username, organization_id)
-                    if user_id != None:
-                        msg_title = theMessageContent.get("title")
-                        msg_body = theMessageContent.get("body")
-                        if isinstance(data, dict) and "notification" in data:
-                            payload = data["notification"]
-                        else:
-                            payload = data if isinstance(data, str) else json.dumps(data)
-                        
-                        notification_message = json.dumps({
-                            "event": "notification",
-                            "data": {
-                                "title": msg_title,
-                                "body": msg_body,
-                                "message": data['notification'],
-                            }
-                        })
-                        await send_general_notification_msg_to_users(pool, notification_message, user_id, organization_id, msg_title, msg_body)
-                        await websocket.send( json.dumps({
-                            "event":"notification_success",
-                            }))
-                    else :
-                        print(f"{client_ip}: username is not found")
-                        await websocket.send( json.dumps({
-                            "event":"notification_failed",
-                            "data":"username is not found"}))
-
-                ## get list of rooms  param: session_token
-                if event == "GetRooms":
-                    data = theMessageContent.get("data")
-                    session_token = data['session_token']
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-
-                    rooms = await get_user_rooms(pool, client_info['user_id'])
-                    if rooms == None :
-                        await websocket.send(json.dumps({
-                            "event":"get_rooms_failed",
-                            "data":"User not registered in any rooms"}))
-                    else : 
-                        await websocket.send(json.dumps({
-                            "event": "get_rooms",
-                            "data": rooms 
-                            }))
-                    continue
-
-                ## create a rooms param: session_token, name, users, description, type(optional: group/direct)
-                if event == "UpdateOrMakeRoom":
-                    data = theMessageContent.get("data")
-                    session_token = data['session_token']
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-
-                    user_id = client_info['user_id']
-                    room_name = data["name"]
-                    user_names = data["users"]
-                    description = data["description"]
-                    requested_room_type = data.get("type")
-                    org_id = client_info['organization_id']
-                    room_id, room_type = await create_or_update_room(
-                        pool, user_id, room_name, user_names, description, org_id, requested_room_type
-                    )
-                    if room_id == None: 
-                        await websocket.send(json.dumps({
-                            "event":"update_or_make_room",
-                            "data":{ 
-                                "room": room_id,
-                                "type": room_type,
-                                "status": "failed",
-                                "msg":"Failed to create a room"
-                                }
-                            }))
-                    else:
-                        await websocket.send(json.dumps({
-                            "event":"update_or_make_room",
-                            "data":{
-                                "room": room_id,
-                                "name": room_name,
-                                "type": room_type,
-                                "status": "success"
-                                }
-                            }))
-
-                ## get the users in a room -- param: session_token, room id
-                if event == "GetUsersInRoom" :
-                    data = theMessageContent.get("data")
-                    session_token = data['session_token']
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-
-                    room_id = data['room']
-                    owners = await get_room_owner(pool, room_id)
-                    users = await get_user_names_in_room( pool, room_id )
-                    await websocket.send(json.dumps({
-                        "event":"room_users",
-                        "room":room_id,
-                        "users":users or [],
-                        "owners":owners or []
-                    }))
-
-                ## leave room -- param: session_token, room id
-                if event == "LeaveRoom" :
-                    data = theMessageContent.get("data")
-                    session_token = data['session_token']
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-                    
-                    user_id = client_info['user_id']
-                    res = await leave_room( pool, data['room'], user_id )
-                    if( res == True ) :
-                        await websocket.send(json.dumps({
-                            "event":"leave_room_success",
-                        }))
-                    else : 
-                        await websocket.send(json.dumps({
-                            "event":"leave_room_failed",
-                        }))
-
-                ###
-                if event == "SilentRoom" :
-                    data = theMessageContent.get("data")
-                    session_token = data['session_token']
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-                    
-                    user_id = client_info['user_id']
-                    res = await silent_room( pool, data['room'], user_id )
-                    if( res == True ) :
-                        await websocket.send(json.dumps({
-                            "event":"silent_room_success",
-                        }))
-                    else : 
-                        await websocket.send(json.dumps({
-                            "event":"silent_room_failed",
-                        }))
-
-                ###
-                if event == "UnSilentRoom" :
-                    data = theMessageContent.get("data")
-                    session_token = data['session_token']
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-                    
-                    user_id = client_info['user_id']
-                    res = await unsilent_room( pool, data['room'], user_id )
-                    if( res == True ) :
-                        await websocket.send(json.dumps({
-                            "event":"unsilent_room_success",
-                        }))
-                    else : 
-                        await websocket.send(json.dumps({
-                            "event":"unsilent_room_failed",
-                        }))
-                    
-                ## Clear the last seen -- param: session_token, room id
-                if event == "ClearLastMessageSeen":
-                    data = theMessageContent.get("data")
-                    session_token = data['session_token']
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-
-                    room_id = data['room']
-                    user_id = client_info['user_id']
-                    await clear_user_last_seen_msg( pool, user_id, room_id )
-                    await websocket.send(json.dumps({
-                            "event":"cleared_last_seen_msgs",
-                            "data":""
-                        }))
-
-                ## Get all msgs in room after specific msg --- param: session_token, room id, last msg seen
-                if event == "GetMessagesInRoom":
-                    data = theMessageContent.get("data")
-                    session_token = data['session_token']
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-                    room_id = data['room']
-                    last_id = data['last_id']
-                    user_id = client_info['user_id']
-                    organization_id = client_info['organization_id']
-
-                    msgs = await get_messages_in_room( pool, user_id, room_id, organization_id, last_id )
-                    await websocket.send(json.dumps({
-                            "event":"messages_in_room",
-                            "data": msgs
-                        }))
-                    
-                ## Get all msgs in room before a specific msg --- param: session_token, room id, last msg seen
-                if event == "GetPrevMessagesInRoom":
-                    data = theMessageContent.get("data")
-                    session_token = data['session_token']
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-                    room_id = data['room']
-                    last_id = data['last_id']
-                    user_id = client_info['user_id']
-                    organization_id = client_info['organization_id']
-                    msgs = await get_prev_messages_in_room( pool, user_id, room_id, organization_id, last_id )
-                    await websocket.send(json.dumps({
-                            "event":"prev_messages_in_room",
-                            "data": msgs
-                        }))
-                    
-                ## Get the last messages in a room --- param: session_token, room id, last msg seen
-                if event == "GetLastMessagesInRoom":
-                    data = theMessageContent.get("data")
-                    session_token = data['session_token']
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-                    room_id = data['room']
-                    user_id = client_info['user_id']
-                    organization_id = client_info['organization_id']
-
-                    msgs = await get_last_messages_in_room( pool, user_id, room_id, organization_id )
-                    await websocket.send(json.dumps({
-                            "event":"last_messages_in_room",
-                            "data": msgs
-                        }))
-                    
-                ## delete msg in room --- param: session_token, room id, msg_id
-                if event == "DeleteMessageInRoom":
-                    data = theMessageContent.get("data")
-                    session_token = data['session_token']
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-                    room_id = data['room']
-                    user_id = client_info['user_id']
-                    msg_id = data['msg_id']
-                    organization_id = client_info['organization_id']
-
-                    res = await delete_message_in_room( pool, user_id, room_id, msg_id, organization_id )
-                    await websocket.send(json.dumps({
-                            "event":"delete_messages_in_room",
-                            "success": res
-                        }))
-                    
-                ## edit msg in room --- param: session_token, room id, msg_id
-                if event == "EditMessageInRoom":
-                    data = theMessageContent.get("data")
-                    session_token = data['session_token']
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-
-                    room_id = data['room']
-                    user_id = client_info['user_id']
-                    msg_id = data['msg_id']
-                    organization_id = client_info['organization_id']
-                    msg = data['message']
-                    info = data['msginfo']
-
-                    result = await edit_message_in_room( pool, user_id, msg_id, msg, info, room_id, organization_id )
-                    if(result > 0 ) :
-                        await websocket.send(json.dumps({
-                                "event":"edit_message_in_room",
-                                "data": result
-                            }))
-                        
-                        user_ids = await get_users_in_room( pool, room_id )
-
-                        #broadcast it to online users
-                        broadcast_data = json.dumps({
-                            "event": "chat_message_updated",
-                            "data": {
-                                "username": client_info['username'],
-                                'msgid': msg_id,
-                                "room":room_id,
-                                "message": data['message'],
-                                "msginfo": data['msginfo'],
-                            }
-                        })
-                        await send_msg_to_users( pool, broadcast_data, user_ids, organization_id, room_id )
-
-                    else :
-                        await websocket.send(json.dumps({
-                                "event":"edit_message_in_room",
-                                "data": "failed"
-                            }))
-                    
-                if event == "Ping":
-                    data = theMessageContent.get("data") or {}
-                    session_token = data.get('session_token')
-                    if not session_token:
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is missing"
-                        }))
-                        continue
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-                    await websocket.send(json.dumps({
-                        "event":"ping_response",
-                        "status": True,
-                        "user_id": client_info['user_id']
-                        }))
-
-                if event == "GetUserStatus":
-                    data = theMessageContent.get("data") or {}
-                    session_token = data.get('session_token')
-                    if not session_token:
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is missing"
-                        }))
-                        continue
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-                    user_id = client_info['user_id']
-                    await websocket.send(json.dumps({
-                        "event":"user_status_response",
-                        "user_id": user_id,
-                        "status": isUserOnline(user_id),
-                        }))
-                    
-                ## got the event and payload
-                if event == "LastSeenMsg":
-                    data = theMessageContent.get("data")
-                    session_token = data['session_token']
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-
-                    room_id = data['room']
-                    user_id = client_info['user_id']
-                    msg_id = data['msg_id']
-                    organization_id = client_info['organization_id']
-                    result = await update_last_seen_msg_in_room( pool, user_id, room_id, msg_id, organization_id )
-                    await websocket.send(json.dumps({
-                        "event":"update_last_seen_msg_in_room",
-                        "status": result
-                    }))
-                    
-                ## got the event and payload
-                if event == "BroadcastMessage":
-                    data = theMessageContent.get("data")
-                    session_token = data['session_token']
-                    if client_info['session_token'] != session_token :
-                        await websocket.send(json.dumps({
-                            "error":"invalid token",
-                            "data":"Session token is invalid"
-                        }))
-                        continue
-
-                    user_id = client_info['user_id']
-                    organization_id = client_info['organization_id']
-                    room_id = data['room']
-                    user_ids = await get_users_in_room( pool, room_id )
-                    print(f"{user_id}: Got BroadcastMessage ")
-
-                    if user_id in user_ids:
-                        user_ids.remove(user_id)
-                    else:
-                        await websocket.send(json.dumps({
-                            "event":"broadcast_message_response",
-                            "status": False
-                        }))
-                        continue
+            event = theMessageContent.get("event")
+            print(f"Request Event from {client_ip} '{event}'")
+            request = EventRequest(websocket, session, event, theMessageContent)
+            if request.req_id is None or not session.registered:
+                await run_event(request, take_room_turn(request, session.room_tails), session.room_tails)
+                continue
 
-                    #store the msg for offline users
-                    id = await store_new_message(pool, user_id, data['message'], data['msginfo'], room_id, client_info['organization_id'])
-
-                    #broadcast it to online users
-                    broadcast_data = json.dumps({
-                        "event": "chat_message",
-                        "data": {
-                            "username": client_info['username'],
-                            'msgid': id,
-                            "room":room_id,
-                            "message": data['message'],
-                            "msginfo": data['msginfo'],
-                        }
-                    })
-                    await send_msg_to_users( pool, broadcast_data, user_ids, organization_id, room_id )
-
-                    await websocket.send(json.dumps({
-                            "event":"broadcast_message_response",
-                            "status": True,
-                            "msgid": id
-                        }))
-
-            except Exception as outer_err:
-                # Catch websocket errors (disconnects, etc.)
-                print(f"WebSocket error: {outer_err}")
+            if session.inflight is None:
+                # frames tagged with a req_id run concurrently, up to MAX_PIPELINED_REQUESTS per connection
+                session.inflight = asyncio.Semaphore(MAX_PIPELINED_REQUESTS)
+                session.pipelined = set()
+            await session.inflight.acquire()
+            turn = take_room_turn(request, session.room_tails)
+            task = asyncio.create_task(run_pipelined_event(request, turn, session.room_tails, session.inflight))
+            session.pipelined.add(task)
+            task.add_done_callback(session.pipelined.discard)
     except websockets.ConnectionClosed:
-        pass
+        close_sent = websocket.protocol.close_sent
+        if close_sent is not None and close_sent.reason == "keepalive ping timeout":
+            idle_sweeper.reaped["ping_timeout"] += 1
     finally:
+        idle_sweeper.forget(websocket, session)
+        unregister_connection(websocket)
+        if session.presence:
+            presence_notifier.unsubscribe(websocket, session.presence)
         connected_clients.pop(websocket, None)
 
-def send_push_notification(token, title, body, data=None):
+def fcm_send_multicast(tokens, title, body, data=None):
     """
-    Sends a push notification to a specific device via FCM.
-    :param token: The FCM device registration token.
+    Sends one multicast message to up to FCM_MULTICAST_LIMIT devices via FCM.
+    This call blocks, run it through dispatch_push.
+    :param tokens: The FCM device registration tokens.
     :param title: Notification title.
     :param body: Notification body.
     :param data: Optional custom key/value payload (dict).
+    :return: A status per token: "ok", "unregistered" or "error".
     """
-    # Create the message
-    message = messaging.Message(
+    from firebase_admin import messaging, exceptions
+
+    message = messaging.MulticastMessage(
         notification=messaging.Notification(
             title=title,
             body=body,
         ),
-        token=token,
+        tokens=tokens,
         data=data or {}
     )
 
-    # Send message
     try:
-        response = messaging.send(message)
-        print(f"✅ Successfully sent message with token: {token} response:  {response}")
-        return "ok"
-    except messaging.UnregisteredError as e:
-        print(f"FCM token unregistered: {token} error: {e}")
-        return "unregistered"
+        response = messaging.send_each_for_multicast(message)
     except exceptions.FirebaseError as e:
-        print(f"FCM send error for token {token}: {e}")
-        return "error"
+        print(f"FCM multicast error for {len(tokens)} tokens: {e}")
+        return ["error"] * len(tokens)
     except Exception as e:
-        print(f"Unexpected FCM error for token {token}: {e}")
-        return "error"
+        print(f"Unexpected FCM error for {len(tokens)} tokens: {e}")
+        return ["error"] * len(tokens)
+
+    print(f"✅ Successfully sent {response.success_count}/{len(tokens)} messages")
+    statuses = []
+    for token, result in zip(tokens, response.responses):
+        if result.success:
+            statuses.append("ok")
+        elif isinstance(result.exception, messaging.UnregisteredError):
+            print(f"FCM token unregistered: {token} error: {result.exception}")
+            statuses.append("unregistered")
+        else:
+            print(f"FCM send error for token {token}: {result.exception}")
+            statuses.append("error")
+    return statuses
+
+class FakePushTransport:
+    """
+    Local stand-in for FCM, used by tests and benchmarks instead of fcm_send_multicast.
+    Tokens in unregistered_tokens are reported as unregistered, every batch is recorded in sent.
+    """
+    def __init__(self, unregistered_tokens=(), latency=0.0):
+        self.unregistered_tokens = set(unregistered_tokens)
+        self.latency = latency
+        self.sent = []
+
+    def __call__(self, tokens, title, body, data=None):
+        if self.latency:
+            time.sleep(self.latency)
+        self.sent.append((list(tokens), title, body, data))
+        return ["unregistered" if tok in self.unregistered_tokens else "ok" for tok in tokens]
+
+push_transport = fcm_send_multicast
+
+def set_push_transport(transport):
+    global push_transport
+    push_transport = transport
+
+def get_push_executor():
+    global push_executor
+    if push_executor is None:
+        push_executor = ThreadPoolExecutor(max_workers=PUSH_WORKERS, thread_name_prefix="push")
+    return push_executor
+
+async def dispatch_push(tokens, title, body, data=None):
+    """
+    Sends a notification to all tokens without blocking the event loop. Tokens are
+    grouped in multicast batches that run on a bounded thread pool.
+    :return: dict of token -> "ok", "unregistered" or "error".
+    """
+    tokens = [tok for tok in dict.fromkeys(tokens) if tok]
+    if not tokens:
+        return {}
+    loop = asyncio.get_running_loop()
+    executor = get_push_executor()
+    transport = push_transport
+    batches = [tokens[i:i + FCM_MULTICAST_LIMIT] for i in range(0, len(tokens), FCM_MULTICAST_LIMIT)]
+    results = await asyncio.gather(*[
+        loop.run_in_executor(executor, transport, batch, title, body, data)
+        for batch in batches
+    ])
+    statuses = {}
+    for batch, batch_statuses in zip(batches, results):
+        statuses.update(zip(batch, batch_statuses))
+    return statuses
 
 
 # HTTP POST server
 async def http_sendmessage(request):
+    from aiohttp import web
     data = await request.post()
     user = data.get("user", "Console")
     message = data.get("message", "")
-    broadcast_data = json.dumps({
+    broadcast_data = {
         "event": "ChatMessageSent",
         "data": {"user": user, "message": message}
-    })
-    await asyncio.gather(*[
-        client.send(broadcast_data)
-        for client in connected_clients
-    ])
+    }
+    broadcast_message(broadcast_data, list(connected_clients))
     return web.json_response({"status": "ok"})
 
-async def main():
-    global pool
+def init_firebase():
+    import firebase_admin
+    from firebase_admin import credentials, exceptions
 
     try:
         cred = credentials.Certificate("firebase_credentials.json")
@@ -1435,12 +3910,131 @@ async def main():
         # Generic catch-all for anything unexpected
         print("Unexpected error:", e)
 
-    await init_db()
-    pool = await create_pool()
+@contextmanager
+def startup_phase(name):
+    # records how long a startup phase takes in startup_timings
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - start
+
+async def open_database():
+    try:
+        return await create_pool()
+    except aiomysql.OperationalError as e:
+        if e.args[0] != ER_BAD_DB_ERROR:
+            raise
+        await create_database()
+        return await create_pool()
+
+async def open_storage():
+    if STORAGE == "memory":
+        return MemoryStorage()
+    if STORAGE == "sqlite":
+        return SQLiteStorage(SQLITE_PATH)
+    if STORAGE == "mysql":
+        pool = await open_database()
+        # one connection of its own for the MessageWriter, on top of DB_POOL_MAXSIZE
+        return MySQLStorage(pool, getattr(config, "MESSAGE_WRITER_MULTI_ROW", True), await create_pool(1, 1))
+    raise ValueError(f"unknown STORAGE {STORAGE!r}, expected mysql, sqlite or memory")
+
+async def migrate_storage(storage):
+    await storage.migrate()
+    await ensure_notify_user(storage)
+
+async def run_worker_process(worker_id, stopping):
+    # restarts the worker when it exits on its own
+    while True:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            env=dict(os.environ, CCSS_WORKER_ID=str(worker_id)),
+        )
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
+            raise
+        if stopping.is_set():
+            return
+        print(f"Worker {worker_id} exited with {code}, restarting")
+        await asyncio.sleep(1)
+
+async def supervise():
+    """
+    Parent process when WORKERS > 1: migrates the schema once, runs the backplane
+    broker and keeps WORKERS worker processes running until SIGINT/SIGTERM.
+    """
+    if STORAGE == "memory":
+        sys.exit("STORAGE = \"memory\" keeps the rows in one process, it cannot run WORKERS > 1")
+    if STORAGE == "sqlite":
+        sys.exit("STORAGE = \"sqlite\" queries on the event loop thread of one process, it cannot run WORKERS > 1")
+    with startup_phase("db_pool"):
+        schema_storage = await open_storage()
+    with startup_phase("schema"):
+        await migrate_storage(schema_storage)
+    await schema_storage.close()
+
+    broker = BackplaneBroker(BACKPLANE_SOCKET)
+    await broker.start()
+    stopping = asyncio.Event()
+    workers = [asyncio.create_task(run_worker_process(worker_id, stopping)) for worker_id in range(1, WORKERS + 1)]
+    print(f"Started {WORKERS} workers on ws://{SERVER_IP}:{SERVER_PORT}, backplane {BACKPLANE_SOCKET}")
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    await stopping.wait()
+    print("Shutting down workers...")
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    await broker.stop()
+
+async def main():
+    global pool, storage, backplane
+
+    worker_id = os.environ.get("CCSS_WORKER_ID")
+    startup_timings["imports"] = time.perf_counter() - STARTUP_STARTED
+    loop = asyncio.get_running_loop()
+    firebase_ready = None
+    if getattr(config, "PUSH_TRANSPORT", "fcm") == "fake":
+        print("Using the fake push transport, no notifications are sent to FCM")
+        set_push_transport(FakePushTransport())
+    else:
+        # importing and initializing the SDK is slow, do it while the database starts
+        firebase_started = time.perf_counter()
+        firebase_ready = loop.run_in_executor(None, init_firebase)
+
+    with startup_phase("db_pool"):
+        if storage is None:
+            storage = await open_storage()
+        # the aiomysql pool the events share connections of, None for the other storages
+        pool = storage.pool
+    if worker_id is None:
+        with startup_phase("schema"):
+            await migrate_storage(storage)
+    else:
+        # the parent process migrated the schema before starting the workers
+        backplane = UnixSocketBackplane(BACKPLANE_SOCKET, int(worker_id))
+        with startup_phase("backplane"):
+            await backplane.start(handle_backplane_message)
+    last_seen_buffer.start(pool)
+    message_writer.start(pool)
+    idle_sweeper.start()
+    if firebase_ready is not None:
+        await firebase_ready
+        startup_timings["firebase"] = time.perf_counter() - firebase_started
 
     # Start WebSocket server on port 8080
     #ws_server = await websockets.serve(lambda ws, path:ws_handler(ws, path, pool), SERVER_IP, 8080)
-    ws_server = await websockets.serve(ws_handler, SERVER_IP, SERVER_PORT)
+    with startup_phase("listen"):
+        ws_server = await websockets.serve(ws_handler, SERVER_IP, SERVER_PORT, reuse_port=worker_id is not None,
+            subprotocols=list(codecs) or None, select_subprotocol=select_subprotocol,
+            ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT, close_timeout=CLOSE_TIMEOUT,
+            **compression_options())
 
     # Start HTTP server on port 8081
     #app = web.Application()
@@ -1450,9 +4044,28 @@ async def main():
     #site = web.TCPSite(runner, SERVER_IP, 8081)
     #await site.start()
 
-    print(f"WebSocket: ws://{SERVER_IP}:{SERVER_PORT}")
+    startup_timings["total"] = time.perf_counter() - STARTUP_STARTED
+    print("Startup: " + ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in startup_timings.items()))
+    print(f"WebSocket: ws://{SERVER_IP}:{SERVER_PORT}" + (f" (worker {worker_id})" if worker_id else ""))
     #print("HTTP POST: http://{SERVER_IP}:8081/sendmessage")
-    await asyncio.Future()  # run forever
-
 
-asyncio.run(main())
+    # run until SIGINT/SIGTERM, then write out what is still buffered
+    stop = loop.create_future()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+    await stop
+    print("Shutting down...")
+    idle_sweeper.stop()
+    ws_server.close()
+    await ws_server.wait_closed()
+    await message_writer.stop()
+    await last_seen_buffer.stop(pool)
+    await backplane.stop()
+    await storage.close()
+
+
+if __name__ == "__main__":
+    if WORKERS > 1 and "CCSS_WORKER_ID" not in os.environ:
+        asyncio.run(supervise())
+    else:
+        asyncio.run(main())